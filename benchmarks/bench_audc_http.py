@@ -0,0 +1,91 @@
+"""
+AUDC REST scanner benchmark against a local stub HTTP server:
+the old fixed chunks with a session per host vs the AudcHttpEngine sliding window over the shared sessions
+a part of the stub hosts answers slowly, like the real network
+usage: python benchmarks/bench_audc_http.py [hosts] [slow hosts ratio]
+"""
+import sys
+import time
+import random
+import asyncio
+import threading
+from pathlib import Path
+
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from plugins.audc_scanner import AudcHttpEngine
+
+STATUS = {'productType': 'Mediant SW', 'versionID': '7.40A.500.001', 'serialNumber': '1234567', 'macAddress': '00908f0'}
+
+
+def start_stub_server(slow_ratio: float, slow_delay: float = 2.0) -> int:
+    """ run the stub /api/v1/status server in a background thread
+    :return: the server port
+    """
+    rnd = random.Random(1)
+
+    async def status(request: web.Request) -> web.Response:
+        if rnd.random() < slow_ratio:
+            await asyncio.sleep(slow_delay)
+        return web.json_response(STATUS, headers={'Server': 'AudioCodes'})
+
+    started = threading.Event()
+    port_holder = []
+
+    async def serve() -> None:
+        app = web.Application()
+        app.router.add_get('/api/v1/status', status)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0, backlog=4096)
+        await site.start()
+        port_holder.append(site._server.sockets[0].getsockname()[1])
+        started.set()
+        await asyncio.Event().wait()
+
+    threading.Thread(target=asyncio.run, args=(serve(),), daemon=True).start()
+    started.wait()
+    return port_holder[0]
+
+
+async def legacy_get_status(host) -> dict:
+    ip, username, password = host
+    async with aiohttp.ClientSession(auth=aiohttp.BasicAuth(username, password)) as session:
+        async with session.get(f'http://{ip}/api/v1/status') as r:
+            return dict(ip=ip, status=r.status, value=await r.json())
+
+
+async def legacy_chunk(hosts) -> list:
+    return await asyncio.gather(*(legacy_get_status(host) for host in hosts), return_exceptions=True)
+
+
+def legacy(hosts, concurrency: int) -> int:
+    """ the old run_audc_scanner: asyncio.run per chunk, a new session per host """
+    results = 0
+    for index in range(0, len(hosts), concurrency):
+        results += len(asyncio.run(legacy_chunk(hosts[index:index + concurrency])))
+    return results
+
+
+def engine(hosts, concurrency: int) -> int:
+    async def scan() -> int:
+        results = 0
+        async with AudcHttpEngine(concurrency) as http_engine:
+            async for _ in http_engine.scan(hosts):
+                results += 1
+        return results
+    return asyncio.run(scan())
+
+
+if __name__ == '__main__':
+    hosts_num = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    slow_ratio = float(sys.argv[2]) if len(sys.argv) > 2 else 0.01
+    stub_port = start_stub_server(slow_ratio)
+    hosts = [(f'127.0.0.1:{stub_port}', 'Admin', 'Admin')] * hosts_num
+    for func in (legacy, engine):
+        start = time.perf_counter()
+        done = func(hosts, 256)
+        elapsed = time.perf_counter() - start
+        print(f'{func.__name__:8} {done} hosts {elapsed:7.2f} s {done / elapsed:8.0f} hosts/s')
@@ -0,0 +1,58 @@
+"""
+hosts grid records benchmark: the old cell by cell formatting with the sorted keys JSON vs grid_records with
+the precomputed columns formats and the app JSON provider, per row cost of the rows of a synthetic inventory
+usage: python benchmarks/bench_grid_records.py [hosts]
+"""
+import sys
+import json
+import time
+import logging
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+sys.path.insert(0, str(Path(__file__).parent))
+from configuration import Config
+from generate_inventory import generate_inventory
+
+display_values = {'x': '&#10060;', 'ok': '&#9989;', 'down': '&#9760;', 'up': '&#9989;'}
+
+
+def legacy(headers: list[str], rows: list[tuple]) -> str:
+    """ the old get_table_data records and jsonify (sorted keys) """
+    records = []
+    for row in rows:
+        record = {'recid': row[0]}
+        for param_name, param in zip(headers, row):
+            if param_name != 'ipv4' and isinstance(param, str):
+                param = param[0:32].replace('\n', '')
+                param = display_values.get(param, param)
+            record[param_name] = param
+        records.append(record)
+    return json.dumps({'status': 'success', 'total': len(rows), 'records': records}, sort_keys=True)
+
+
+def current(headers: list[str], rows: list[tuple]) -> str:
+    from web_app.flask_web import app, grid_records
+    return app.json.dumps({'status': 'success', 'total': len(rows), 'records': grid_records('hosts', headers, rows)})
+
+
+if __name__ == '__main__':
+    hosts_num = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    logging.disable(logging.INFO)
+    with tempfile.TemporaryDirectory() as tmp:
+        Config.db_file = Path(tmp) / 'net_scan_data.db'
+        generate_inventory(Config.db_file, hosts_num)
+        from sql_connection import get_sql_connection
+        sql = get_sql_connection()
+        hosts_headers = sql.get_hosts_ordered_header()
+        _, hosts_rows = sql.query_table('hosts', hosts_headers, limit=hosts_num)
+        sql.conn.close()
+        # the flask app import is not measured
+        import web_app.flask_web
+    for func in (legacy, current):
+        start = time.perf_counter()
+        size = len(func(hosts_headers, hosts_rows))
+        elapsed = time.perf_counter() - start
+        print(f'{func.__name__:8} {len(hosts_rows)} rows {elapsed:6.2f} s {elapsed / len(hosts_rows) * 1e6:6.2f} us/row '
+              f'{size / len(hosts_rows):5.0f} bytes/row')
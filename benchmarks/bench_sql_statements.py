@@ -0,0 +1,37 @@
+"""
+hosts updates micro-benchmark: SQL text built per value (the old data layer) vs the named parameterized statements
+usage: python benchmarks/bench_sql_statements.py [updates]
+"""
+import sys
+import time
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from sql_connection import SqlConnection
+
+
+def string_built(sql: SqlConnection, ips: list[str], current_date: str) -> None:
+    for num, ipv4 in enumerate(ips):
+        sql.cursor.execute(f"UPDATE hosts SET status='up', name='host{num}', updated='{current_date}' WHERE ipv4='{ipv4}'")
+    sql.conn.commit()
+
+
+def parameterized(sql: SqlConnection, ips: list[str], current_date: str) -> None:
+    for num, ipv4 in enumerate(ips):
+        sql.update_host_fields(ipv4, {'status': 'up', 'name': f'host{num}', 'updated': current_date}, commit=False)
+    sql.conn.commit()
+
+
+if __name__ == '__main__':
+    updates = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    ips = [f'10.{num >> 16 & 255}.{num >> 8 & 255}.{num & 255}' for num in range(updates)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        sql = SqlConnection(Path(tmp_dir) / 'bench.db')
+        sql.bulk_upsert_hosts([{'ipv4': ipv4} for ipv4 in ips])
+        for func in (string_built, parameterized):
+            start = time.perf_counter()
+            func(sql, ips, time.ctime())
+            elapsed = time.perf_counter() - start
+            print(f'{func.__name__:14} {updates} updates {elapsed:7.2f} s {updates / elapsed:10.0f} updates/s')
+        sql.conn.close()
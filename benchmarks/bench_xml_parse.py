@@ -0,0 +1,52 @@
+"""
+nmap XML ingestion benchmark: ElementTree (XmlParser) vs streaming iter_nmap_hosts
+every measurement runs in its own process to get a clean peak RSS
+usage: python benchmarks/bench_xml_parse.py [hosts ...]
+"""
+import sys
+import time
+import subprocess
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+sys.path.insert(0, str(Path(__file__).parent))
+from configuration import Config, XmlParser, iter_nmap_hosts
+from synthetic_nmap import write_nmap_xml
+
+
+def peak_rss_mb() -> float:
+    try:
+        import resource
+    except ImportError:
+        return float('nan')
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024
+
+
+def parse(parser: str, xml_file: str) -> None:
+    start = time.perf_counter()
+    count = 0
+    if parser == 'tree':
+        for host in XmlParser(xml_file).root.findall('host'):
+            host.findall('address')
+            host.find('ports')
+            count += 1
+    else:
+        for _ in iter_nmap_hosts(xml_file):
+            count += 1
+    elapsed = time.perf_counter() - start
+    print(f'{parser:6} {count:8} hosts {elapsed:8.2f} s {count / elapsed:10.0f} hosts/s '
+          f'peak RSS {peak_rss_mb():8.1f} MB')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == '--parse':
+        parse(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+    for hosts in [int(arg) for arg in sys.argv[1:]] or [10_000, 100_000]:
+        xml_file = Config.tmp_folder_path / f'bench_nmap_{hosts}.xml'
+        write_nmap_xml(xml_file, hosts)
+        print(f'== {hosts} hosts, {xml_file.stat().st_size / 1024 / 1024:.1f} MB XML')
+        for parser in ('tree', 'stream'):
+            subprocess.run([sys.executable, __file__, '--parse', parser, str(xml_file)], check=True)
+        xml_file.unlink()
@@ -0,0 +1,62 @@
+"""
+stub nmap for the offline benchmarks: writes realistic -oX output for the -iL targets without touching the network
+set Config.nmap_command = [sys.executable, 'benchmarks/fake_nmap.py'], the simulated network is set by the environment:
+    FAKE_NMAP_DENSITY     share of the target addresses that are alive (0.3)
+    FAKE_NMAP_OPEN_RATIO  share of the scanned ports that are open (0.5)
+    FAKE_NMAP_OS_RATIO    share of the -O scanned hosts with an OS match (0.8)
+    FAKE_NMAP_LATENCY     scan time per alive host, sec (0)
+the alive hosts, their MACs and ports depend only on the address, so the repeated scans see the same network
+"""
+import os
+import sys
+import time
+import random
+import ipaddress
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+from synthetic_nmap import host_xml, OS_FAMILIES
+
+
+def arg_value(args: list[str], name: str, default: str = '') -> str:
+    return args[args.index(name) + 1] if name in args else default
+
+
+def expand_targets(targets: list[str]) -> list[str]:
+    ips = []
+    for target in targets:
+        network = ipaddress.ip_network(target, strict=False)
+        ips += [str(ip) for ip in (network.hosts() if network.num_addresses > 2 else network)]
+    return ips
+
+
+def main(args: list[str]) -> int:
+    density = float(os.environ.get('FAKE_NMAP_DENSITY', 0.3))
+    open_ratio = float(os.environ.get('FAKE_NMAP_OPEN_RATIO', 0.5))
+    os_ratio = float(os.environ.get('FAKE_NMAP_OS_RATIO', 0.8))
+    latency = float(os.environ.get('FAKE_NMAP_LATENCY', 0))
+    xml_file = arg_value(args, '-oX')
+    targets = Path(arg_value(args, '-iL')).read_text().split() if '-iL' in args else []
+    ports = () if '-sn' in args else tuple(int(port.split(':')[-1]) for port in arg_value(args, '-p').split(',') if port)
+    os_detection = '-O' in args
+    alive = []
+    for ip in expand_targets(targets):
+        rnd = random.Random(ip)
+        if rnd.random() < density:
+            alive.append((ip, rnd))
+    time.sleep(latency * len(alive))
+    with open(xml_file, 'w') as fh:
+        fh.write(f'<?xml version="1.0" encoding="UTF-8"?>\n'
+                 f'<nmaprun scanner="nmap" args="{" ".join(args)}" version="7.94">\n')
+        for ip, rnd in alive:
+            os_family = rnd.choice(OS_FAMILIES) if rnd.random() < os_ratio else None
+            fh.write(host_xml(ip, ports, open_ratio, os_family if os_detection else None, rnd))
+            fh.write('\n')
+        fh.write(f'<runstats><finished time="{int(time.time())}" exit="success"/>'
+                 f'<hosts up="{len(alive)}" down="0" total="{len(alive)}"/></runstats>\n</nmaprun>\n')
+    print(f'Nmap done: {len(targets)} targets, {len(alive)} hosts up')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,56 @@
+"""
+synthetic inventory: fill a net_scan_data.db with the hosts, alive_networks and b_networks of a large network
+usage: python benchmarks/generate_inventory.py <db file> [hosts] [seed]
+"""
+import sys
+import time
+import random
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from configuration import Config
+from sql_connection import SqlConnection
+
+OS_FAMILIES = ('Linux', 'Windows', 'embedded', 'IOS', '')
+CHUNK = 50_000
+
+
+def host_record(num: int, rnd: random.Random) -> dict:
+    """ the num-th host: 10.x.y.z, 200 hosts per C network """
+    c_net, host = divmod(num, 200)
+    record = dict(
+        ipv4=f'10.{c_net >> 8 & 255}.{c_net & 255}.{host + 1}',
+        name=f'host{num}',
+        domain='example.local',
+        os=rnd.choice(OS_FAMILIES),
+        status='up' if rnd.random() < 0.9 else 'down',
+        scanned='1',
+    )
+    for column in Config.check_ports_dict.values():
+        record[column] = 'ok' if rnd.random() < 0.4 else 'x'
+    if rnd.random() < 0.05:
+        record.update(type='AUDC', productType='Mediant SW', version='7.40A.500.001', http='ok')
+    return record
+
+
+def generate_inventory(db: str | Path, hosts: int, seed: int = 0) -> None:
+    rnd = random.Random(seed)
+    sql = SqlConnection(db)
+    for start in range(0, hosts, CHUNK):
+        sql.bulk_upsert_hosts([host_record(num, rnd) for num in range(start, min(hosts, start + CHUNK))])
+    c_networks = (hosts + 199) // 200
+    with sql.conn:
+        sql.executemany('alive_network_upsert', [
+            (f'10.{c_net >> 8 & 255}.{c_net & 255}.0/24', min(200, hosts - c_net * 200)) for c_net in range(c_networks)
+        ])
+        sql.cursor.executemany('INSERT OR IGNORE INTO b_networks (network, status) VALUES (?, ?)',
+                               [(f'10.{b_net}.0.0/16', 'idle') for b_net in range((c_networks + 255) // 256)])
+    sql.conn.close()
+
+
+if __name__ == '__main__':
+    db_file = Path(sys.argv[1])
+    hosts_num = int(sys.argv[2]) if len(sys.argv) > 2 else 10_000
+    start_time = time.perf_counter()
+    generate_inventory(db_file, hosts_num, int(sys.argv[3]) if len(sys.argv) > 3 else 0)
+    print(f'{hosts_num} hosts written to {db_file} in {time.perf_counter() - start_time:.1f} s')
@@ -0,0 +1,150 @@
+"""
+offline benchmark suite: a synthetic inventory, the fake nmap and a local AUDC stub server instead of the network
+the results are saved as JSON, --compare prints the change against the results of a previous release
+the INFO logs are disabled, the numbers measure the code and not the log handlers
+usage: python benchmarks/run_benchmarks.py [--hosts 10000] [--out results.json] [--compare old_results.json]
+"""
+import sys
+import json
+import time
+import asyncio
+import logging
+import platform
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+from statistics import median
+from datetime import datetime
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+sys.path.insert(0, str(Path(__file__).parent))
+from configuration import Config
+from synthetic_nmap import write_nmap_xml
+from generate_inventory import generate_inventory
+from bench_audc_http import start_stub_server
+
+BENCH_DIR = Path(__file__).parent
+
+
+def timed(func, *args, repeat: int = 1, **kwargs) -> tuple[float, object]:
+    """ :return: (median seconds, the result of the last run) """
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    return median(times), result
+
+
+def bench_process_nmap_res(sql, hosts: int, tmp_dir: Path) -> dict:
+    from scanner import process_nmap_res
+    xml_file = tmp_dir / 'process_nmap_res.xml'
+    write_nmap_xml(xml_file, hosts, first_ip='172.16.0.1')
+    seconds, _ = timed(process_nmap_res, sql, xml_file)
+    return dict(seconds=seconds, items=hosts)
+
+
+def bench_update_hosts_table(sql, hosts: int) -> dict:
+    records = [dict(ipv4=f'172.17.{num >> 8 & 255}.{num & 255}', status='up', scanned='1') for num in range(hosts)]
+
+    def update_all():
+        for host_obj in records:
+            sql.update_hosts_table(host_obj)
+    seconds, _ = timed(update_all)
+    return dict(seconds=seconds, items=hosts)
+
+
+def bench_web(path: str) -> dict:
+    from web_app.flask_web import app
+    client = app.test_client()
+    client.get(path)
+    seconds, response = timed(client.get, path, repeat=20)
+    assert response.status_code == 200, response.status_code
+    return dict(seconds=seconds, items=1)
+
+
+def bench_audc_pass(sql) -> dict:
+    from plugins.audc_scanner import AudcHttpEngine, audc_scan_pass
+    port = start_stub_server(slow_ratio=0.01)
+
+    async def audc_pass() -> int:
+        async with AudcHttpEngine(status_url=f'http://127.0.0.1:{port}/api/v1/status?host={{ip}}') as engine:
+            return await audc_scan_pass(sql, engine, logging.getLogger('bench'))
+    sql.cursor.execute('DELETE FROM probe_state')
+    sql.conn.commit()
+    seconds, found = timed(asyncio.run, audc_pass())
+    probed = sql.cursor.execute("SELECT count(*) FROM probe_state WHERE plugin='audc'").fetchone()[0]
+    return dict(seconds=seconds, items=probed, found=found)
+
+
+def bench_refresher(hosts: int) -> dict:
+    from refresher import search_for_dead
+    seconds, _ = timed(search_for_dead, one_cycle=True)
+    return dict(seconds=seconds, items=hosts)
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=BENCH_DIR, capture_output=True,
+                              text=True).stdout.strip()
+    except OSError:
+        return ''
+
+
+def compare(results: dict, old_file: Path) -> None:
+    old = json.loads(old_file.read_text())['results']
+    for name, res in results.items():
+        if name in old and old[name]['seconds']:
+            change = (res['seconds'] / old[name]['seconds'] - 1) * 100
+            print(f'{name:20} {old[name]["seconds"]:9.3f} s -> {res["seconds"]:9.3f} s {change:+7.1f}%')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hosts', type=int, default=10_000, help='the synthetic inventory size')
+    parser.add_argument('--out', type=Path, help='the results JSON file')
+    parser.add_argument('--compare', type=Path, help='the results JSON of a previous run')
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp_dir = Path(tmp)
+        Config.db_file = tmp_dir / 'net_scan_data.db'
+        Config.nmap_command = [sys.executable, str(BENCH_DIR / 'fake_nmap.py')]
+        generate_inventory(Config.db_file, args.hosts)
+        from sql_connection import get_sql_connection
+        sql = get_sql_connection()
+        results = {
+            'process_nmap_res': bench_process_nmap_res(sql, args.hosts, tmp_dir),
+            'update_hosts_table': bench_update_hosts_table(sql, min(args.hosts, 10_000)),
+            'web_index': bench_web('/'),
+            'web_hosts_page': bench_web('/data/hosts?request={"limit":100,"offset":0}'),
+            'audc_pass': bench_audc_pass(sql),
+            # the refresher changes the hosts statuses - the last one
+            'refresher_cycle': bench_refresher(args.hosts),
+        }
+        sql.conn.close()
+    for res in results.values():
+        res['per_second'] = res['items'] / res['seconds'] if res['seconds'] else 0
+    report = dict(
+        date=datetime.now().isoformat(timespec='seconds'),
+        revision=git_revision(),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        hosts=args.hosts,
+        results=results,
+    )
+    out = args.out or BENCH_DIR / 'results' / f'bench_{datetime.now():%Y%m%d_%H%M%S}.json'
+    out.parent.mkdir(exist_ok=True)
+    out.write_text(json.dumps(report, indent=2))
+    for name, res in results.items():
+        print(f'{name:20} {res["seconds"]:9.3f} s {res["per_second"]:12.0f} /s')
+    print(f'The results are saved in {out}')
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
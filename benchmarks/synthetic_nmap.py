@@ -0,0 +1,66 @@
+"""
+synthetic nmap -oX output for the benchmarks
+"""
+import random
+import ipaddress
+from pathlib import Path
+from typing import Optional
+
+OS_FAMILIES = ('Linux', 'Windows', 'embedded', 'IOS', 'FreeBSD')
+VENDORS = ('AudioCodes', 'Dell', 'Cisco Systems', 'VMware', 'Hewlett Packard')
+
+
+def host_xml(
+        ip: str,
+        ports: tuple[int, ...] = (22, 80, 443, 3389),
+        open_ratio: float = 0.5,
+        os_family: Optional[str] = None,
+        rnd: random.Random = random,
+) -> str:
+    """ one nmap <host> element """
+    mac = ':'.join(f'{rnd.randrange(256):02X}' for _ in range(6))
+    lines = [
+        '<host starttime="1700000000" endtime="1700000001"><status state="up" reason="syn-ack" reason_ttl="0"/>',
+        f'<address addr="{ip}" addrtype="ipv4"/>',
+        f'<address addr="{mac}" addrtype="mac" vendor="{rnd.choice(VENDORS)}"/>',
+        f'<hostnames><hostname name="host-{ip.replace(".", "-")}.example.local" type="PTR"/></hostnames>',
+        '<ports>',
+    ]
+    for port in ports:
+        state = 'open' if rnd.random() < open_ratio else 'closed'
+        lines.append(f'<port protocol="tcp" portid="{port}"><state state="{state}" reason="syn-ack" reason_ttl="0"/>'
+                     f'<service name="unknown" method="table" conf="3"/></port>')
+    lines.append('</ports>')
+    if os_family:
+        lines.append(f'<os><osmatch name="{os_family} generic" accuracy="96" line="1">'
+                     f'<osclass type="general purpose" vendor="{os_family}" osfamily="{os_family}" accuracy="96"/>'
+                     f'</osmatch></os>')
+    lines.append('<times srtt="1000" rttvar="1000" to="100000"/></host>')
+    return '\n'.join(lines)
+
+
+def write_nmap_xml(
+        xml_file: str | Path,
+        hosts: int | list[str],
+        first_ip: str = '10.0.0.1',
+        ports: tuple[int, ...] = (22, 80, 443, 3389),
+        open_ratio: float = 0.5,
+        os_ratio: float = 0.8,
+        seed: int = 0,
+) -> list[str]:
+    """ write nmap XML with the given hosts (or number of consecutive hosts starting from first_ip)
+    :return: the IPs of the written hosts
+    """
+    rnd = random.Random(seed)
+    if isinstance(hosts, int):
+        start = int(ipaddress.IPv4Address(first_ip))
+        hosts = [str(ipaddress.IPv4Address(start + ind)) for ind in range(hosts)]
+    with open(xml_file, 'w') as fh:
+        fh.write('<?xml version="1.0" encoding="UTF-8"?>\n<nmaprun scanner="nmap" args="nmap" version="7.94">\n')
+        for ip in hosts:
+            os_family = rnd.choice(OS_FAMILIES) if rnd.random() < os_ratio else None
+            fh.write(host_xml(ip, ports, open_ratio, os_family, rnd))
+            fh.write('\n')
+        fh.write(f'<runstats><finished time="1700000100" exit="success"/>'
+                 f'<hosts up="{len(hosts)}" down="0" total="{len(hosts)}"/></runstats>\n</nmaprun>\n')
+    return hosts
@@ -0,0 +1,60 @@
+"""
+live change feed of the grids: the DB triggers (see sql_migrations.create_revision_triggers) stamp every inserted
+or changed row of the FEED_TABLES with the next revision and leave a tombstone of every deleted row,
+a client keeps the last revision it has seen and asks only for the rows changed after it instead of reloading the table
+"""
+import time
+import logging
+from typing import Optional
+
+from configuration import Config
+from sql_migrations import FEED_TABLES, FEED_COLUMNS
+
+log = logging.getLogger('change_feed')
+
+
+def current_revision(sql) -> int:
+    return sql.execute('revision_get', ('rows',)).fetchone()[0]
+
+
+def tables_version(sql) -> int:
+    """ grows with every write of the grid tables: the rows revisions, the expired tombstones and the 'tables'
+    counter of the other writes (see sql_migrations.add_tables_version)
+    """
+    return sql.execute('tables_version').fetchone()[0]
+
+
+def changes_since(sql, table: str, select: list[str], since: int, limit: Optional[int] = None) -> dict:
+    """ the changes of the table after the since revision, at most limit rows
+    :param select: the columns of the changed rows, the key column first
+    :return: {revision: the revision the client has after applying the changes, rows: [(*select, revision)],
+        inserted: [keys of the rows inserted after the since revision, the other rows are changed],
+        deleted: [keys of the rows the client may have], reset: the client revision is older than the expired tombstones (or newer than the DB),
+        the client should reload the table}
+    """
+    limit = limit or Config.feed_batch
+    upto = current_revision(sql)
+    if since > upto or since < sql.execute('revision_get', ('tombstones',)).fetchone()[0]:
+        return dict(revision=upto, rows=[], inserted=[], deleted=[], reset=True)
+    rows = sql.rows_changed_since(table, select, since, upto, limit)
+    if len(rows) == limit:
+        # the rest of the changes in the next batch
+        upto = rows[-1][-1]
+    inserted = sql.rows_created_since(table, since, upto)
+    deleted = [key for key, in sql.execute('row_tombstones_since', (table, since, upto, since)).fetchall()]
+    return dict(revision=upto, rows=rows, inserted=inserted, deleted=deleted, reset=False)
+
+
+def expire_tombstones(sql, now: Optional[float] = None) -> int:
+    """ delete the tombstones older than feed_tombstones_days, the clients behind them get a reset
+    :return: number of the deleted tombstones
+    """
+    now = now or time.time()
+    expired = sql.execute('row_tombstones_expired', (now - Config.feed_tombstones_days * 86400,)).fetchone()[0]
+    if expired is None:
+        return 0
+    with sql.conn:
+        deleted = sql.execute('row_tombstones_expire', (expired,)).rowcount
+        sql.execute('revision_raise', (expired, 'tombstones'))
+    log.info(f'{deleted} expired tombstones of {", ".join(FEED_TABLES)} deleted')
+    return deleted
@@ -4,13 +4,13 @@ the configuration is overridden by appsettings.json file settings
 """
 import sys
 from pathlib import Path
-import ipaddress
 import logging
 from logging.handlers import RotatingFileHandler, QueueHandler
 import xml.etree.ElementTree as eT
-from typing import Optional
+from typing import Optional, Iterator
 
 sys.path.insert(0, Path(__file__).parent)
+from net_trie import NetworkScope
 
 
 class Config:
@@ -29,19 +29,89 @@ class Config:
     tmp_folder_path: Path = root_path / 'tmp'
     tmp_folder_path.mkdir(exist_ok=True)
     log_file: Path = log_files_path / 'netscan.log'
+    db_file: Path = root_path / 'net_scan_data.db'
+    # the nmap executable and its leading arguments, the benchmarks use [sys.executable, 'benchmarks/fake_nmap.py']
+    nmap_command: list[str] = ['nmap.exe']
     search_for_dead_period: int = 4
-    search_for_dead_burst: int = 5
+    # liveness sweep: initial hosts per nmap job, the batch size adapts to search_for_dead_target_latency
+    search_for_dead_burst: int = 256
+    search_for_dead_max_burst: int = 4096
+    search_for_dead_target_latency: int = 60
+    search_for_dead_jobs: int = 4
     sleep_between_c_networks_scan: int = 10
+    # number of C networks scanned concurrently by the scan pool workers
+    scan_workers: int = 4
+    # 'per_c_network' - ports and OS scan of every C network, 'two_phase' - host discovery sweep of
+    # discovery_chunk_networks C networks per nmap, then ports and OS scan of the alive hosts only,
+    # both modes check for new B networks and sleep after every scan_workers jobs,
+    # the scan_engine runs the ports scan of both modes, the two_phase discovery sweep is always nmap
+    scan_mode: str = 'two_phase'
+    discovery_chunk_networks: int = 16
+    port_scan_batch_hosts: int = 256
+    # the nmap -O result is reused while the host mac and open ports do not change (0 - always run -O)
+    os_cache_ttl: int = 7 * 24 * 3600
+    # C networks scan scheduler: the rescan interval of a network with hosts, the empty networks back off
+    # up to scan_base_interval * 2 ** scan_max_backoff
+    scan_base_interval: int = 6 * 3600
+    scan_max_backoff: int = 6
+    scan_density_weight: float = 1.0
+    scan_churn_weight: float = 4.0
+    # 'nmap' or 'native' (asyncio TCP connect probes) engine for the ports scan and the liveness sweeps
+    # (the two_phase scan_mode discovers the alive hosts with nmap and probes their ports by the engine)
+    scan_engine: str = 'nmap'
+    liveness_engine: str = 'nmap'
+    native_probe_concurrency: int = 512
+    native_probe_timeout: float = 1.0
+    native_host_timeout: float = 3.0
     filter_os_for_AUDC_scan: str = "os<>'Windows' AND os<>'JUNOS' AND os<>'iLO' AND os<>'ESXi' AND \
     os<>'FreeBSD' AND os<>'OpenBSD' AND os<>'Data ONTAP' and os<>'IOS' AND os<>'AOS' AND os<>'FreeNAS' \
     AND os<>'Android' AND os<>'DESQview/X' AND os<>'Solaris' AND os<>'CyanogenMod'"
+    # AUDC REST scanner HTTP engine
+    audc_concurrency: int = 512  # requests in flight
+    audc_connect_timeout: float = 5.0
+    audc_read_timeout: float = 10.0
+    audc_total_timeout: float = 20.0
+    audc_old_hw_workers: int = 32
+    audc_old_hw_host_interval: float = 1.0  # min sec between the requests to the same old HW host
+    # the plugins probe backoff: the failed (or not matching) host waits base * 2 ** (failures - 1) sec
+    probe_backoff_base: int = 1200
+    probe_backoff_max_exp: int = 6
+    # the plugins hosts updates are written in one transaction per batch or interval (sec)
+    hosts_write_batch: int = 500
+    hosts_write_interval: float = 5.0
 
     selected_networks: tuple[str] | list[str] = ('10.8.0.0/16', '10.3.0.0/16')
     exclude_networks: tuple[str] | list[str] = ()
-    exclude_networks_obj_list: list[ipaddress] = [ipaddress.ip_network(net) for net in exclude_networks]
+    # the scans are limited to these networks (empty - no limit)
+    allowed_networks: tuple[str] | list[str] = ()
+    # built from allowed_networks and exclude_networks after appsettings.json is loaded
+    scan_scope: NetworkScope = NetworkScope()
     exclude_file: Path = tmp_folder_path / f'exclude_networks.txt'
-    with open(exclude_file, 'w') as fh:
-        fh.write('\n'.join(exclude_networks))
+
+    # hosts availability history retention: the raw up/down transitions, the hourly and the daily buckets
+    history_raw_retention_days: int = 7
+    history_hourly_retention_days: int = 30
+    history_daily_retention_days: int = 365
+    # the processes add their metrics to the DB at least every metrics_flush_interval sec (when busy)
+    metrics_flush_interval: float = 15.0
+    # live change feed of the grids: a stream polls the revision every feed_poll_interval sec and ends after
+    # feed_stream_seconds (the browser reconnects), the deleted rows tombstones are kept feed_tombstones_days
+    feed_poll_interval: float = 1.0
+    feed_stream_seconds: int = 30
+    feed_retry_ms: int = 2000
+    feed_batch: int = 1000
+    feed_tombstones_days: int = 7
+    # the waitress worker threads, every open change feed stream holds one
+    web_app_threads: int = 64
+    # the rendered pages of the last web_cache_entries URLs are reused while the grid tables version is the same,
+    # the responses over web_gzip_min_bytes are compressed
+    web_cache_entries: int = 256
+    web_gzip_min_bytes: int = 1024
+    web_gzip_level: int = 6
+    # SQLite connections tuning
+    sqlite_busy_timeout: int = 30_000  # ms
+    sqlite_synchronous: str = 'NORMAL'
+    sqlite_cache_size_kb: int = 64_000
 
     check_ports_dict: dict[str, str] = {'T:22': 'ssh', 'T:80': 'http', 'T:443': 'https', 'T:3389': 'rdp'}
     sql_fields: dict[str, str] = {
@@ -132,6 +202,39 @@ class XmlParser:
         self.root = tree.getroot()
 
 
+def iter_nmap_hosts(xml_res_file: str | Path) -> Iterator[dict]:
+    """ stream the <host> elements of the nmap XML result as compact records,
+    the parsed elements are cleared on the fly, so the memory does not grow with the scan size
+    :param xml_res_file: nmap -oX output
+    :return: records: ipv4, mac, macvendor, state, ports [(protocol, portid, state)], hostname, osfamily
+    """
+    context = eT.iterparse(xml_res_file, events=('start', 'end'))
+    _, root = next(context)
+    for event, elem in context:
+        if event != 'end' or elem.tag != 'host':
+            continue
+        record = dict(ipv4='', mac='', macvendor='', state='', ports=[], hostname='', osfamily='')
+        for host_addr in elem.iterfind('address'):
+            if host_addr.get('addrtype') == 'ipv4':
+                record['ipv4'] = host_addr.get('addr')
+            elif host_addr.get('addrtype') == 'mac':
+                record['mac'] = host_addr.get('addr', '').replace(':', '').lower()
+                record['macvendor'] = host_addr.get('vendor', '')
+        if (status := elem.find('status')) is not None:
+            record['state'] = status.get('state', '')
+        for port in elem.iterfind('ports/port'):
+            state = port.find('state')
+            record['ports'].append(
+                (port.get('protocol'), port.get('portid'), state.get('state') if state is not None else '')
+            )
+        if (hostname := elem.find('hostnames/hostname')) is not None:
+            record['hostname'] = hostname.get('name', '')
+        if (osclass := elem.find('os/osmatch/osclass')) is not None:
+            record['osfamily'] = osclass.get('osfamily', '')
+        yield record
+        root.clear()
+
+
 if (Path(__file__).parent / 'appsettings.json').exists():
     import json
     with open(Path(__file__).parent / 'appsettings.json') as fh:
@@ -140,3 +243,8 @@ if (Path(__file__).parent / 'appsettings.json').exists():
         if key not in dir(Config):
             raise Exception(f'Bad key in appsettings.json: {key}')
         setattr(Config, key, app_settings[key])
+
+# the nmap exclude file has the collapsed exclude networks
+Config.scan_scope = NetworkScope(Config.allowed_networks, Config.exclude_networks)
+with open(Config.exclude_file, 'w') as exclude_fh:
+    exclude_fh.write('\n'.join(str(network) for network in Config.scan_scope.deny.networks()))
@@ -0,0 +1,174 @@
+"""
+hosts availability history: the refresher appends the up/down changes (not the polls) to host_transitions,
+the transitions are rolled up into the hourly and daily host_availability buckets and expire by the retention
+only the buckets with transitions are stored, the hours without a row keep the state of the previous change,
+so the storage grows with the flapping and not with the number of the hosts (the last transition of a host is kept)
+"""
+import time
+import logging
+from typing import Optional
+
+from configuration import Config
+
+log = logging.getLogger('history')
+
+PERIODS: dict[str, int] = {'h': 3600, 'd': 86400}
+
+
+def retention(period: str) -> float:
+    """ the seconds the transitions ('raw') or the buckets of the period are kept """
+    days = {
+        'raw': Config.history_raw_retention_days,
+        'h': Config.history_hourly_retention_days,
+        'd': Config.history_daily_retention_days,
+    }[period]
+    return days * 86400
+
+
+def get_watermark(sql, name: str) -> Optional[float]:
+    row = sql.execute('history_state_get', (name,)).fetchone()
+    return row[0] if row else None
+
+
+def split_to_buckets(
+        state: Optional[str],
+        transitions: list[tuple[float, str]],
+        start: float,
+        end: float,
+        size: int,
+) -> dict[int, list]:
+    """ the up/down seconds of the buckets of [start, end)
+    :param state: the status at start (None - unknown, the time until the first transition is not counted)
+    :return: {bucket start: [up seconds, down seconds, transitions, status at the bucket end]}
+    """
+    buckets: dict[int, list] = {}
+    moment = start
+    for at, status in [*transitions, (end, None)]:
+        while moment < at:
+            bucket = int(moment // size * size)
+            segment_end = min(at, bucket + size)
+            row = buckets.setdefault(bucket, [0.0, 0.0, 0, state])
+            if state == 'up':
+                row[0] += segment_end - moment
+            elif state == 'down':
+                row[1] += segment_end - moment
+            moment = segment_end
+        if status:
+            row = buckets.setdefault(int(at // size * size), [0.0, 0.0, 0, state])
+            # the first observation of the host is not a change
+            if state and status != state:
+                row[2] += 1
+            row[3] = state = status
+    return buckets
+
+
+def rollup(sql, period: str, now: Optional[float] = None) -> int:
+    """ roll up the transitions of the completed buckets since the last rollup of the period
+    :return: number of the written buckets
+    """
+    now = now or time.time()
+    size = PERIODS[period]
+    end = now // size * size
+    start = get_watermark(sql, period)
+    if start is None:
+        first = sql.execute('host_transitions_first').fetchone()[0]
+        if first is None:
+            return 0
+        start = first // size * size
+    if start >= end:
+        return 0
+    states = dict(sql.execute('host_transitions_states_before', (start, end, start)).fetchall())
+    transitions: dict[str, list[tuple[float, str]]] = {}
+    for ipv4, at, status in sql.execute('host_transitions_window', (start, end)).fetchall():
+        transitions.setdefault(ipv4, []).append((at, status))
+    rows = []
+    for ipv4, host_transitions in transitions.items():
+        # the bucket of the first observation of the host anchors its state for the following buckets
+        anchor = None if ipv4 in states else int(host_transitions[0][0] // size * size)
+        for bucket, (up, down, count, status) in split_to_buckets(
+                states.get(ipv4), host_transitions, start, end, size).items():
+            if count or bucket == anchor:
+                rows.append((ipv4, period, bucket, up, down, count, status))
+    with sql.conn:
+        sql.executemany('host_availability_upsert', rows)
+        sql.execute('history_state_set', (period, end))
+    log.info(f'{len(rows)} {period} availability buckets of {len(transitions)} hosts rolled up')
+    return len(rows)
+
+
+def compact(sql, now: Optional[float] = None) -> None:
+    """ delete the expired transitions (except the last one of the existing hosts) and buckets """
+    now = now or time.time()
+    with sql.conn:
+        deleted = sql.execute('host_transitions_compact', (now - retention('raw'),)).rowcount
+        for period in PERIODS:
+            deleted += sql.execute('host_availability_expire', (period, now - retention(period))).rowcount
+        sql.execute('history_state_set', ('compact', now))
+    log.info(f'{deleted} expired history rows deleted')
+
+
+def maintain(sql, now: Optional[float] = None) -> None:
+    """ the periodic rollups and the daily compaction, called after the refresher pass """
+    now = now or time.time()
+    for period in PERIODS:
+        rollup(sql, period, now)
+    if now - (get_watermark(sql, 'compact') or 0) >= PERIODS['d']:
+        compact(sql, now)
+
+
+def state_at(sql, ipv4: str, moment: float) -> Optional[str]:
+    """ the host status at the moment by the latest of the raw transitions and the rolled up buckets """
+    candidates = []
+    if row := sql.execute('host_transition_before', (ipv4, moment)).fetchone():
+        candidates.append(row)
+    for period, size in PERIODS.items():
+        if row := sql.execute('host_bucket_before', (ipv4, period, moment - size)).fetchone():
+            candidates.append((row[0] + size, row[1]))
+    return max(candidates)[1] if candidates else None
+
+
+def availability(sql, ipv4: str, start: float, end: float, now: Optional[float] = None) -> dict:
+    """ the host up/down seconds and changes in [start, end):
+    the rolled up buckets (hourly if kept, daily otherwise) up to the rollup watermark and the raw transitions after it
+    the buckets part has the bucket resolution
+    :return: {up, down, transitions, uptime (None if unknown)}
+    """
+    now = now or time.time()
+    period = 'h' if start >= now - retention('h') else 'd'
+    size = PERIODS[period]
+    up = down = changes = 0
+    raw_start = start
+    watermark = get_watermark(sql, period)
+    if start < now - retention('raw') and watermark and watermark > start:
+        bucket_start = start // size * size
+        raw_start = min(watermark, end)
+        rows = {bucket: (bucket_up, bucket_down, count, status) for bucket, bucket_up, bucket_down, count, status
+                in sql.execute('host_availability_of', (ipv4, period, bucket_start, raw_start)).fetchall()}
+        state = state_at(sql, ipv4, bucket_start)
+        for bucket in range(int(bucket_start), int(raw_start), size):
+            if bucket in rows:
+                bucket_up, bucket_down, count, state = rows[bucket]
+                up, down, changes = up + bucket_up, down + bucket_down, changes + count
+            elif state == 'up':
+                up += size
+            elif state == 'down':
+                down += size
+    if raw_start < end:
+        state = state_at(sql, ipv4, raw_start)
+        transitions = sql.execute('host_transitions_of', (ipv4, raw_start, end)).fetchall()
+        for bucket_up, bucket_down, count, _ in split_to_buckets(
+                state, transitions, raw_start, end, int(end - raw_start) + 1).values():
+            up, down, changes = up + bucket_up, down + bucket_down, changes + count
+    return dict(up=up, down=down, transitions=changes, uptime=up / (up + down) * 100 if up + down else None)
+
+
+def host_history(sql, ipv4: str, now: Optional[float] = None) -> dict:
+    """ the host availability summary of the /api/history and the details view """
+    now = now or time.time()
+    windows = {'24h': 86400, '7d': 7 * 86400, '30d': 30 * 86400, '365d': 365 * 86400}
+    return dict(
+        ip=ipv4,
+        status=state_at(sql, ipv4, now),
+        availability={name: availability(sql, ipv4, now - seconds, now, now) for name, seconds in windows.items()},
+        transitions=sql.execute('host_transitions_of', (ipv4, now - retention('raw'), now)).fetchall(),
+    )
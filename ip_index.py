@@ -0,0 +1,54 @@
+"""
+sorted in-memory index of the hosts addresses: the subnet members and the per subnet counts by bisect,
+the index is rebuilt from the ip_num column when the rows revision changes (see change_feed)
+"""
+import bisect
+import logging
+import ipaddress
+import threading
+from itertools import groupby
+
+import change_feed
+
+log = logging.getLogger('ip_index')
+
+
+class IpIndex:
+
+    def __init__(self):
+        self.revision: int | None = None
+        # (sorted numeric addresses, their ipv4), replaced as a whole - the readers take no lock
+        self._data: tuple[list[int], list[str]] = ([], [])
+        self._lock = threading.Lock()
+
+    def refresh(self, sql) -> None:
+        """ rebuild the index if the hosts changed since the last refresh """
+        revision = change_feed.current_revision(sql)
+        with self._lock:
+            if revision == self.revision:
+                return
+            rows = sql.execute('hosts_ip_index').fetchall()
+            self._data = ([num for num, _ in rows], [ip for _, ip in rows])
+            self.revision = revision
+        log.debug(f'IP index of {len(rows)} hosts rebuilt at revision {revision}')
+
+    @staticmethod
+    def span(nums: list[int], network: ipaddress.IPv4Network) -> tuple[int, int]:
+        """ :return: the [start, end) positions of the network addresses in nums """
+        return (bisect.bisect_left(nums, int(network.network_address)),
+                bisect.bisect_right(nums, int(network.broadcast_address)))
+
+    def hosts_in(self, network: ipaddress.IPv4Network) -> list[str]:
+        nums, ips = self._data
+        start, end = self.span(nums, network)
+        return ips[start:end]
+
+    def subnet_counts(self, network: ipaddress.IPv4Network, prefixlen: int = 24) -> dict[str, int]:
+        """ the number of the hosts of every not empty subnet of the network """
+        nums, _ = self._data
+        start, end = self.span(nums, network)
+        shift = 32 - prefixlen
+        return {
+            str(ipaddress.IPv4Network((subnet << shift, prefixlen))): len([*members])
+            for subnet, members in groupby(nums[start:end], key=lambda num: num >> shift)
+        }
@@ -0,0 +1,132 @@
+"""
+counters and histograms of the scanner, refresher, plugins and web processes
+every process collects its metrics in memory and adds them to the metrics table at safe points (flush),
+the web app renders the table in the Prometheus text format (/metrics)
+"""
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+from configuration import Config
+
+log = logging.getLogger('metrics')
+
+DEFAULT_BUCKETS: tuple[float, ...] = (0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 15, 60, 300)
+
+# {name: (type, help, histogram buckets)}
+METRICS: dict[str, tuple[str, str, tuple[float, ...]]] = {
+    'nmap_duration_seconds': ('histogram', 'nmap job wall time', (1, 5, 15, 60, 120, 240, 600, 1800)),
+    'nmap_runs_total': ('counter', 'nmap jobs by exit code', ()),
+    'nmap_xml_parse_seconds': ('histogram', 'nmap XML result parse time', DEFAULT_BUCKETS),
+    'hosts_upserted_total': ('counter', 'hosts records written by the scans', ()),
+    'refresher_pass_seconds': ('histogram', 'liveness pass duration', (60, 300, 900, 1800, 3600, 7200)),
+    'refresher_hosts_total': ('counter', 'hosts found alive, dead and deleted by the liveness passes', ()),
+    'audc_probe_seconds': ('histogram', 'AUDC plugins request latency', (0.05, 0.1, 0.5, 1, 2, 5, 10, 20)),
+    'audc_probes_total': ('counter', 'AUDC plugins requests by outcome', ()),
+    'sqlite_statement_seconds': ('histogram', 'named statements time including the lock waits', DEFAULT_BUCKETS),
+    'sqlite_locked_total': ('counter', 'statements failed with "database is locked"', ()),
+    'http_request_seconds': ('histogram', 'web routes latency', DEFAULT_BUCKETS),
+    'web_cache_total': ('counter', 'web pages served from the render cache (hit) and rendered (miss)', ()),
+    'change_feed_rows_total': ('counter', 'changed and deleted rows sent by the change feed streams', ()),
+}
+
+_lock = threading.Lock()
+# {(series name, labels): value added since the last flush}
+_pending: dict[tuple[str, str], float] = {}
+_last_flush = time.monotonic()
+
+
+def format_labels(labels: dict) -> str:
+    return ','.join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    key = (name, format_labels(labels))
+    with _lock:
+        _pending[key] = _pending.get(key, 0) + value
+
+
+def observe(name: str, value: float, **labels) -> None:
+    """ add the value to the cumulative buckets, the sum and the count of the histogram
+    (all the buckets of the series are written, so every bucket exists in the output)
+    """
+    buckets = METRICS[name][2]
+    labels_str = format_labels(labels)
+    prefix = f'{labels_str},' if labels_str else ''
+    first = bisect.bisect_left(buckets, value)
+    with _lock:
+        for index, le in enumerate(buckets):
+            key = (f'{name}_bucket', f'{prefix}le="{le}"')
+            _pending[key] = _pending.get(key, 0) + (index >= first)
+        for key, add in (((f'{name}_bucket', f'{prefix}le="+Inf"'), 1),
+                         ((f'{name}_sum', labels_str), value), ((f'{name}_count', labels_str), 1)):
+            _pending[key] = _pending.get(key, 0) + add
+
+
+@contextmanager
+def timer(name: str, **labels) -> Iterator[None]:
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start_time, **labels)
+
+
+def flush(sql=None) -> int:
+    """ add the pending metrics to the metrics table, should run outside of the caller transactions
+    :return: number of the written series
+    """
+    global _last_flush
+    from sql_connection import get_sql_connection, STATEMENTS
+    sql = sql or get_sql_connection()
+    if sql.conn.in_transaction:
+        return 0
+    with _lock:
+        rows = [(name, labels, value) for (name, labels), value in _pending.items()]
+        _pending.clear()
+        _last_flush = time.monotonic()
+    if not rows:
+        return 0
+    try:
+        with sql.conn:
+            # not the instrumented sql.executemany - the flush should not produce new metrics
+            sql.conn.executemany(STATEMENTS['metrics_add'], rows)
+    except Exception as err:
+        log.error(f'Failed to write {len(rows)} metrics: {err}')
+        return 0
+    return len(rows)
+
+
+def flush_due(sql=None) -> int:
+    """ flush if Config.metrics_flush_interval passed since the last flush """
+    if time.monotonic() - _last_flush < Config.metrics_flush_interval:
+        return 0
+    return flush(sql)
+
+
+def le_order(labels: str) -> tuple[str, float]:
+    """ the histogram buckets are rendered in the le order """
+    if 'le="' not in labels:
+        return labels, 0.0
+    rest, _, le = labels.rpartition('le="')
+    return rest, float(le.rstrip('"'))
+
+
+def render(sql) -> str:
+    """ the metrics table in the Prometheus text format """
+    series: dict[str, list[tuple[str, float]]] = {}
+    for name, labels, value in sql.execute('metrics_all').fetchall():
+        series.setdefault(name, []).append((labels, value))
+    lines = []
+    for metric, (metric_type, help_text, _) in METRICS.items():
+        names = [metric] if metric_type == 'counter' else [f'{metric}_bucket', f'{metric}_sum', f'{metric}_count']
+        if not any(name in series for name in names):
+            continue
+        lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} {metric_type}']
+        for name in names:
+            for labels, value in sorted(series.get(name, []), key=lambda item: le_order(item[0])):
+                lines.append(f'{name}{{{labels}}} {float(value)!r}' if labels else f'{name} {float(value)!r}')
+    return '\n'.join(lines) + '\n'
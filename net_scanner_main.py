@@ -8,13 +8,16 @@ import subprocess
 import time
 import ipaddress
 from datetime import datetime
-from multiprocessing import Process, Queue
+from multiprocessing import Process, Queue, Pool
 from typing import Optional
 
 from configuration import Config
 from sql_connection import SqlConnection
 from refresher import search_for_dead
-from scanner import scan_networks
+from scanner import init_scan_worker, scan_c_network_worker, process_scan_result, two_phase_scan
+from scan_scheduler import order_subnets, record_scan, network_hosts
+import os_cache
+import metrics
 from plugins.audc_scanner import run_audc_scanner, run_audc_scanner_old_hw
 
 logging.basicConfig(level=(logging.DEBUG if Config.DEBUG else logging.INFO))
@@ -60,7 +63,7 @@ def log_listener_process(queue):
 
 def test_for_new_networks(sql_handler: SqlConnection) -> list[tuple]:
     return [el[0] for el in
-            sql_handler.cursor.execute('SELECT network FROM b_networks WHERE updated is NULL').fetchall()]
+            sql_handler.execute('b_networks_new').fetchall()]
 
 
 def get_networks_for_scan(sql_handler: SqlConnection) -> list[str]:
@@ -68,12 +71,12 @@ def get_networks_for_scan(sql_handler: SqlConnection) -> list[str]:
     # Prioritize the networks that were not updated yet
     if res := test_for_new_networks(sql_handler):
         return res
-    return [el[0] for el in sql_handler.cursor.execute('SELECT network FROM b_networks WHERE status != "invalid"').fetchall()]
+    return [el[0] for el in sql_handler.execute('b_networks_valid').fetchall()]
 
 
 def check_my_pid_is_registered(sql_handler: SqlConnection,) -> bool:
     name = Config.scanner_app_name
-    running_app = sql_handler.get_all_rows_in_table('applications', select='pid', sql_filter=f'application="{name}"')
+    running_app = sql_handler.execute('application_pid', (name,)).fetchall()
     if not running_app:
         log.info(f'The {name} process is not found in DB')
         return False
@@ -85,7 +88,7 @@ def check_my_pid_is_registered(sql_handler: SqlConnection,) -> bool:
     return False
 
 def check_process_is_running(sql_handler: SqlConnection, name: str, ) -> bool:
-    running_app = sql_handler.get_all_rows_in_table('applications', select='pid', sql_filter=f'application="{name}"')
+    running_app = sql_handler.execute('application_pid', (name,)).fetchall()
     if not running_app:
         log.info(f'The {name} process is not found in DB')
         return False
@@ -124,7 +127,7 @@ if __name__ == '__main__':
         sql.update_table(
             'applications', ('pid',),
             (web_process.pid,),
-            f'application="{Config.web_app_name}"',
+            {'application': Config.web_app_name},
             update_date=True
         )
         time.sleep(3)
@@ -150,7 +153,7 @@ if __name__ == '__main__':
     sql.update_table(
         'applications', ('pid',),
         (os.getpid(),),
-        f'application="{Config.scanner_app_name}"',
+        {'application': Config.scanner_app_name},
         update_date=True
     )
     log.info('Start the refresher (search_for_dead process)')
@@ -166,15 +169,18 @@ if __name__ == '__main__':
         p_audc_scanner: Process = Process(target=run_audc_scanner_old_hw, args=(False, log_queue,))
         p_audc_scanner.daemon = True
         p_audc_scanner.start()
-    sql.update_table('b_networks', ('status',), ('idle',), 'status!="invalid"', update_date=False, )
+    sql.execute('b_networks_status_reset', ('idle',))
+    sql.conn.commit()
+    log.info(f'Start the scan pool of {Config.scan_workers} workers')
+    scan_pool = Pool(Config.scan_workers, initializer=init_scan_worker, initargs=(log_queue,))
     while True:
         try:
             if not Config.ALLOW_SCAN:
                 # Only the refreshing is allowed
                 time.sleep(1)
                 continue
-            b_net_hosts_num = {}
             found_all = 0
+            scanned_c_networks = 0
             networks_for_scan: list[str] = get_networks_for_scan(sql)
             if len(networks_for_scan) == 0:
                 log.critical('There are no networks to scan!')
@@ -191,20 +197,32 @@ if __name__ == '__main__':
                         'b_networks',
                         ('status', ),
                         ('invalid',),
-                        f"network='{subnet_ab_str}'",
+                        {'network': subnet_ab_str},
                         update_date=True,
                     )
                     continue
-                b_net_hosts_num[subnet_ab_str] = 0
                 prefix_len: int = 24 if subnet_ab.prefixlen < 24 else subnet_ab.prefixlen
                 sql.update_table(
                     'b_networks',
                     ('status', ),
                     ('scanning',),
-                    f"network='{subnet_ab_str}'",
+                    {'network': subnet_ab_str},
                     update_date=False,
                 )
-                for subnet_c in subnet_ab.subnets(new_prefix=prefix_len):
+                all_subnets_c: list[str] = [str(subnet_c) for subnet_c in subnet_ab.subnets(new_prefix=prefix_len)]
+                # the excluded C networks are not passed to nmap at all
+                in_scope_c: list[str] = [net for net in all_subnets_c if not Config.scan_scope.excluded(net)]
+                subnets_c: list[str] = order_subnets(sql, in_scope_c)
+                log.info(f'{len(subnets_c)} of {len(all_subnets_c)} C networks of "{subnet_ab_str}" are due for scan, '
+                         f'{len(all_subnets_c) - len(in_scope_c)} are out of the scan scope')
+                scanned_c_networks += len(subnets_c)
+                if Config.scan_mode == 'two_phase':
+                    # one discovery job per pool worker in every chunk
+                    chunk_size = Config.discovery_chunk_networks * Config.scan_workers
+                else:
+                    # every worker of the pool scans its own C network
+                    chunk_size = Config.scan_workers
+                for index in range(0, len(subnets_c), chunk_size):
                     if (new_networks := test_for_new_networks(sql)) and subnet_ab_str not in new_networks:
                         # To allow faster scanning of new networks
                         log.debug(f'Found new networks- stop scanning the {subnet_ab_str} and start scanning the new')
@@ -212,34 +230,44 @@ if __name__ == '__main__':
                             'b_networks',
                             ('status', ),
                             ('idle', ),
-                            f"network='{subnet_ab_str}'",
+                            {'network': subnet_ab_str},
                             update_date=False,
                         )
                         break
-                    subnet_abc_str = str(subnet_c)
-                    try:
-                        found_hosts = scan_networks(sql, full_net_pattern=subnet_abc_str)
-                        if found_hosts >= 0:
-                            b_net_hosts_num[subnet_ab_str] += found_hosts
-                        # sleep some time
-                        log.info(f'sleep {Config.sleep_between_c_networks_scan} seconds after c network scan')
-                        time.sleep(Config.sleep_between_c_networks_scan)
-                    except Exception as err:
-                        log.exception(f'ERROR! exception while running scan_networks {subnet_abc_str}!', exc_info=err)
-
-                # If nothing was found after full scanning subnet type B - it is marked and will never be scanned again
+                    subnets_batch = subnets_c[index:index + chunk_size]
+                    if Config.scan_mode == 'two_phase':
+                        two_phase_scan(sql, scan_pool, subnets_batch)
+                    else:
+                        # the results are written in the subnets order
+                        for scan_result in scan_pool.map(scan_c_network_worker, subnets_batch):
+                            try:
+                                found_hosts = process_scan_result(sql, *scan_result)
+                                if found_hosts >= 0:
+                                    record_scan(sql, scan_result[0], found_hosts)
+                            except Exception as err:
+                                log.exception(f'ERROR! exception while processing {scan_result[0]} scan!', exc_info=err)
+                    # sleep some time
+                    log.info(f'sleep {Config.sleep_between_c_networks_scan} seconds after c networks scan')
+                    time.sleep(Config.sleep_between_c_networks_scan)
+
+                # the not due C networks keep the hosts of their last scan
                 current_date = datetime.now().strftime("%Y-%b-%d %H:%M:%S")
-                b_hosts = b_net_hosts_num[subnet_ab_str]
+                b_hosts = network_hosts(sql, all_subnets_c)
                 log.info(f'Found {b_hosts} hosts in "{subnet_ab_str}" B network')
                 sql.update_table(
                     'b_networks',
                     ('network', 'hosts', 'updated', 'status'),
                     (subnet_ab_str, b_hosts, current_date, 'idle'),
-                    f"network='{subnet_ab_str}'"
+                    {'network': subnet_ab_str}
                 )
                 found_all += b_hosts
+                log.info(f'OS cache statistics: {os_cache.get_stats(sql)}')
+                metrics.flush(sql)
         except Exception as ex:
             log.exception("ERROR! Exception in while loop", exc_info=True)
             sys.exit(1)
         log.info(f'Found all {found_all} hosts during current scan')
+        if not scanned_c_networks:
+            log.info(f'No C network is due for scan, sleep {Config.sleep_between_c_networks_scan} seconds')
+            time.sleep(Config.sleep_between_c_networks_scan)
     sys.exit(0)
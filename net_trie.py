@@ -0,0 +1,103 @@
+"""
+IPv4 CIDR sets as binary prefix tries: a lookup walks at most the prefix length bits whatever the set size,
+the overlapping networks and the adjacent halves are collapsed on insert, so the set keeps the minimal CIDR list
+"""
+import ipaddress
+from typing import Iterable, Iterator, Optional
+
+# a node: [0 child, 1 child, the whole prefix is in the set]
+Node = list
+
+
+def to_network(network: str | ipaddress.IPv4Network) -> ipaddress.IPv4Network:
+    return network if isinstance(network, ipaddress.IPv4Network) else ipaddress.IPv4Network(network, strict=False)
+
+
+class PrefixTrie:
+    """ a set of IPv4 networks """
+
+    def __init__(self, networks: Iterable[str | ipaddress.IPv4Network] = ()):
+        self.root: Node = [None, None, False]
+        for network in networks:
+            self.add(network)
+
+    def add(self, network: str | ipaddress.IPv4Network) -> None:
+        network = to_network(network)
+        address, length = int(network.network_address), network.prefixlen
+        path = [self.root]
+        node = self.root
+        for depth in range(length):
+            if node[2]:
+                # already covered by a shorter prefix
+                return
+            bit = address >> (31 - depth) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, False]
+            node = node[bit]
+            path.append(node)
+        # the longer prefixes are covered by this one
+        node[:] = [None, None, True]
+        # two covered halves are the covered parent
+        for parent in reversed(path[:-1]):
+            if not (parent[0] and parent[0][2] and parent[1] and parent[1][2]):
+                break
+            parent[:] = [None, None, True]
+
+    def covers(self, network: str | ipaddress.IPv4Network) -> bool:
+        """ the whole network is in the set """
+        network = to_network(network)
+        address = int(network.network_address)
+        node = self.root
+        for depth in range(network.prefixlen):
+            if node[2]:
+                return True
+            node = node[address >> (31 - depth) & 1]
+            if node is None:
+                return False
+        return node[2]
+
+    def overlaps(self, network: str | ipaddress.IPv4Network) -> bool:
+        """ a part of the network is in the set """
+        network = to_network(network)
+        address = int(network.network_address)
+        node = self.root
+        for depth in range(network.prefixlen):
+            if node[2]:
+                return True
+            node = node[address >> (31 - depth) & 1]
+            if node is None:
+                return False
+        # the nodes are created by the added networks only, but the root exists in the empty set too
+        return bool(node[0] or node[1] or node[2])
+
+    def __contains__(self, ip: str | ipaddress.IPv4Address) -> bool:
+        return self.covers(ipaddress.IPv4Network(ip))
+
+    def __bool__(self) -> bool:
+        return bool(self.root[0] or self.root[1] or self.root[2])
+
+    def networks(self) -> Iterator[ipaddress.IPv4Network]:
+        """ the collapsed networks of the set in the address order """
+        stack = [(self.root, 0, 0)]
+        while stack:
+            node, address, depth = stack.pop()
+            if node[2]:
+                yield ipaddress.IPv4Network((address << (32 - depth), depth))
+                continue
+            for bit in (1, 0):
+                if node[bit] is not None:
+                    stack.append((node[bit], address << 1 | bit, depth + 1))
+
+
+class NetworkScope:
+    """ the scanned networks: the allowed ones (all if not set) without the denied ones
+    a network partly out of the allowed set is excluded, the partly denied one is scanned with the nmap exclude file
+    """
+
+    def __init__(self, allow: Optional[Iterable[str]] = None, deny: Iterable[str] = ()):
+        self.allow = PrefixTrie(allow) if allow else None
+        self.deny = PrefixTrie(deny)
+
+    def excluded(self, network: str | ipaddress.IPv4Network) -> bool:
+        network = to_network(network)
+        return self.deny.covers(network) or (self.allow is not None and not self.allow.covers(network))
@@ -0,0 +1,56 @@
+"""
+OS fingerprint cache: the nmap -O result of a host is reused while its ipv4, mac and open ports set do not change
+and the entry is not older than Config.os_cache_ttl, so only the cache misses get the slow OS detection scan
+"""
+import time
+import logging
+from typing import Optional
+
+from configuration import Config, iter_nmap_hosts
+
+log = logging.getLogger('os_cache')
+
+
+def fingerprint_keys(xml_res_file) -> dict[str, tuple[str, str]]:
+    """ the cache keys of the hosts of the nmap XML result: {ipv4: (mac, open ports)} """
+    return {
+        host['ipv4']: (host['mac'], ','.join(sorted(portid for _, portid, state in host['ports'] if state == 'open')))
+        for host in iter_nmap_hosts(xml_res_file)
+    }
+
+
+def lookup(sql, keys: dict[str, tuple[str, str]], now: Optional[float] = None) -> tuple[dict[str, str], list[str]]:
+    """ split the hosts to the cache hits and misses
+    :return: ({ipv4: cached os}, [missed ipv4])
+    """
+    now = now or time.time()
+    hits, misses = {}, []
+    for ipv4, key in keys.items():
+        entry = sql.execute('os_cache_get', (ipv4,)).fetchone()
+        if entry and (entry[0], entry[1]) == key and now - entry[3] < Config.os_cache_ttl:
+            hits[ipv4] = entry[2]
+        else:
+            misses.append(ipv4)
+    return hits, misses
+
+
+def save(sql, update: dict) -> None:
+    """ write the new cache entries and the statistics of a scan
+    :param update: {entries: [(ipv4, mac, ports, os, checked)], hits, misses, os_scan_hosts, os_scan_seconds}
+    """
+    with sql.conn:
+        sql.executemany('os_cache_upsert', update['entries'])
+        sql.executemany('os_cache_stats_add', [
+            (name, update[name]) for name in ('hits', 'misses', 'os_scan_hosts', 'os_scan_seconds')
+        ])
+
+
+def get_stats(sql) -> dict[str, float]:
+    """ the cache counters, the hit rate and the estimated OS detection time saved by the hits """
+    stats = dict.fromkeys(('hits', 'misses', 'os_scan_hosts', 'os_scan_seconds'), 0.0)
+    stats.update(sql.execute('os_cache_stats').fetchall())
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+    per_host = stats['os_scan_seconds'] / stats['os_scan_hosts'] if stats['os_scan_hosts'] else 0.0
+    stats['saved_seconds'] = stats['hits'] * per_host
+    return stats
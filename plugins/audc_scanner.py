@@ -1,5 +1,4 @@
-from typing import Optional
-import re
+from typing import Optional, AsyncIterator
 from pathlib import Path
 import logging
 from logging.handlers import QueueHandler
@@ -7,14 +6,17 @@ import aiohttp
 import asyncio
 import requests
 import time
-import ipaddress
+import threading
+from html.parser import HTMLParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
-from bs4 import BeautifulSoup
 from requests.auth import HTTPDigestAuth, HTTPBasicAuth
 
-from sql_connection import SqlConnection, remove_bad_symbols
+from sql_connection import SqlConnection, HostsUpdateWriter
 from configuration import Config
+from plugins import probe_state
+import metrics
 
 # log = logging.getLogger('audc_sc')
 # Log messages in separate log file
@@ -22,6 +24,7 @@ from configuration import Config
 # Config.config_logger(file=log_file, filter_logger=log)
 
 INTER_SCAN_DELAY = 1200
+OLD_HW_INTER_SCAN_DELAY = 600
 
 rest_2_sql_map = dict(
     productType='productType',
@@ -59,73 +62,234 @@ rest_2_sql_map.update({
 'Pre Recorded Tones File Name ', 'plz_wait.dat',
 'Loaded Coder Table ', 'Default CODERTABLE']
 """
-max_simult_scan: int = 512
 db_audc_filter: str = (f"SELECT ipv4,username,password FROM hosts WHERE "
                        f"(status='up' AND http='ok' and {Config.filter_os_for_AUDC_scan}"
                        f" and type='' or type='AUDC')")
 
 
-async def audc_scanner(host):
-    ip, username, password, *_ = host
-    if username == '': username = 'Admin'
-    if password == '': password = 'Admin'
-    try:
-        async with aiohttp.ClientSession(auth=aiohttp.BasicAuth(username, password)) as session:
-            async with session.get(f'http://{ip}/api/v1/status') as r:
-                await r.read()
+def probe_metrics(plugin: str, result_dic: dict, latency: float) -> None:
+    metrics.observe('audc_probe_seconds', latency, plugin=plugin)
+    outcome = 'exception' if result_dic['result'] == 'EXCEPTION!' else result_dic['status']
+    metrics.inc('audc_probes_total', plugin=plugin, outcome=outcome)
+
+
+class AudcHttpEngine:
+    """ the REST status requests of many hosts over the shared connections pool:
+    one ClientSession per credential pair on top of one connector, at most `concurrency` requests in flight
+    """
+
+    def __init__(
+            self,
+            concurrency: Optional[int] = None,
+            timeout: Optional[aiohttp.ClientTimeout] = None,
+            status_url: str = 'http://{ip}/api/v1/status',
+    ):
+        self.concurrency = concurrency or Config.audc_concurrency
+        self.status_url = status_url
+        self.timeout = timeout or aiohttp.ClientTimeout(
+            total=Config.audc_total_timeout,
+            sock_connect=Config.audc_connect_timeout,
+            sock_read=Config.audc_read_timeout,
+        )
+        self.connector: Optional[aiohttp.TCPConnector] = None
+        self.sessions: dict[tuple[str, str], aiohttp.ClientSession] = {}
+
+    async def __aenter__(self) -> 'AudcHttpEngine':
+        # every host is requested once per pass, so the keep-alive connections would only pile up
+        self.connector = aiohttp.TCPConnector(limit=self.concurrency, force_close=True, enable_cleanup_closed=True)
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        for session in self.sessions.values():
+            await session.close()
+        self.sessions.clear()
+        await self.connector.close()
+
+    def session(self, username: str, password: str) -> aiohttp.ClientSession:
+        if (username, password) not in self.sessions:
+            self.sessions[(username, password)] = aiohttp.ClientSession(
+                connector=self.connector,
+                connector_owner=False,
+                auth=aiohttp.BasicAuth(username, password),
+                timeout=self.timeout,
+            )
+        return self.sessions[(username, password)]
+
+    async def get_status(self, host) -> dict:
+        """ the /api/v1/status REST request of the host
+        :param host: (ip, username, password) - the empty credentials are replaced with the defaults
+        :return: the process_rest_result format result
+        """
+        ip, username, password, *_ = host
+        start_time = time.perf_counter()
+        try:
+            session = self.session(username or 'Admin', password or 'Admin')
+            async with session.get(self.status_url.format(ip=ip)) as r:
                 result_dic = dict(ip=ip, headers=r.headers, status=r.status)
                 if r.status == 200:
                     result_dic['result'] = 'OK!'
-                    result_dic['value'] = await r.json()
+                    result_dic['value'] = await r.json(content_type=None)
                 else:
                     result_dic['result'] = 'FAILED!'
-                    result_dic['value'] = r.text
-    except Exception as err:
-        result_dic = dict(result='EXCEPTION!', status=0, ip=ip, headers={}, value=err)
-    return result_dic
+                    result_dic['value'] = await r.text()
+        except Exception as err:
+            result_dic = dict(result='EXCEPTION!', status=0, ip=ip, headers={}, value=err)
+        probe_metrics('audc', result_dic, time.perf_counter() - start_time)
+        return result_dic
 
+    async def scan(self, hosts) -> AsyncIterator[dict]:
+        """ request the hosts in a sliding window: a new request starts as soon as one completes,
+        so the slow hosts do not hold up the rest
+        :return: the results in completion order
+        """
+        pending: set[asyncio.Task] = set()
+        for host in hosts:
+            if len(pending) >= self.concurrency:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+            pending.add(asyncio.create_task(self.get_status(host)))
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
 
-async def set_concurrent_clients(hosts):
-    return await asyncio.gather(*(audc_scanner(host) for host in hosts))
 
+def probe_result_name(res: dict, is_audc: bool) -> str:
+    """ the probe_state result of the REST request """
+    return 'AUDC' if is_audc else f"{res['result']} {res.get('status', 0)}"
 
-def run_audc_scanner(one_loop: bool = False, log_queue: QueueHandler = None):
-    log = Config.initiate_process_queue_logger('audc_sc', log_queue)
+
+async def audc_scan_pass(sql, engine: AudcHttpEngine, log: logging.Logger) -> int:
+    """ one REST scan pass of all the potential AUDC hosts, the results are processed as they come
+    :return: number of the found AUDC hosts
+    """
+    # Get all alive hosts with http, except the hosts that wait for their next probe
+    audc_hosts = probe_state.select_eligible(sql, 'audc', db_audc_filter)
+    hosts_to_scan = len(audc_hosts)
+    found_audc_hosts = 0
+    start_scan_timestamp = time.time()
+    log.debug(f'Found {hosts_to_scan} potential AUDC hosts')
+    writer = HostsUpdateWriter(sql)
+    probe_results = []
+    async for res in engine.scan(audc_hosts):
+        is_audc = process_rest_result(sql, res, log, writer)
+        found_audc_hosts += is_audc
+        probe_results.append((res['ip'], probe_result_name(res, is_audc), is_audc))
+    writer.flush()
+    probe_state.record_results(sql, 'audc', probe_results)
+    log.info(f'AUDC probe state: {probe_state.get_stats(sql, "audc")}')
+    metrics.flush(sql)
+    # recount the AUDC hosts of all the C networks in one statement
+    with sql.conn:
+        sql.execute('alive_networks_audc_recount')
+
+    elapsed = time.time() - start_scan_timestamp
+    log.info(f'The rest scan of {hosts_to_scan} hosts took {elapsed:.1f} sec, found {found_audc_hosts} audc')
+    return found_audc_hosts
+
+
+async def audc_scanner_loop(one_loop: bool, log: logging.Logger) -> None:
     sql = SqlConnection()
-    while True:
-        try:
-            # Get all alive hosts with http
-            audc_hosts = sql.cursor.execute(db_audc_filter).fetchall()
-            # audc_hosts = (('10.8.41.182', 'Admin', 'Admin'), ('10.8.94.152', '', ''),)
-            hosts_to_scan = len(audc_hosts)
-            found_audc_hosts = 0
-            start_scan_timestamp = time.time()
-            log.debug(f'Found {hosts_to_scan} potential AUDC hosts')
-            audc_c_networks = {}
-            for index in range(0, hosts_to_scan, max_simult_scan):
-                temp_hosts_list = audc_hosts[index:index + max_simult_scan]
-                log.info(f"Start http scan of {index} - {index+max_simult_scan} range")
-                start_time_stamp = time.time()
-                results = asyncio.run(set_concurrent_clients(temp_hosts_list))
-                log.debug(f'The scan took {time.time() - start_time_stamp} seconds')
-                for res in results:
-                    if process_rest_result(sql, res, log):
-                        found_audc_hosts += 1
-                        ip_c_net = ipaddress.ip_network(res['ip'] + '/24', False).network_address.__str__()
-                        audc_c_networks[ip_c_net] = audc_c_networks.get(ip_c_net, 0) + 1
-
-            for audc_c_net, count in audc_c_networks.items():
-                update_str = f"UPDATE alive_networks SET audc={count} WHERE network='{audc_c_net}/24'"
-                if not sql.cursor.execute(update_str).rowcount:
-                    log.error(f'{update_str} \n Failed to update alive_networks SQL table')
-                sql.conn.commit()
-
-            log.debug(f'The rest scan took {time.time() - start_scan_timestamp} sec, found {found_audc_hosts} audc')
-        except Exception as ex:
-            log.exception("ERROR! Exception in while loop", exc_info=True)
-        finally:
+    async with AudcHttpEngine() as engine:
+        while True:
+            try:
+                await audc_scan_pass(sql, engine, log)
+            except Exception as ex:
+                log.exception("ERROR! Exception in while loop", exc_info=True)
             if one_loop: break
-            time.sleep(INTER_SCAN_DELAY)
+            await asyncio.sleep(INTER_SCAN_DELAY)
+
+
+def run_audc_scanner(one_loop: bool = False, log_queue: QueueHandler = None):
+    log = Config.initiate_process_queue_logger('audc_sc', log_queue)
+    # one event loop and connections pool for the process lifetime
+    asyncio.run(audc_scanner_loop(one_loop, log))
+
+
+class SoftwareVersionParser(HTMLParser):
+    """ the text cells of the old HW /SoftwareVersion page """
+
+    def __init__(self):
+        super().__init__()
+        self.cells: list[str] = []
+
+    def handle_data(self, data: str) -> None:
+        cell = ' '.join(data.replace('\xa0', ' ').split()).rstrip(':').strip()
+        if cell:
+            self.cells.append(cell)
+
+
+def parse_software_version_page(html: str) -> dict[str, str]:
+    """ the rest_2_sql_map fields of the old HW /SoftwareVersion page, the value is the cell after the name cell
+    :return: {field name: value}
+    """
+    parser = SoftwareVersionParser()
+    parser.feed(html)
+    parser.close()
+    fields = {}
+    for index, cell in enumerate(parser.cells):
+        name, _, value = cell.partition(':')
+        name = name.strip()
+        if name not in rest_2_sql_map or name in fields:
+            continue
+        if value.strip():
+            fields[name] = value.strip()
+        elif index + 1 < len(parser.cells):
+            fields[name] = parser.cells[index + 1]
+    return fields
+
+
+class HostRateLimiter:
+    """ keeps at least `interval` seconds between the requests to the same host """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.next_time: dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def wait(self, host: str) -> None:
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time.get(host, 0))
+            self.next_time[host] = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+_thread_local = threading.local()
+
+
+def get_old_hw_version(host, rate_limiter: HostRateLimiter) -> dict:
+    """ the /SoftwareVersion page request of the old HW host (digest auth)
+    :param host: (ip, username, password) - the empty credentials are replaced with the defaults
+    :return: the process_rest_result format result
+    """
+    ip, username, password, *_ = host
+    if not hasattr(_thread_local, 'session'):
+        _thread_local.session = requests.Session()
+    result_dic = dict(ip=ip, result='FAILED!', value={}, headers={}, status=0)
+    rate_limiter.wait(ip)
+    start_time = time.perf_counter()
+    try:
+        res = _thread_local.session.get(
+            f'http://{ip}/SoftwareVersion',
+            auth=HTTPDigestAuth(username or 'Admin', password or 'Admin'),
+            timeout=(Config.audc_connect_timeout, Config.audc_read_timeout),
+        )
+    except requests.RequestException as err:
+        result_dic.update(result='EXCEPTION!', value=err)
+        probe_metrics('audc_old_hw', result_dic, time.perf_counter() - start_time)
+        return result_dic
+    result_dic['status'] = res.status_code
+    result_dic['headers'] = res.headers
+    probe_metrics('audc_old_hw', result_dic, time.perf_counter() - start_time)
+    if res.status_code in (200, 203):
+        result_dic['result'] = 'OK!'
+        result_dic['value'] = parse_software_version_page(res.text)
+    else:
+        result_dic['value'] = res.text
+    return result_dic
 
 
 def run_audc_scanner_old_hw(
@@ -137,96 +301,92 @@ def run_audc_scanner_old_hw(
 ) -> None:
     log = Config.initiate_process_queue_logger('audc_sc_ohw', log_queue)
     sql = SqlConnection()
-    while True:
-        # Get all alive AUDc hosts with http and os='embedded'
-        if ip:
-            audc_hosts = [(ip, user, password)]
-        else:
-            audc_hosts = sql.cursor.execute(
-                (f"SELECT ipv4,username,password FROM hosts WHERE "
-                 f"(status='up' AND http='ok' and os='embedded' and type='AUDC')")
-            ).fetchall()
-        hosts_to_scan = len(audc_hosts)
-        found_audc_hosts = 0
-        start_scan_timestamp = time.time()
-        log.debug(f'Found {hosts_to_scan} potential old HW AUDC hosts')
-
-        for host in audc_hosts:
+    rate_limiter = HostRateLimiter(Config.audc_old_hw_host_interval)
+    with ThreadPoolExecutor(max_workers=Config.audc_old_hw_workers) as executor:
+        while True:
             try:
-                ip, username, password, *_ = host
-                if username == '': username = 'Admin'
-                if password == '': password = 'Admin'
-                result_dic = dict(ip=ip, result='FAILED!', value={}, headers={})
-                res = requests.get(f'http://{ip}/SoftwareVersion', auth=HTTPDigestAuth(username, password))
-                result_dic['status'] = res.status_code
-                result_dic['headers'] = res.headers
-                if res.status_code in (200, 203):
-                    found_audc_hosts += 1
-                    result_dic['result'] = 'OK!'
-                    sp = BeautifulSoup(res.text, 'html.parser')
-                    res_txt = re.sub(r'\n+', '\n', re.sub(r'\xa0+', ' ', sp.text))
-                    res_list = [el.strip() for el in re.sub(r' *: *', '', res_txt).split('\n')]
-                    log.debug(f'{ip=} - {res_list}')
-                    for key in rest_2_sql_map:
-                        if key in res_list:
-                            result_dic['value'][key] = res_list[res_list.index(key) + 1]
-                    process_rest_result(sql, result_dic, log)
+                # Get all alive AUDc hosts with http and os='embedded'
+                if ip:
+                    audc_hosts = [(ip, user, password)]
                 else:
-                    result_dic['value'] = res.text
-            except:
+                    audc_hosts = probe_state.select_eligible(
+                        sql, 'audc_old_hw',
+                        (f"SELECT ipv4,username,password FROM hosts WHERE "
+                         f"(status='up' AND http='ok' and os='embedded' and type='AUDC')")
+                    )
+                hosts_to_scan = len(audc_hosts)
+                found_audc_hosts = 0
+                start_scan_timestamp = time.time()
+                log.debug(f'Found {hosts_to_scan} potential old HW AUDC hosts')
+                writer = HostsUpdateWriter(sql)
+                probe_results = []
+                futures = [executor.submit(get_old_hw_version, host, rate_limiter) for host in audc_hosts]
+                for future in as_completed(futures):
+                    result_dic = future.result()
+                    log.debug(f'{result_dic["ip"]} - {result_dic["result"]} {result_dic["status"]}')
+                    is_audc = result_dic['result'] == 'OK!'
+                    if is_audc:
+                        found_audc_hosts += 1
+                        process_rest_result(sql, result_dic, log, writer)
+                    probe_results.append((result_dic['ip'], probe_result_name(result_dic, is_audc), is_audc))
+                writer.flush()
+                probe_state.record_results(sql, 'audc_old_hw', probe_results)
+                metrics.flush(sql)
+                log.debug(f'The rest scan took {time.time() - start_scan_timestamp} sec,'
+                          f' discovered {found_audc_hosts} old HW audc (out of {hosts_to_scan=})')
+            except Exception:
                 log.exception("ERROR! Exception in old HW loop", exc_info=True)
             if one_loop: break
-            time.sleep(1)
-        if one_loop: break
-        time.sleep(600)
-        log.debug(f'The rest scan took {time.time() - start_scan_timestamp} sec,'
-                  f' discovered {found_audc_hosts} old HW audc (out of {hosts_to_scan=})')
+            time.sleep(OLD_HW_INTER_SCAN_DELAY)
 
 
-def process_rest_result(sql, res, log: Optional[logging.Logger] = None) -> bool:
+def process_rest_result(
+        sql,
+        res,
+        log: Optional[logging.Logger] = None,
+        writer: Optional[HostsUpdateWriter] = None,
+) -> bool:
+    """ update the host with the REST request result, through the writer batches if given
+    :return: True if the host is AUDC device
+    """
     if not log: log = logging.getLogger('process_result')
-    sql_update_list = []
+    sql_update_dict = {}
     server = res["headers"].get("Server", "UNKNOWN")
     status = res.get('status', 0)
     if status == 404:
         if server.find('Allegro-Software-RomPager/3.10') == 0 or server.find('AudioCodes') != -1:
             log.info(f'{res["ip"]} - probably old AUDC device, the server "{server}"')
-            sql_update_list.append("type='AUDC'")
+            sql_update_dict['type'] = 'AUDC'
         elif server.find('lighttpd/1.4.') == 0:
             log.info(f'{res["ip"]} - probably AUDC phone, the server "{server}"')
-            sql_update_list.append("type='AC_PHONE'")
+            sql_update_dict['type'] = 'AC_PHONE'
         else:
             log.info(f'{res["ip"]} - the REST path is not found server "{server}": NOT AUDC device')
-            sql_update_list.append("type='NOT_AC'")
+            sql_update_dict['type'] = 'NOT_AC'
     if status in (401, 404, 200):
-        pass
-        sql_update_list.append(f"web_server='{server}'")
+        sql_update_dict['web_server'] = server
     if res['result'] == 'OK!':
         json_dict = res['value']
         for key in json_dict:
             if rest_2_sql_map.get(key):
                 val = json_dict[key]
-                if key != 'systemUpTime': val = remove_bad_symbols(json_dict[key])
-                sql_update_list.append(f"{rest_2_sql_map.get(key)}='{val}'")
-        if not sql_update_list:
+                sql_update_dict[rest_2_sql_map.get(key)] = val if isinstance(val, (str, int, float)) else str(val)
+        if not sql_update_dict:
             log.info(f'{res["ip"]} return OK on REST request but no device information found')
-        sql_update_list.append("type='AUDC'")
-    if not sql_update_list:
+        sql_update_dict['type'] = 'AUDC'
+    if not sql_update_dict:
         log.info(f'{res["result"]} while gets status of {res["ip"]}, Error: "{res["value"]}" ')
     else:
-        current_date = datetime.now().strftime("%Y-%b-%d %H:%M:%S")
-        sql_update_list.append(f"updated='{current_date}'")
-        update_str = f"UPDATE hosts SET {','.join(sql_update_list)} WHERE ipv4='{res['ip']}'"
-        log.debug(update_str)
-        updated = sql.cursor.execute(update_str).rowcount
-        sql.conn.commit()
-        if not updated:
-            log.error(f'{update_str} \n Failed to update SQL table')
-    if "type='AUDC'" in sql_update_list:
+        sql_update_dict['updated'] = datetime.now().strftime("%Y-%b-%d %H:%M:%S")
+        log.debug(f'{res["ip"]}: {sql_update_dict}')
+        if writer:
+            writer.add(res['ip'], sql_update_dict)
+        elif not sql.update_host_fields(res['ip'], sql_update_dict):
+            log.error(f'{res["ip"]}: {sql_update_dict} \n Failed to update SQL table')
+    if sql_update_dict.get('type') == 'AUDC':
         return True
     return False
 
 
-
 if __name__ == '__main__':
     run_audc_scanner(one_loop=True)
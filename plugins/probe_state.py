@@ -0,0 +1,54 @@
+"""
+per host probe bookkeeping of the plugins: the last result, the consecutive failures and the next eligible time
+the host that failed (or is not the plugin device) waits with exponential backoff,
+a change of its open ports or web server makes it eligible at once
+"""
+import time
+import logging
+from typing import Optional
+
+from configuration import Config
+from sql_connection import PROBE_SIGNATURE
+
+log = logging.getLogger('probe_state')
+
+
+def select_eligible(sql, plugin: str, query: str, now: Optional[float] = None) -> list[tuple]:
+    """ the rows of the plugin hosts query without the hosts that wait for their next probe
+    :param query: the plugin hosts SELECT, its first column is ipv4
+    """
+    now = now or time.time()
+    return sql.cursor.execute(
+        f'SELECT q.* FROM ({query}) q JOIN hosts h ON h.ipv4=q.ipv4 '
+        f'LEFT JOIN probe_state p ON p.plugin=? AND p.ipv4=q.ipv4 '
+        f'WHERE p.ipv4 IS NULL OR p.next_eligible <= ? OR p.signature IS NOT {PROBE_SIGNATURE}',
+        (plugin, now)
+    ).fetchall()
+
+
+def backoff(failures: int) -> float:
+    """ seconds until the next probe of the host """
+    if not failures:
+        return 0
+    return Config.probe_backoff_base * 2 ** min(failures - 1, Config.probe_backoff_max_exp)
+
+
+def record_results(sql, plugin: str, results: list[tuple[str, str, bool]], now: Optional[float] = None) -> None:
+    """ save the probe results of a plugin pass, should run after the hosts updates are written
+    (the current open ports and web server of the host are the signature of the probe)
+    :param results: [(ipv4, result, success)]
+    """
+    now = now or time.time()
+    failures = dict(sql.execute('probe_state_failures', (plugin,)).fetchall())
+    rows = []
+    for ipv4, result, success in results:
+        host_failures = 0 if success else (failures.get(ipv4) or 0) + 1
+        rows.append((plugin, result, host_failures, now, now + backoff(host_failures), ipv4))
+    with sql.conn:
+        sql.executemany('probe_state_upsert', rows)
+
+
+def get_stats(sql, plugin: str, now: Optional[float] = None) -> dict[str, tuple[int, int]]:
+    """ :return: {result: (hosts, hosts waiting for the next probe)} """
+    now = now or time.time()
+    return {result: (hosts, waiting) for result, hosts, waiting in sql.execute('probe_state_stats', (now, plugin))}
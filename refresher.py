@@ -5,11 +5,17 @@ import os
 from logging.handlers import QueueHandler
 from pathlib import Path
 from logging import Logger
+from typing import Optional
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
-from configuration import Config, XmlParser
+from configuration import Config, iter_nmap_hosts
 from scanner import scan_networks
 from sql_connection import SqlConnection
+from tcp_probe import native_liveness
+import metrics
+import history
+import change_feed
 
 log = logging.getLogger('refresher')
 # log_file = os.path.join(Config.log_files_path, f'{__name__}.log')
@@ -17,111 +23,197 @@ log = logging.getLogger('refresher')
 
 
 def update_host_status(xml_res_file: Path | str) -> set[str]:
-    rt = XmlParser(xml_res_file)
     count = 0
     ip_set = set()
-    for host in rt.root.findall('host'):
+    for host in iter_nmap_hosts(xml_res_file):
         count += 1
-        for host_addr in host.findall('address'):
-            if host_addr.attrib['addrtype'] == 'ipv4':
-                ip = host_addr.attrib['addr']
-                break
-        else:
+        if not host['ipv4']:
             log.error(f'No ipv4 address found in the host {host}')
             continue
-        state = host.find('status').attrib['state']
-        if state == 'up':
-            ip_set.add(ip)
+        if host['state'] == 'up':
+            ip_set.add(host['ipv4'])
     log.info(f'Found {count} alive hosts')
     return ip_set
 
 
+def reconcile_hosts_status(
+        sql: SqlConnection,
+        hosts_ip_set: set[str],
+        alive_ip_set: set[str],
+        current_date: str,
+        now: Optional[float] = None,
+) -> list[str]:
+    """ update the status of the probed hosts with few bulk statements and delete the dead hosts
+    that have no owner or other identification, or whose name is taken by another alive host (the IP changed - dhcp)
+    the status changes are appended to the host_transitions history
+    :return: the deleted hosts
+    """
+    with sql.conn:
+        sql.execute('probed_hosts_create')
+        sql.execute('probed_hosts_clear')
+        sql.executemany('probed_hosts_insert', [(ipv4, int(ipv4 in alive_ip_set)) for ipv4 in hosts_ip_set])
+        sql.execute('host_transitions_insert', (now or time.time(),))
+        # down_at keeps the time the host went down - only the hosts that were up are updated
+        sql.execute('hosts_down_at_update', (current_date,))
+        for alive, status in ((1, 'up'), (0, 'down')):
+            sql.execute('hosts_status_update', (current_date, status, alive))
+        deleted = [ipv4 for ipv4, in sql.execute('hosts_dead_to_delete').fetchall()]
+        log.debug(f'Delete dead hosts: {deleted}')
+        sql.executemany('host_delete', [(ipv4,) for ipv4 in deleted])
+    return deleted
+
+
+class AdaptiveBatcher:
+    """ sizes the liveness batches from the measured per-batch latency """
+    def __init__(
+            self,
+            size: int = Config.search_for_dead_burst,
+            max_size: int = Config.search_for_dead_max_burst,
+            target_latency: float = Config.search_for_dead_target_latency,
+    ):
+        self.size = max(1, size)
+        self.max_size = max(self.size, max_size)
+        self.target_latency = target_latency
+
+    def update(self, batch_size: int, latency: float) -> int:
+        """ rescale the batch size towards the target latency (at most x2 or /2 per batch) """
+        if batch_size < self.size or latency <= 0:
+            # a partial batch does not tell much about the full size
+            return self.size
+        factor = min(2.0, max(0.5, self.target_latency / latency))
+        self.size = int(min(self.max_size, max(1, self.size * factor)))
+        return self.size
+
+
+def sweep_hosts(job_id: int, hosts: list[str]) -> tuple[Optional[set[str]], float]:
+    """ run one nmap liveness job, every job has its own targets and results files
+    :return: (alive ips - None if nmap failed, job latency)
+    """
+    xml_res_file = Config.tmp_folder_path / f'nmap_search_for_dead_{job_id}.xml'
+    temp_hosts_nmap = Config.tmp_folder_path / f'temp_hosts_nmap_{job_id}.txt'
+    start_time = time.time()
+    cmd = [*Config.nmap_command, '-sn', '-n', '-PE', '-Pn', '--max-rtt-timeout', '200ms', '--disable-arp-ping',
+           '--host-timeout', '30s', '-oX', os.path.normcase(xml_res_file), '-iL', os.path.normcase(temp_hosts_nmap)]
+    log.debug(' '.join(cmd))
+    # the files of the failed and the timed out jobs are removed too
+    try:
+        with open(temp_hosts_nmap, 'w') as fh:
+            fh.write('\n'.join(hosts))
+        try:
+            cmd_res = subprocess.run(
+                cmd,
+                timeout=max(200, len(hosts)),
+                text=True,
+                capture_output=True,
+            )
+        except subprocess.TimeoutExpired:
+            metrics.inc('nmap_runs_total', job='liveness', code='timeout')
+            raise
+        finally:
+            metrics.observe('nmap_duration_seconds', time.time() - start_time, job='liveness')
+        metrics.inc('nmap_runs_total', job='liveness', code=cmd_res.returncode)
+        log.debug(re.sub(r'[\n\r]+', r'\\n ', cmd_res.stdout))
+        alive_ip_set = None
+        if cmd_res.returncode:
+            log.info(cmd_res.stderr)
+            log.error(f'ERROR! Failed to get hosts status (job {job_id})')
+        else:
+            log.info(f'The scanning hosts states passed successfully (job {job_id}, {len(hosts)} hosts)')
+            with metrics.timer('nmap_xml_parse_seconds', job='liveness'):
+                alive_ip_set = update_host_status(xml_res_file)
+    finally:
+        for file in (xml_res_file, temp_hosts_nmap):
+            file.unlink(missing_ok=True)
+    return alive_ip_set, time.time() - start_time
+
+
+def sweep_all_hosts(
+        ips: list[str],
+        batcher: AdaptiveBatcher,
+        jobs: int = Config.search_for_dead_jobs,
+) -> tuple[set[str], set[str]]:
+    """ check liveness of all the ips with concurrent nmap jobs, a new batch is started when a job finishes
+    :return: (alive ips, ips of the failed jobs - their status is unknown)
+    """
+    alive_ip_set = set()
+    failed_ip_set = set()
+    next_index = 0
+    # the job slot selects the temp files of the job
+    free_slots = list(range(jobs))
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        running = {}
+        while next_index < len(ips) or running:
+            while next_index < len(ips) and free_slots:
+                batch = ips[next_index:next_index + batcher.size]
+                log.info(f'Process [{next_index}:{next_index + len(batch)}] hosts in the "hosts" table')
+                slot = free_slots.pop()
+                running[executor.submit(sweep_hosts, slot, batch)] = (slot, batch)
+                next_index += len(batch)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                slot, batch = running.pop(future)
+                batch_size = len(batch)
+                free_slots.append(slot)
+                try:
+                    alive, latency = future.result()
+                except Exception as err:
+                    log.exception('ERROR! exception in the liveness job', exc_info=err)
+                    failed_ip_set.update(batch)
+                    continue
+                if alive is None:
+                    failed_ip_set.update(batch)
+                    continue
+                alive_ip_set |= alive
+                log.debug(f'{batch_size} hosts took {latency:.1f} sec, next batch size {batcher.update(batch_size, latency)}')
+    return alive_ip_set, failed_ip_set
+
+
 def search_for_dead(one_cycle: bool = False, log_queue: QueueHandler = None) -> None:
     log = Config.initiate_process_queue_logger('refresher', log_queue)
-    xml_res_file = Config.tmp_folder_path / 'nmap_search_for_dead.xml'
-    temp_hosts_nmap = Config.tmp_folder_path / 'temp_hosts_nmap.txt'
 
     sql = SqlConnection()
-    search_for_dead_timer = time.time()
+    batcher = AdaptiveBatcher()
 
     while True:
-        hosts_ip_set = set()
-        alive_ip_set = set()
         try:
-            sql_tuples_up = sql.cursor.execute('SELECT ipv4 FROM hosts WHERE status="up"').fetchall()
-            sql_tuples_down = sql.cursor.execute('SELECT ipv4 FROM hosts WHERE status="down"').fetchall()
-            sql_tuples = sql_tuples_up + sql_tuples_down
-            all_ips = len(sql_tuples)
+            pass_start_time = time.time()
+            # At first Try to scan manually newly added hosts
+            not_scanned = sql.execute('hosts_not_scanned').fetchall()
+            for ipv4, in not_scanned:
+                scan_networks(sql, full_net_pattern=ipv4)
+            hosts_ip_set = {ipv4 for ipv4, in sql.execute('hosts_up_or_down').fetchall()}
+            all_ips = len(hosts_ip_set)
             log.info(f'Found {all_ips} hosts')
-            for i in range(0, all_ips, Config.search_for_dead_burst):
-                # At first Try to scan manually newly added hosts
-                not_scanned = sql.cursor.execute('SELECT ipv4 FROM hosts WHERE scanned=0').fetchall()
-                for ipv4, in not_scanned:
-                    scan_networks(sql, full_net_pattern=ipv4)
-                with open(temp_hosts_nmap, 'w') as fh:
-                    for ipv4, in sql_tuples[i:i + Config.search_for_dead_burst]:
-                        fh.write(f'{ipv4} ')
-                        hosts_ip_set.add(ipv4)
-                log.info(f'Process [{i}:{i + 256}] hosts in the "hosts" table')
-                cmd_str = (f'nmap.exe -sn -n -PE -Pn --max-rtt-timeout 200ms --disable-arp-ping --host-timeout'
-                           f' 30s -oX {os.path.normcase(xml_res_file)} -iL {os.path.normcase(temp_hosts_nmap)}')
-                log.debug(cmd_str)
-                cmd_res = subprocess.run(
-                    cmd_str,
-                    timeout=200,
-                    text=True,
-                    capture_output=True,
-                )
-                log.debug(re.sub(r'[\n\r]+', r'\\n ', cmd_res.stdout))
-                if cmd_res.returncode:
-                    log.info(cmd_res.stderr)
-                    log.error(f'ERROR! Failed to get hosts status')
-                else:
-                    log.info(f'The scanning hosts states passed successfully')
-                alive_ip_set |= update_host_status(xml_res_file)
-                time.sleep(Config.search_for_dead_period)
+            alive_ip_set = set()
+            if Config.liveness_engine == 'native':
+                alive_ip_set = native_liveness(sql, sorted(hosts_ip_set))
+            # the hosts that did not answer the native probes are checked by nmap
+            swept_alive, failed_ip_set = sweep_all_hosts(sorted(hosts_ip_set - alive_ip_set), batcher)
+            alive_ip_set |= swept_alive
+            if failed_ip_set:
+                # not down - the status of these hosts is unknown until the next pass
+                log.error(f'The liveness jobs of {len(failed_ip_set)} hosts failed, their status is not changed')
+                hosts_ip_set -= failed_ip_set
 
             dead_ip_set = hosts_ip_set - alive_ip_set
             log.debug(f'dead ips:\n{dead_ip_set}')
             log.info(f'Found {len(dead_ip_set)} dead hosts of {all_ips}')
             current_date = datetime.now().strftime("%Y-%b-%d %H:%M:%S")
-            for ipv4 in hosts_ip_set:
-                status = 'up'
-                if ipv4 in dead_ip_set: status = 'down'
-                update_str = f"updated='{current_date}', status='{status}'"
-                sql_cmd = f"UPDATE hosts SET {update_str} WHERE ipv4='{ipv4}'"
-                if status == 'down' and (ipv4,) in sql_tuples_up:
-                    update_str += f", down_at='{current_date}'"
-                sql.cursor.execute(sql_cmd)
-                sql.conn.commit()
-                time.sleep(0.1)
-                if status == 'down':
-                    #
-                    # TODO -  check how long the host is in down state and delete
-                    #
-                    del_command = f"DELETE FROM hosts WHERE ipv4='{ipv4}'"
-                    sql_cmd = (f"SELECT name,domain,keep,type,owner,sub_owner "
-                               f"FROM hosts WHERE ipv4='{ipv4}'")
-                    name, domain, keep, type, owner, sub_owner, *_ = sql.cursor.execute(sql_cmd).fetchall()[0]
-                    if not [x for x in (keep, type, owner, sub_owner) if x]:
-                        log.info(f'Delete dead host ({ipv4})- there is no owner or other identification')
-                        sql.cursor.execute(del_command)
-                        sql.conn.commit()
-                    elif name:
-                        h_list = sql.cursor.execute(
-                            f"SELECT ipv4 FROM hosts WHERE name='{name}' AND domain='{domain}' AND type<>'AUDC'"
-                        ).fetchall()
-                        if len(h_list) > 1:
-                            log.debug(h_list)
-                            log.info(f'Found several ({len(h_list)}) hosts with the same name "{name}" - ',
-                                     f'probably the IP {ipv4} changed (dhcp)')
-                            log.info(f'Delete dead host {ipv4}')
-                            sql.cursor.execute(del_command)
-                            sql.conn.commit()
-                sql.conn.commit()
+            deleted = reconcile_hosts_status(sql, hosts_ip_set, alive_ip_set, current_date)
+            log.info(f'Deleted {len(deleted)} dead hosts')
+            # the pass duration is how stale the hosts status column can be
+            pass_duration = time.time() - pass_start_time
+            log.info(f'The liveness pass of {all_ips} hosts took {pass_duration:.1f} sec')
+            metrics.observe('refresher_pass_seconds', pass_duration)
+            for state, hosts in (('alive', alive_ip_set & hosts_ip_set), ('dead', dead_ip_set), ('deleted', deleted)):
+                metrics.inc('refresher_hosts_total', len(hosts), state=state)
+            history.maintain(sql)
+            change_feed.expire_tombstones(sql)
+            metrics.flush(sql)
         except Exception as err:
             log.critical('An exception happened during refresh cycle!!!', exc_info=err)
         if one_cycle: break
+        time.sleep(Config.search_for_dead_period)
 
 
 if __name__ == '__main__':
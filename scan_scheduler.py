@@ -0,0 +1,60 @@
+"""
+density and change driven scheduling of the C networks scans
+every /24 scan is recorded in alive_networks (last scan time, hosts, churn, empty scans in a row),
+the dense and volatile networks are rescanned often and the empty ones back off exponentially
+"""
+import time
+import logging
+from typing import Optional
+
+from configuration import Config
+
+log = logging.getLogger('scheduler')
+
+
+def scan_interval(hosts: int, churn: int, empty_scans: int) -> float:
+    """ seconds until the next scan of the network """
+    if not hosts:
+        return Config.scan_base_interval * 2 ** min(empty_scans, Config.scan_max_backoff)
+    # the volatile networks are rescanned sooner
+    return Config.scan_base_interval / (1 + churn / hosts)
+
+
+def scan_score(hosts: int, churn: int, last_scan: float, now: float) -> float:
+    """ the expected value of the scan: the networks with more hosts and changes that wait longer come first """
+    return (1 + hosts * Config.scan_density_weight + churn * Config.scan_churn_weight) * (now - last_scan)
+
+
+def order_subnets(sql, subnets: list[str], now: Optional[float] = None) -> list[str]:
+    """ the subnets that are due for scan ordered by the expected value, never scanned subnets first """
+    now = now or time.time()
+    history = {network: row for network, *row in sql.execute('alive_networks_history').fetchall()}
+    new, due = [], []
+    for network in subnets:
+        if network not in history or history[network][2] is None:
+            new.append(network)
+            continue
+        hosts, churn, last_scan, next_scan = history[network]
+        if (next_scan or 0) <= now:
+            due.append((scan_score(hosts or 0, churn or 0, last_scan, now), network))
+    log.debug(f'{len(new)} new and {len(due)} due of {len(subnets)} subnets')
+    return new + [network for _, network in sorted(due, reverse=True)]
+
+
+def record_scan(sql, network: str, found: int, now: Optional[float] = None) -> None:
+    """ save the result of the network scan in the alive_networks history """
+    now = now or time.time()
+    row = sql.execute('alive_network_history', (network,)).fetchone()
+    prev_hosts, empty_scans = (row[0] or 0, row[1] or 0) if row else (0, 0)
+    churn = abs(found - prev_hosts)
+    empty_scans = 0 if found else empty_scans + 1
+    next_scan = now + scan_interval(found, churn, empty_scans)
+    sql.execute('alive_network_scan_record', (network, found, now, prev_hosts, churn, empty_scans, next_scan))
+    sql.conn.commit()
+
+
+def network_hosts(sql, subnets: list[str]) -> int:
+    """ the hosts found in the subnets by their last scans """
+    subnets_set = set(subnets)
+    return sum(hosts or 0 for network, hosts, *_ in sql.execute('alive_networks_history').fetchall()
+               if network in subnets_set)
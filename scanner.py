@@ -1,12 +1,21 @@
 import logging
 from typing import Optional
+from pathlib import Path
+from logging.handlers import QueueHandler
 import subprocess
 import os
 import re
 import ipaddress
 import socket
+import time
+from collections import Counter
 from datetime import datetime
-from configuration import Config, XmlParser
+from configuration import Config, iter_nmap_hosts
+from tcp_probe import native_port_scan
+from scan_scheduler import record_scan
+from sql_connection import get_sql_connection
+import os_cache
+import metrics
 
 log = logging.getLogger('scanner')
 
@@ -20,6 +29,7 @@ def scan_networks(
         xml_res_file: str = Config.tmp_folder_path / 'nmap_res.xml',
         only_public: bool = True,
         discovery_mode: str = 'PS',
+        engine: Optional[str] = None,
         ) -> int:
     """ scan a subnet or a host for open ports for and update the hosts table
     :param sql:
@@ -30,24 +40,56 @@ def scan_networks(
     :param xml_res_file:
     :param only_public:
     :param discovery_mode: nmap discovery mode - PS, PE
+    :param engine: 'nmap' or 'native' (asyncio TCP connect probes, no OS detection), default Config.scan_engine
     :return:
     """
-    pn_param: str = ''
-    hostname: str = ''
     found: int = 0
     if full_net_pattern:
         scan_pattern = full_net_pattern
     else:
         scan_pattern = f'{subnet_a}.{subnet_b}.{subnet_c}.0/24'
+    allowed, pn_param, hostname = check_scan_pattern(scan_pattern, only_public)
+    if not allowed:
+        return -1
+    if (engine or Config.scan_engine) == 'native':
+        found = process_scan_result(sql, scan_pattern, native_port_scan(scan_targets(scan_pattern), hostname), 0)
+    else:
+        returncode = run_nmap_port_scan(scan_pattern, xml_res_file, discovery_mode, pn_param)
+        if not returncode:
+            found = process_nmap_res(sql, xml_res_file, hostname=hostname)
+    if found > 0:
+        sql.update_alive_networks_table(scan_pattern, found)
+    return found
+
+
+def scan_targets(scan_pattern: str) -> list[str]:
+    """ the host addresses of the network (or the host itself) without the excluded ones,
+    nmap skips them by the exclude file, the native probes by this filter
+    """
+    try:
+        network = ipaddress.ip_network(scan_pattern)
+    except ValueError:
+        return [scan_pattern]
+    deny = Config.scan_scope.deny
+    return [str(ip) for ip in [*network.hosts()] or [network.network_address] if ip not in deny]
+
+
+def check_scan_pattern(scan_pattern: str, only_public: bool = True) -> tuple[bool, str, str]:
+    """ check that the scan pattern may be scanned
+    :param scan_pattern: network or host (IP or FQDN)
+    :param only_public:
+    :return: (allowed, nmap -Pn parameter, hostname)
+    """
+    pn_param: str = ''
+    hostname: str = ''
     try:
         ipaddress.ip_network(scan_pattern)
         if only_public and not ipaddress.ip_network(scan_pattern).is_private:
             log.info(f'The network {scan_pattern} is public - cannot run scan on public networks')
-            return -1
-        for f_net in Config.exclude_networks_obj_list:
-            if ipaddress.ip_network(scan_pattern).subnet_of(f_net):
-                log.info(f'The network {scan_pattern} is found as excluded from scan network')
-                return -1
+            return False, pn_param, hostname
+        if Config.scan_scope.excluded(scan_pattern):
+            log.info(f'The network {scan_pattern} is out of the scan scope')
+            return False, pn_param, hostname
     except ValueError:
         log.info(f'The {scan_pattern=} is not a valid network - is it host? - try to resolve FQDN')
         try:
@@ -56,66 +98,298 @@ def scan_networks(
         except:
             pass
         pn_param = '-Pn'
+    return True, pn_param, hostname
+
+
+def run_nmap_port_scan(
+        scan_pattern: str,
+        xml_res_file: str | Path,
+        discovery_mode: str = 'PS',
+        pn_param: str = '',
+) -> int:
+    """ run nmap port scan of the scan pattern, the results are saved in the xml_res_file
+    :return: nmap return code
+    """
     log.info(f'start scanning the {scan_pattern}')
-    cmd_str = f'nmap.exe -p {",".join([*Config.check_ports_dict])} -O --max-rtt-timeout 100ms --disable-arp-ping \
---host-timeout 30s -sT -{discovery_mode} {pn_param} -oX {os.path.normcase(xml_res_file)} --excludefile {Config.exclude_file} {scan_pattern}'
-
-    log.debug(cmd_str)
-    cmd_res = subprocess.run(
-        cmd_str,
-        timeout=240,
-        text=True,
-        capture_output=True,
-    )
-    log.info(cmd_res.stdout)
-    if cmd_res.returncode:
-        log.info(cmd_res.stderr)
+    returncode = run_nmap(port_scan_args(discovery_mode, pn_param), [scan_pattern], xml_res_file)
+    if returncode:
         log.error(f'ERROR! Failed to enumerate {scan_pattern} subnet')
     else:
         log.info(f'The scanning "{scan_pattern}" subnet passed successfully')
-        found = process_nmap_res(sql, xml_res_file, hostname=hostname)
-        if found:
-            sql.update_alive_networks_table(scan_pattern, found)
-    return found
+    return returncode
 
 
-def process_nmap_res(sql, xml_res_file, hostname: str = ''):
-    rt = XmlParser(xml_res_file)
-    count = 0
-    current_date = datetime.now().strftime("%Y-%b-%d %H:%M:%S")
-    for host in rt.root.findall('host'):
-        count += 1
+def port_scan_args(discovery_mode: str = 'PS', pn_param: str = '', os_detection: bool = True) -> list[str]:
+    args = ['-p', ','.join([*Config.check_ports_dict]), '--max-rtt-timeout', '100ms', '--disable-arp-ping',
+            '--host-timeout', '30s', '-sT', f'-{discovery_mode}']
+    if os_detection:
+        args.append('-O')
+    if pn_param:
+        args.append(pn_param)
+    return args
+
+
+def port_scan(
+        targets: list[str],
+        xml_res_file: str | Path,
+        discovery_mode: str = 'PS',
+        pn_param: str = '',
+        timeout: int = 240,
+) -> tuple[list[dict], int, Optional[dict]]:
+    """ ports scan of the targets, the slow -O OS detection runs only for the OS cache misses
+    :return: (hosts records, nmap return code, OS cache update - see os_cache.save)
+    """
+    if not Config.os_cache_ttl:
+        returncode = run_nmap(port_scan_args(discovery_mode, pn_param), targets, xml_res_file, timeout)
+        return ([] if returncode else nmap_res_to_records(xml_res_file)), returncode, None
+    returncode = run_nmap(port_scan_args(discovery_mode, pn_param, os_detection=False), targets, xml_res_file, timeout)
+    if returncode:
+        return [], returncode, None
+    records = {host_obj['ipv4']: host_obj for host_obj in nmap_res_to_records(xml_res_file)}
+    keys = os_cache.fingerprint_keys(xml_res_file)
+    hits, misses = os_cache.lookup(get_sql_connection(), keys)
+    for ipv4, os_family in hits.items():
+        if os_family and ipv4 in records:
+            records[ipv4]['os'] = os_family
+    update = dict(entries=[], hits=len(hits), misses=len(misses), os_scan_hosts=0, os_scan_seconds=0.0)
+    if misses:
+        start_time = time.time()
+        os_returncode = run_nmap(port_scan_args(discovery_mode, '-Pn'), misses, xml_res_file, timeout,
+                                 job='os_detection')
+        update['os_scan_seconds'] = time.time() - start_time
+        if os_returncode:
+            log.error(f'ERROR! Failed to detect OS of {len(misses)} hosts')
+        else:
+            update['os_scan_hosts'] = len(misses)
+            os_keys = os_cache.fingerprint_keys(xml_res_file)
+            for host_obj in nmap_res_to_records(xml_res_file):
+                records[host_obj['ipv4']] = host_obj
+                mac, ports = os_keys.get(host_obj['ipv4']) or keys.get(host_obj['ipv4'], ('', ''))
+                update['entries'].append((host_obj['ipv4'], mac, ports, host_obj.get('os', ''), time.time()))
+    log.info(f'OS cache: {len(hits)} hits, {len(misses)} misses ({update["os_scan_seconds"]:.1f} sec of -O scan)')
+    return [*records.values()], 0, update
+
+
+def discovery_args() -> list[str]:
+    """ the fast host discovery sweep: no ports scan, no DNS """
+    ports = ','.join(key[2:] for key in Config.check_ports_dict if key.startswith('T:'))
+    return ['-sn', '-n', '-PE', f'-PS{ports}', '--max-rtt-timeout', '100ms', '--disable-arp-ping']
+
+
+def run_nmap(
+        args: list[str],
+        targets: list[str],
+        xml_res_file: str | Path,
+        timeout: int = 240,
+        job: str = 'port_scan',
+) -> int:
+    """ run nmap against the targets (passed in a -iL file), the results are saved in the xml_res_file
+    :param job: the job kind of the metrics
+    :return: nmap return code
+    """
+    targets_file = Path(xml_res_file).with_suffix('.txt')
+    targets_file.write_text('\n'.join(targets))
+    cmd = [*Config.nmap_command, *args, '-oX', os.path.normcase(xml_res_file), '--excludefile', os.path.normcase(Config.exclude_file),
+           '-iL', os.path.normcase(targets_file)]
+    log.debug(' '.join(cmd))
+    start_time = time.perf_counter()
+    try:
+        cmd_res = subprocess.run(
+            cmd,
+            timeout=timeout,
+            text=True,
+            capture_output=True,
+        )
+    except subprocess.TimeoutExpired:
+        metrics.inc('nmap_runs_total', job=job, code='timeout')
+        raise
+    finally:
+        targets_file.unlink(missing_ok=True)
+        metrics.observe('nmap_duration_seconds', time.perf_counter() - start_time, job=job)
+    metrics.inc('nmap_runs_total', job=job, code=cmd_res.returncode)
+    log.info(cmd_res.stdout)
+    if cmd_res.returncode:
+        log.info(cmd_res.stderr)
+    return cmd_res.returncode
+
+
+def init_scan_worker(log_queue: Optional[QueueHandler] = None) -> None:
+    """ initializer of the scan pool worker processes """
+    Config.initiate_process_queue_logger('scanner', log_queue)
+
+
+def scan_c_network_worker(scan_pattern: str, engine: Optional[str] = None) -> tuple[str, list[dict], int, Optional[dict]]:
+    """ scan pool worker: scan one C network (nmap into its own XML file or native probes),
+    the DB is updated by the caller (see process_scan_result) to keep the writes ordered
+    :return: (scan_pattern, hosts records, nmap return code or -1 if the network is not allowed, OS cache update)
+    """
+    allowed, pn_param, _ = check_scan_pattern(scan_pattern)
+    if not allowed:
+        return scan_pattern, [], -1, None
+    try:
+        if (engine or Config.scan_engine) == 'native':
+            return scan_pattern, native_port_scan(scan_targets(scan_pattern)), 0, None
+        xml_res_file = Config.tmp_folder_path / f"nmap_res_{re.sub(r'[./]', '_', scan_pattern)}.xml"
+        log.info(f'start scanning the {scan_pattern}')
+        records, returncode, os_cache_update = port_scan([scan_pattern], xml_res_file, pn_param=pn_param)
+        xml_res_file.unlink(missing_ok=True)
+        return scan_pattern, records, returncode, os_cache_update
+    except Exception as err:
+        log.exception(f'ERROR! exception while scanning {scan_pattern}!', exc_info=err)
+        return scan_pattern, [], 1, None
+    finally:
+        metrics.flush()
+
+
+def process_scan_result(
+        sql,
+        scan_pattern: str,
+        records: list[dict],
+        returncode: int,
+        os_cache_update: Optional[dict] = None,
+) -> int:
+    """ update the DB with the results of scan_c_network_worker, the alive_networks row is left to record_scan
+    that reads the previous hosts count of the churn before it writes the new one
+    :return: number of found hosts, -1 if the network was not scanned (not allowed or the scan failed)
+    """
+    if os_cache_update:
+        os_cache.save(sql, os_cache_update)
+    if returncode:
+        if returncode > 0:
+            log.error(f'ERROR! Failed to scan {scan_pattern} (code {returncode})')
+        return -1
+    if not records:
+        return 0
+    sql.bulk_upsert_hosts(records)
+    return len(records)
+
+
+def discover_hosts_worker(networks: list[str]) -> tuple[list[str], list[str], int]:
+    """ scan pool worker, phase 1 of the two phase scan: host discovery sweep of the networks
+    :return: (networks, alive ips, nmap return code)
+    """
+    xml_res_file = Config.tmp_folder_path / f'nmap_discovery_{os.getpid()}.xml'
+    log.info(f'start host discovery of {len(networks)} networks {networks[0]} - {networks[-1]}')
+    try:
+        addresses = sum(ipaddress.ip_network(network).num_addresses for network in networks)
+        returncode = run_nmap(discovery_args(), networks, xml_res_file, timeout=max(240, addresses // 10),
+                              job='discovery')
+        with metrics.timer('nmap_xml_parse_seconds', job='discovery'):
+            alive = [] if returncode else [host['ipv4'] for host in iter_nmap_hosts(xml_res_file)
+                                           if host['state'] == 'up']
+    except Exception as err:
+        log.exception(f'ERROR! exception while discovering {networks}!', exc_info=err)
+        return networks, [], 1
+    finally:
+        xml_res_file.unlink(missing_ok=True)
+        metrics.flush()
+    log.info(f'Found {len(alive)} alive hosts in {len(networks)} networks')
+    return networks, alive, returncode
+
+
+def port_scan_worker(ips: list[str], engine: Optional[str] = None) -> tuple[list[str], list[dict], int, Optional[dict]]:
+    """ scan pool worker, phase 2 of the two phase scan: ports and OS scan of the alive hosts
+    (the native engine probes the ports only)
+    :return: (ips, hosts records, nmap return code, OS cache update)
+    """
+    xml_res_file = Config.tmp_folder_path / f'nmap_res_{os.getpid()}.xml'
+    try:
+        if (engine or Config.scan_engine) == 'native':
+            records = native_port_scan(ips)
+            # alive by the discovery sweep even if none of the probed ports answers
+            answered = {host_obj['ipv4'] for host_obj in records}
+            records.extend(dict(ipv4=ip, status='up', scanned='1') for ip in ips if ip not in answered)
+            return ips, records, 0, None
+        records, returncode, os_cache_update = port_scan(ips, xml_res_file, pn_param='-Pn', timeout=max(240, len(ips)))
+    except Exception as err:
+        log.exception(f'ERROR! exception while scanning {len(ips)} hosts!', exc_info=err)
+        return ips, [], 1, None
+    finally:
+        xml_res_file.unlink(missing_ok=True)
+        metrics.flush()
+    return ips, records, returncode, os_cache_update
+
+
+def two_phase_scan(sql, scan_pool, networks: list[str]) -> int:
+    """ scan the networks in two phases: one wide nmap host discovery sweep (Config.discovery_chunk_networks per nmap),
+    then the ports and OS scan (by Config.scan_engine) of the alive hosts only, batched across the networks boundaries
+    the results are recorded per network in alive_networks
+    :return: number of found hosts
+    """
+    networks = [network for network in networks if check_scan_pattern(network)[0]]
+    if not networks:
+        return 0
+    failed: set[str] = set()
+    alive_ips: list[str] = []
+    chunk = Config.discovery_chunk_networks
+    for chunk_networks, ips, returncode in scan_pool.map(
+            discover_hosts_worker, [networks[i:i + chunk] for i in range(0, len(networks), chunk)]):
+        if returncode:
+            failed.update(chunk_networks)
+        alive_ips.extend(ips)
+    prefix_len = ipaddress.ip_network(networks[0]).prefixlen
+
+    def network_of(ip: str) -> str:
+        return str(ipaddress.ip_network(f'{ip}/{prefix_len}', strict=False))
+
+    records: list[dict] = []
+    batch = Config.port_scan_batch_hosts
+    for ips, batch_records, returncode, os_cache_update in scan_pool.map(
+            port_scan_worker, [alive_ips[i:i + batch] for i in range(0, len(alive_ips), batch)]):
+        if os_cache_update:
+            os_cache.save(sql, os_cache_update)
+        if returncode:
+            log.error(f'ERROR! Failed to scan {len(ips)} hosts {ips[0]} - {ips[-1]}')
+            failed.update(network_of(ip) for ip in ips)
+        records.extend(batch_records)
+    sql.bulk_upsert_hosts(records)
+    counts = Counter(network_of(host_obj['ipv4']) for host_obj in records)
+    for network in networks:
+        if network not in failed:
+            record_scan(sql, network, counts.get(network, 0))
+    log.info(f'Found {len(records)} hosts in {len(networks)} networks ({len(failed)} failed)')
+    return len(records)
+
+
+def nmap_res_to_records(xml_res_file, hostname: str = '') -> list[dict]:
+    """ convert the nmap XML result to the hosts table records """
+    start_time = time.perf_counter()
+    records: list[dict] = []
+    for host in iter_nmap_hosts(xml_res_file):
         host_obj = dict()
-        for host_addr in host.findall('address'):
-            host_obj['ipv4'] = hostname if hostname else host_addr.attrib['addr']
-            if host_addr.attrib['addrtype'] == 'mac' and host_addr.attrib.get('vendor', None):
-                host_obj['macvendor'] = host_addr.attrib['vendor']
-        prots_el = host.find('ports')
-        if prots_el is not None:
-            for port in prots_el:
+        host_obj['ipv4'] = hostname if hostname else host['ipv4']
+        if host['macvendor']:
+            host_obj['macvendor'] = host['macvendor']
+        if host['ports']:
+            for protocol, portid, state in host['ports']:
                 prot_prefix = ''
-                if port.attrib['protocol'] == 'tcp': prot_prefix = 'T:'
-                elif port.attrib['protocol'] == 'udp': prot_prefix = 'U:'
-                else: log.warning(f"Unlisted protocol found: '{port.attrib['protocol']}'")
-                check_prot_name = Config.check_ports_dict.get(prot_prefix + port.attrib['portid'], None)
-                if check_prot_name and port.find('state').attrib['state'] == 'open':
+                if protocol == 'tcp': prot_prefix = 'T:'
+                elif protocol == 'udp': prot_prefix = 'U:'
+                else: log.warning(f"Unlisted protocol found: '{protocol}'")
+                check_prot_name = Config.check_ports_dict.get(prot_prefix + portid, None)
+                if check_prot_name and state == 'open':
                     host_obj[check_prot_name] = 'ok'
         else:
             log.debug(f"no ports listed for {host_obj['ipv4']}")
-        hostname = host.find('hostnames').find('hostname')
-        if hostname is not None:
-            host_obj['name'] = hostname.attrib['name']
-            re_res = re.search(r'^([^\.]+)\.(.+)$', hostname.attrib['name'])
+        if host['hostname']:
+            host_obj['name'] = host['hostname']
+            re_res = re.search(r'^([^\.]+)\.(.+)$', host['hostname'])
             if re_res:
                 host_obj['name'], host_obj['domain'] = re_res.groups('')
-        try:
-            host_obj['os'] = host.find('os').find('osmatch').find('osclass').attrib['osfamily']
-        except:
-            pass
+        if host['osfamily']:
+            host_obj['os'] = host['osfamily']
         host_obj['status'] = 'up'
         host_obj['scanned'] = '1'
         log.info(host_obj)
-        sql.update_hosts_table(host_obj, current_date, False)
-        sql.conn.commit()
-    log.info(f'Found {count} hosts in "{xml_res_file}"')
-    return count
+        records.append(host_obj)
+    metrics.observe('nmap_xml_parse_seconds', time.perf_counter() - start_time, job='port_scan')
+    return records
+
+
+def process_nmap_res(sql, xml_res_file, hostname: str = ''):
+    current_date = datetime.now().strftime("%Y-%b-%d %H:%M:%S")
+    records = nmap_res_to_records(xml_res_file, hostname)
+    # all the hosts of the scan are written in one transaction
+    sql.bulk_upsert_hosts(records, current_date)
+    log.info(f'Found {len(records)} hosts in "{xml_res_file}"')
+    return len(records)
@@ -1,17 +1,164 @@
-import re
 import sqlite3
 import logging
+import threading
+import time
 from datetime import datetime
+from typing import Optional, Iterator
+from contextlib import contextmanager
+from functools import lru_cache
 from configuration import Config as cfg
+from sql_migrations import migrate, FEED_TABLES
+import metrics
 
 log = logging.getLogger('sql_client')
+# w2ui grid search operators
+COMPARE_OPERATORS: dict[str, str] = {'is': '=', 'less': '<', 'more': '>'}
+# the grid sort of the (table, field) by another column: the addresses in the numeric order
+SORT_COLUMNS: dict[tuple[str, str], str] = {('hosts', 'ipv4'): 'ip_num'}
+
+
+HOSTS_INSERT_COLUMNS: list[str] = [key for key in cfg.sql_fields if key != 'updated']
+# the host properties that force a new plugin probe when changed (see plugins/probe_state), hosts alias is h
+PROBE_SIGNATURE = " || ',' || ".join(
+    f"coalesce(h.{column}, '')" for column in [*cfg.check_ports_dict.values(), 'web_server'] if column in cfg.sql_fields
+)
+# the named statements of the data layer: the SQL text never changes, only the parameters do,
+# so the sqlite3 statement cache parses and plans every statement once per connection
+STATEMENTS: dict[str, str] = {
+    'host_delete': 'DELETE FROM hosts WHERE ipv4=?',
+    'hosts_not_scanned': 'SELECT ipv4 FROM hosts WHERE scanned=0',
+    'hosts_up_or_down': "SELECT ipv4 FROM hosts WHERE status='up' OR status='down'",
+    # refresher status reconciliation (see refresher.reconcile_hosts_status)
+    'probed_hosts_create': 'CREATE TEMP TABLE IF NOT EXISTS probed_hosts (ipv4 char(17) primary key, alive integer)',
+    'probed_hosts_clear': 'DELETE FROM probed_hosts',
+    'probed_hosts_insert': 'INSERT INTO probed_hosts (ipv4, alive) VALUES (?, ?)',
+    'hosts_down_at_update': ("UPDATE hosts SET down_at=? WHERE status='up' "
+                             "AND ipv4 IN (SELECT ipv4 FROM probed_hosts WHERE alive=0)"),
+    'hosts_status_update': 'UPDATE hosts SET updated=?, status=? WHERE ipv4 IN (SELECT ipv4 FROM probed_hosts WHERE alive=?)',
+    'hosts_dead_to_delete': """SELECT h.ipv4 FROM hosts h JOIN probed_hosts p ON p.ipv4 = h.ipv4 AND p.alive = 0
+        WHERE COALESCE(h.keep, '') || COALESCE(h.type, '') || COALESCE(h.owner, '') || COALESCE(h.sub_owner, '') = ''
+        OR (COALESCE(h.name, '') <> '' AND EXISTS (
+            SELECT 1 FROM hosts d WHERE d.name = h.name AND d.domain = h.domain AND d.type <> 'AUDC'
+            AND d.status = 'up' AND d.ipv4 <> h.ipv4))""",
+    'alive_network_upsert': ('INSERT INTO alive_networks (network, hosts) VALUES (?, ?) '
+                             'ON CONFLICT(network) DO UPDATE SET hosts=excluded.hosts'),
+    # hosts availability history (see history.py), the transitions are written before the status update
+    'host_transitions_insert': (
+        "INSERT INTO host_transitions (ipv4, at, status) "
+        "SELECT p.ipv4, ?, CASE p.alive WHEN 1 THEN 'up' ELSE 'down' END FROM probed_hosts p "
+        "JOIN hosts h ON h.ipv4 = p.ipv4 WHERE h.status IS NOT (CASE p.alive WHEN 1 THEN 'up' ELSE 'down' END) "
+        "OR NOT EXISTS (SELECT 1 FROM host_transitions t WHERE t.ipv4 = p.ipv4)"
+    ),
+    'host_transitions_first': 'SELECT min(at) FROM host_transitions',
+    'host_transitions_window': 'SELECT ipv4, at, status FROM host_transitions WHERE at >= ? AND at < ? ORDER BY ipv4, at',
+    'host_transitions_states_before': (
+        'SELECT t.ipv4, t.status FROM host_transitions t '
+        'WHERE t.ipv4 IN (SELECT ipv4 FROM host_transitions WHERE at >= ? AND at < ?) '
+        'AND t.at = (SELECT max(at) FROM host_transitions m WHERE m.ipv4 = t.ipv4 AND m.at < ?)'
+    ),
+    'host_transitions_of': 'SELECT at, status FROM host_transitions WHERE ipv4=? AND at >= ? AND at < ? ORDER BY at',
+    'host_transition_before': 'SELECT at, status FROM host_transitions WHERE ipv4=? AND at <= ? ORDER BY at DESC LIMIT 1',
+    'host_transitions_compact': (
+        'DELETE FROM host_transitions WHERE at < ? AND (ipv4 NOT IN (SELECT ipv4 FROM hosts) '
+        'OR at < (SELECT max(at) FROM host_transitions m WHERE m.ipv4 = host_transitions.ipv4))'
+    ),
+    'host_availability_upsert': (
+        'INSERT INTO host_availability (ipv4, period, bucket, up_seconds, down_seconds, transitions, last_status) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(ipv4, period, bucket) DO UPDATE SET up_seconds=excluded.up_seconds, '
+        'down_seconds=excluded.down_seconds, transitions=excluded.transitions, last_status=excluded.last_status'
+    ),
+    'host_availability_of': ('SELECT bucket, up_seconds, down_seconds, transitions, last_status FROM host_availability '
+                             'WHERE ipv4=? AND period=? AND bucket >= ? AND bucket < ? ORDER BY bucket'),
+    'host_bucket_before': ('SELECT bucket, last_status FROM host_availability WHERE ipv4=? AND period=? AND bucket <= ? '
+                           'ORDER BY bucket DESC LIMIT 1'),
+    'host_availability_expire': 'DELETE FROM host_availability WHERE period=? AND bucket < ?',
+    'history_state_get': 'SELECT value FROM history_state WHERE name=?',
+    'history_state_set': ('INSERT INTO history_state (name, value) VALUES (?, ?) '
+                          'ON CONFLICT(name) DO UPDATE SET value=excluded.value'),
+    # scan scheduler history (see scan_scheduler)
+    'alive_networks_history': 'SELECT network, hosts, churn, last_scan, next_scan FROM alive_networks',
+    'alive_network_history': 'SELECT hosts, empty_scans FROM alive_networks WHERE network=?',
+    'alive_network_scan_record': (
+        'INSERT INTO alive_networks (network, hosts, last_scan, prev_hosts, churn, empty_scans, next_scan) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(network) DO UPDATE SET hosts=excluded.hosts, '
+        'last_scan=excluded.last_scan, prev_hosts=excluded.prev_hosts, churn=excluded.churn, '
+        'empty_scans=excluded.empty_scans, next_scan=excluded.next_scan'
+    ),
+    # OS fingerprint cache (see os_cache)
+    'os_cache_get': 'SELECT mac, ports, os, checked FROM os_cache WHERE ipv4=?',
+    'os_cache_upsert': (
+        'INSERT INTO os_cache (ipv4, mac, ports, os, checked) VALUES (?, ?, ?, ?, ?) ON CONFLICT(ipv4) DO UPDATE '
+        'SET mac=excluded.mac, ports=excluded.ports, os=excluded.os, checked=excluded.checked'
+    ),
+    'os_cache_stats': 'SELECT name, value FROM os_cache_stats',
+    'os_cache_stats_add': ('INSERT INTO os_cache_stats (name, value) VALUES (?, ?) '
+                           'ON CONFLICT(name) DO UPDATE SET value=value+excluded.value'),
+    # plugins probe state
+    'probe_state_failures': 'SELECT ipv4, failures FROM probe_state WHERE plugin=?',
+    'probe_state_upsert': (
+        f'INSERT INTO probe_state (plugin, ipv4, result, failures, checked, next_eligible, signature) '
+        f'SELECT ?, h.ipv4, ?, ?, ?, ?, {PROBE_SIGNATURE} FROM hosts h WHERE h.ipv4=? '
+        f'ON CONFLICT(plugin, ipv4) DO UPDATE SET result=excluded.result, failures=excluded.failures, '
+        f'checked=excluded.checked, next_eligible=excluded.next_eligible, signature=excluded.signature'
+    ),
+    'probe_state_stats': (
+        'SELECT result, count(*), sum(next_eligible > ?) FROM probe_state WHERE plugin=? GROUP BY result'
+    ),
+    # metrics (see metrics.py)
+    'metrics_add': ('INSERT INTO metrics (name, labels, value) VALUES (?, ?, ?) '
+                    'ON CONFLICT(name, labels) DO UPDATE SET value=value+excluded.value'),
+    'metrics_all': 'SELECT name, labels, value FROM metrics',
+    # live change feed (see change_feed.py)
+    'revision_get': 'SELECT value FROM revision_seq WHERE name=?',
+    'tables_version': 'SELECT sum(value) FROM revision_seq',
+    'revision_raise': 'UPDATE revision_seq SET value=max(value, ?) WHERE name=?',
+    # the rows inserted after the client revision and deleted are unknown to the client
+    'row_tombstones_since': ('SELECT row_key FROM row_tombstones WHERE tbl=? AND revision > ? AND revision <= ? '
+                             'AND created <= ?'),
+    'row_tombstones_expired': 'SELECT max(revision) FROM row_tombstones WHERE deleted < ?',
+    'row_tombstones_expire': 'DELETE FROM row_tombstones WHERE revision <= ?',
+    'alive_networks_audc_recount': (
+        "WITH counts AS MATERIALIZED (SELECT (ip_num >> 24) || '.' || (ip_num >> 16 & 255) || '.' || "
+        "(ip_num >> 8 & 255) || '.0/24' AS network, count(*) AS audc FROM hosts "
+        "WHERE type='AUDC' AND status='up' GROUP BY ip_num >> 8) "
+        "UPDATE alive_networks SET audc=coalesce((SELECT audc FROM counts WHERE counts.network=alive_networks.network), 0)"
+    ),
+    # hosts IP ranges (see ip_index.py)
+    'hosts_ip_index': 'SELECT ip_num, ipv4 FROM hosts WHERE ip_num IS NOT NULL ORDER BY ip_num',
+    'b_networks_new': 'SELECT network FROM b_networks WHERE updated is NULL',
+    'b_networks_valid': "SELECT network FROM b_networks WHERE status != 'invalid'",
+    'b_networks_status_reset': "UPDATE b_networks SET status=? WHERE status != 'invalid'",
+    'application_pid': 'SELECT pid FROM applications WHERE application=?',
+}
+# the DB files whose schema was already checked by this process
+_schema_checked: set[str] = set()
+_schema_lock = threading.Lock()
+# per thread pooled connections, see get_sql_connection
+_thread_local = threading.local()
 
 
 class SqlConnection:
 
-    def __init__(self, db=cfg.root_path / 'net_scan_data.db'):
-        self.conn = sqlite3.connect(db, timeout=10)
+    def __init__(self, db=None):
+        db = db or cfg.db_file
+        self.conn = sqlite3.connect(db, timeout=cfg.sqlite_busy_timeout / 1000, cached_statements=256)
         self.cursor = self.conn.cursor()
+        self._columns_cache: dict[str, set[str]] = {}
+        self.set_pragmas()
+        with _schema_lock:
+            if str(db) not in _schema_checked:
+                self.create_tables()
+                _schema_checked.add(str(db))
+
+    def set_pragmas(self) -> None:
+        """ WAL journal - the readers do not block the writers and vice versa """
+        self.cursor.execute('PRAGMA journal_mode=WAL')
+        self.cursor.execute(f'PRAGMA busy_timeout={int(cfg.sqlite_busy_timeout)}')
+        self.cursor.execute(f'PRAGMA synchronous={cfg.sqlite_synchronous}')
+        self.cursor.execute(f'PRAGMA cache_size=-{int(cfg.sqlite_cache_size_kb)}')
+        self.cursor.execute('PRAGMA temp_store=MEMORY')
+
+    def create_tables(self) -> None:
         self.cursor.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='hosts'")
 
         if self.cursor.fetchone()[0] == 0:
@@ -41,77 +188,216 @@ class SqlConnection:
                 CREATE TABLE applications (application char(50) primary key, pid integer, updated integer)
             ''')
             self.conn.commit()
+        migrate(self.conn)
+
+    def execute(self, statement: str, params: tuple | list = ()) -> sqlite3.Cursor:
+        """ run a named statement of STATEMENTS """
+        with sqlite_metrics(statement):
+            return self.cursor.execute(STATEMENTS[statement], params)
+
+    def executemany(self, statement: str, params_seq) -> sqlite3.Cursor:
+        with sqlite_metrics(statement):
+            return self.cursor.executemany(STATEMENTS[statement], params_seq)
 
     def update_hosts_table(self, host_obj, current_date=None, commit=True):
+        self.upsert_hosts([host_obj], current_date)
+        if commit:
+            self.conn.commit()
+
+    def bulk_upsert_hosts(self, records: list[dict], current_date=None) -> int:
+        """ insert or update the hosts records in one transaction
+        the new hosts get the cfg.fields_defaults values, the existing hosts get only the supplied columns updated
+        :return: number of the written records
+        """
+        with self.conn:
+            self.upsert_hosts(records, current_date)
+        return len(records)
+
+    def upsert_hosts(self, records: list[dict], current_date=None) -> None:
+        """ insert or update the hosts records without commit, see bulk_upsert_hosts """
         if current_date is None:
             current_date = datetime.now().strftime("%Y-%b-%d %H:%M:%S")
-        sql_params_list = []
-        for key in host_obj:
-            delimiter = "'" if cfg.sql_fields[key] != 'int' else ""
-            sql_params_list.append(f"{key}={delimiter}{remove_bad_symbols(host_obj[key])}{delimiter}")
-        sql_params = ', '.join(sql_params_list)
-        cmd = f"UPDATE hosts SET {sql_params},updated='{current_date}' WHERE ipv4='{host_obj['ipv4']}'"
-        log.debug(cmd)
-        if not self.cursor.execute(cmd).rowcount:
-            for key in cfg.fields_defaults:
-                if not host_obj.get(key): host_obj[key] = cfg.fields_defaults[key]
-            sql_params = ', '.join([f"'{host_obj[key]}'" for key in host_obj])
-            cmd: str = f"INSERT INTO hosts ({', '.join([*host_obj])}, updated) VALUES ({sql_params},'{current_date}')"
-            log.debug(cmd)
-            self.cursor.execute(cmd)
+        # executemany needs the same statement for all the rows - group the records by the supplied columns
+        groups: dict[tuple, list[dict]] = {}
+        for host_obj in records:
+            groups.setdefault(tuple(sorted(host_obj)), []).append(host_obj)
+        for keys, hosts in groups.items():
+            cmd = host_upsert_statement(keys)
+            log.debug(f'{cmd} ({len(hosts)} rows)')
+            metrics.inc('hosts_upserted_total', len(hosts))
+            self.cursor.executemany(
+                cmd,
+                [[host_obj.get(key) or cfg.fields_defaults[key] for key in HOSTS_INSERT_COLUMNS] + [current_date]
+                 for host_obj in hosts]
+            )
+
+    def update_host_fields(self, ipv4: str, fields: dict, commit: bool = True) -> int:
+        """ update the columns of an existing host
+        :return: number of the updated rows
+        """
+        columns = self.check_columns('hosts', fields)
+        updated = self.cursor.execute(
+            f"UPDATE hosts SET {', '.join(f'{key}=?' for key in columns)} WHERE ipv4=?",
+            [*fields.values(), ipv4]
+        ).rowcount
         if commit:
             self.conn.commit()
+        return updated
+
+    def update_hosts_fields(self, updates: list[tuple[str, dict]]) -> int:
+        """ update the columns of many existing hosts in one transaction
+        :param updates: [(ipv4, {column: value})]
+        :return: number of the updated rows
+        """
+        # executemany needs the same statement for all the rows - group the updates by the columns
+        groups: dict[tuple, list[tuple[str, dict]]] = {}
+        for ipv4, fields in updates:
+            groups.setdefault(tuple(sorted(fields)), []).append((ipv4, fields))
+        updated = 0
+        with self.conn:
+            for keys, group in groups.items():
+                columns = self.check_columns('hosts', keys)
+                updated += self.cursor.executemany(
+                    f"UPDATE hosts SET {', '.join(f'{key}=?' for key in columns)} WHERE ipv4=?",
+                    [[fields[key] for key in keys] + [ipv4] for ipv4, fields in group]
+                ).rowcount
+        return updated
 
     def update_alive_networks_table(self, network, count):
-        cmd: str = f'UPDATE alive_networks SET hosts={count} WHERE network="{network}"'
-        log.debug(cmd)
-        updated = self.cursor.execute(cmd).rowcount
-        if not updated:
-            cmd = f'INSERT INTO alive_networks (network, hosts) VALUES ("{network}", {count})'
-            log.debug(cmd)
-            self.cursor.execute(cmd)
+        log.debug(f'alive_networks: {network}={count}')
+        self.execute('alive_network_upsert', (network, count))
         self.conn.commit()
 
-    def update_table(self, table, params_list, vals_list, sql_filter: str = '', update_date: bool = False):
-        sql_params = ', '.join([f'{par}="{val}"' for par, val in zip(params_list, vals_list)])
+    def update_table(self, table, params_list, vals_list, key: Optional[dict] = None, update_date: bool = False):
+        """ update the rows matching the key, insert a new row (with the key values) if nothing is updated
+        :param table:
+        :param params_list: columns to update
+        :param vals_list: values of the columns
+        :param key: {column: value} of the updated rows
+        :param update_date: set the "updated" column to the current date
+        """
+        values = dict(zip(params_list, vals_list))
         if update_date:
-            current_date = datetime.now().strftime("%Y-%b-%d %H:%M:%S")
-            sql_params += f",updated='{current_date}'"
-        sql_filter = re.sub(r'WHERE\s+', '', sql_filter, re.IGNORECASE)
-        sql_filter_updated = f'WHERE {sql_filter}' if sql_filter else ''
-        cmd: str = f'UPDATE {table} SET {sql_params} {sql_filter_updated}'
-        log.debug(cmd)
-        updated = self.cursor.execute(cmd).rowcount
+            values['updated'] = datetime.now().strftime("%Y-%b-%d %H:%M:%S")
+        key = key or {}
+        self.check_columns(table, [*values, *key])
+        sql_filter = f"WHERE {' AND '.join(f'{col}=?' for col in key)}" if key else ''
+        cmd: str = f"UPDATE {table} SET {', '.join(f'{col}=?' for col in values)} {sql_filter}"
+        log.debug(f'{cmd} {[*values.values(), *key.values()]}')
+        updated = self.cursor.execute(cmd, [*values.values(), *key.values()]).rowcount
         if not updated:
-            vals = ",".join([f'"{val}"' for val in vals_list])
-            params = ",".join(params_list)
-            if sql_filter:
-                if re.search(f'\s+OR\s+', sql_filter, re.IGNORECASE):
-                    raise Exception(f'Cannot insert line with "OR" in filter: {sql_filter=}')
-                iterator = iter(re.sub(r'\s+AND\s+', '=', sql_filter, re.IGNORECASE).split('='))
-                for par, val in zip(iterator, iterator):
-                    params += f',{par}'
-                    vals += f',{val}'
+            values.update(key)
+            cmd = f"INSERT INTO {table} ({', '.join(values)}) VALUES ({', '.join('?' * len(values))})"
+            log.debug(f'{cmd} {[*values.values()]}')
             try:
-                cmd = f'INSERT INTO {table} ({params}) VALUES ({vals})'
-                log.debug(cmd)
-                self.cursor.execute(cmd)
+                self.cursor.execute(cmd, [*values.values()])
             except Exception as err:
-                log.error(f'Error while inserting row, SQL command: INSERT INTO {table} ({params}) VALUES ({vals})')
+                log.error(f'Error while inserting row, SQL command: {cmd} {[*values.values()]}')
                 raise
         self.conn.commit()
 
+    def check_columns(self, table: str, columns) -> list[str]:
+        """ the table and column names cannot be statement parameters - only the existing ones are accepted """
+        if table not in self._columns_cache:
+            self._columns_cache[table] = set(self.get_table_header(table))
+        if not self._columns_cache[table]:
+            raise ValueError(f'Unknown table: {table}')
+        if unknown := [col for col in columns if col not in self._columns_cache[table]]:
+            raise ValueError(f'Unknown {table} columns: {unknown}')
+        return [*columns]
+
     def get_hosts(self, ordered=True):
         if ordered:
             return self.cursor.execute(f"SELECT {cfg.hosts_names_str} FROM hosts").fetchall()
         return self.cursor.execute("SELECT * FROM hosts").fetchall()
 
-    def get_all_rows_in_table(self, table, ordered=True, select: str = '', sql_filter: str = ''):
-        sql_filter = re.sub(r'WHERE\s+', '', sql_filter, re.IGNORECASE)
-        sql_filter = f'WHERE {sql_filter}' if sql_filter else ''
+    def get_all_rows_in_table(self, table, ordered=True, select: str = '', key: Optional[dict] = None):
+        key = key or {}
         if not select:
             select = cfg.hosts_names_str if table == 'hosts' and ordered else '*'
-        return self.cursor.execute(f"SELECT {select} FROM {table} {sql_filter}").fetchall()
+        self.check_columns(table, [*key, *[col for col in select.split(',') if col != '*']])
+        sql_filter = f"WHERE {' AND '.join(f'{col}=?' for col in key)}" if key else ''
+        return self.cursor.execute(f"SELECT {select} FROM {table} {sql_filter}", [*key.values()]).fetchall()
+
+    def query_table(
+            self,
+            table: str,
+            select: list[str],
+            limit: int = 100,
+            offset: int = 0,
+            sort: Optional[list[dict]] = None,
+            search: Optional[list[dict]] = None,
+            search_logic: str = 'AND',
+    ) -> tuple[int, list[tuple]]:
+        """ one page of the table rows, the sort and search items follow the w2ui grid remote data protocol
+        :param table:
+        :param select: the returned columns, the sort and search fields are limited to these columns
+        :param limit:
+        :param offset:
+        :param sort: [{field, direction}]
+        :param search: [{field, operator, value}]
+        :param search_logic: AND or OR
+        :return: (total number of the matched rows, rows of the page)
+        """
+        conditions: list[str] = []
+        params: list = []
+        for item in search or []:
+            field, operator, value = item.get('field'), item.get('operator', 'is'), item.get('value')
+            if field not in select or value is None:
+                continue
+            if isinstance(value, dict):
+                value = value.get('id')
+            elif isinstance(value, list):
+                value = [val.get('id') if isinstance(val, dict) else val for val in value]
+            if operator in ('begins', 'contains', 'ends'):
+                like = str(value).replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                like = {'begins': f'{like}%', 'contains': f'%{like}%', 'ends': f'%{like}'}[operator]
+                conditions.append(f"{field} LIKE ? ESCAPE '\\'")
+                params.append(like)
+            elif operator in COMPARE_OPERATORS:
+                conditions.append(f'{field} {COMPARE_OPERATORS[operator]} ?')
+                params.append(value)
+            elif operator == 'between' and isinstance(value, list) and len(value) == 2:
+                conditions.append(f'{field} BETWEEN ? AND ?')
+                params.extend(value)
+            elif operator in ('in', 'not in') and isinstance(value, list) and value:
+                conditions.append(f"{field} {operator.upper()} ({', '.join('?' * len(value))})")
+                params.extend(value)
+            else:
+                log.warning(f'Unsupported search item: {item}')
+        logic = ' OR ' if search_logic.upper() == 'OR' else ' AND '
+        sql_filter = f'WHERE {logic.join(conditions)}' if conditions else ''
+        order_list = [f"{SORT_COLUMNS.get((table, item['field']), item['field'])} "
+                      f"{'DESC' if str(item.get('direction')).lower() == 'desc' else 'ASC'}"
+                      for item in sort or [] if item.get('field') in select]
+        order = f"ORDER BY {', '.join(order_list)}" if order_list else ''
+        total = self.cursor.execute(f'SELECT count(*) FROM {table} {sql_filter}', params).fetchone()[0]
+        cmd: str = f"SELECT {', '.join(select)} FROM {table} {sql_filter} {order} LIMIT ? OFFSET ?"
+        log.debug(cmd)
+        return total, self.cursor.execute(cmd, params + [int(limit), int(offset)]).fetchall()
+
+    def rows_changed_since(self, table: str, select: list[str], since: int, upto: int, limit: int) -> list[tuple]:
+        """ the rows of the revisions (since, upto] in the revision order, the revision is the last column """
+        self.check_columns(table, select)
+        return self.cursor.execute(
+            f"SELECT {', '.join(select)}, revision FROM {table} WHERE revision > ? AND revision <= ? "
+            f"ORDER BY revision LIMIT ?", (since, upto, limit)
+        ).fetchall()
+
+    def rows_created_since(self, table: str, since: int, upto: int) -> list[str]:
+        """ the keys of the rows of the revisions (since, upto] inserted after the since revision """
+        key = FEED_TABLES[table]
+        return [row_key for row_key, in self.cursor.execute(
+            f"SELECT {key} FROM {table} WHERE revision > ? AND revision <= ? AND created_revision > ?",
+            (since, upto, since)
+        ).fetchall()]
+
+    def hosts_in_range(self, select: list[str], first: int, last: int) -> list[tuple]:
+        """ the hosts of the numeric addresses [first, last] in the address order - the ip_num index range scan """
+        self.check_columns('hosts', select)
+        return self.cursor.execute(
+            f"SELECT {', '.join(select)} FROM hosts WHERE ip_num BETWEEN ? AND ? ORDER BY ip_num", (first, last)
+        ).fetchall()
 
     def get_table_header(self, table):
         return [cl for ind, cl, *rest in self.cursor.execute(f'PRAGMA table_info({table})').fetchall()]
@@ -120,21 +406,88 @@ class SqlConnection:
     def get_hosts_ordered_header():
         return cfg.hosts_names_str.split(',')
 
-    def delete_row(self, table, sql_filter) -> None:
-        cmd: str = f'DELETE FROM {table} WHERE {sql_filter}'
-        log.debug(cmd)
-        self.cursor.execute(cmd)
+    def delete_row(self, table, key: dict) -> None:
+        self.check_columns(table, key)
+        cmd: str = f"DELETE FROM {table} WHERE {' AND '.join(f'{col}=?' for col in key)}"
+        log.debug(f'{cmd} {[*key.values()]}')
+        self.cursor.execute(cmd, [*key.values()])
         self.conn.commit()
 
     def delete_host(self, ipv4) -> None:
-        self.delete_row('hosts', f'ipv4="{ipv4}"')
+        self.execute('host_delete', (ipv4,))
+        self.conn.commit()
 
     def __del__(self):
         if self.conn:
-            self.conn.close()
+            try:
+                self.conn.close()
+            except sqlite3.ProgrammingError:
+                # a pooled connection released by another thread
+                pass
+
+
+class HostsUpdateWriter:
+    """ collects the hosts columns updates and writes them in one transaction
+    per `batch_size` updates or when `flush_interval` seconds passed since the last write
+    """
+
+    def __init__(self, sql: SqlConnection, batch_size: Optional[int] = None, flush_interval: Optional[float] = None):
+        self.sql = sql
+        self.batch_size = batch_size or cfg.hosts_write_batch
+        self.flush_interval = flush_interval or cfg.hosts_write_interval
+        self.pending: list[tuple[str, dict]] = []
+        self.last_flush = time.monotonic()
+        self.written = 0
+
+    def add(self, ipv4: str, fields: dict) -> None:
+        self.pending.append((ipv4, fields))
+        if len(self.pending) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> int:
+        """ write the pending updates
+        :return: number of the updated hosts
+        """
+        self.last_flush = time.monotonic()
+        if not self.pending:
+            return 0
+        updated = self.sql.update_hosts_fields(self.pending)
+        if updated < len(self.pending):
+            log.error(f'{len(self.pending) - updated} of {len(self.pending)} hosts updates did not find the host')
+        log.debug(f'{updated} hosts updated')
+        self.written += updated
+        self.pending.clear()
+        return updated
+
+
+@contextmanager
+def sqlite_metrics(statement: str) -> Iterator[None]:
+    """ the named statement time (the busy handler lock waits included) and the lock failures """
+    start_time = time.perf_counter()
+    try:
+        yield
+    except sqlite3.OperationalError as err:
+        if 'locked' in str(err):
+            metrics.inc('sqlite_locked_total', statement=statement)
+        raise
+    finally:
+        metrics.observe('sqlite_statement_seconds', time.perf_counter() - start_time, statement=statement)
+
+
+def get_sql_connection(db=None) -> SqlConnection:
+    """ the long-lived connection of the current thread (the web server handlers) """
+    db = db or cfg.db_file
+    connections: dict = _thread_local.__dict__.setdefault('connections', {})
+    if str(db) not in connections:
+        connections[str(db)] = SqlConnection(db)
+    return connections[str(db)]
 
 
-def remove_bad_symbols(my_str):
-    for char in [';', ':', '!', '*', "'", '&', '"', ',', '%']:
-        my_str = my_str.replace(char, '')
-    return my_str
+@lru_cache(maxsize=None)
+def host_upsert_statement(keys: tuple[str, ...]) -> str:
+    """ the hosts upsert statement that overwrites only the supplied columns of an existing host """
+    if unknown := [key for key in keys if key not in cfg.sql_fields]:
+        raise ValueError(f'Unknown hosts columns: {unknown}')
+    update_str = ', '.join([f'{key}=excluded.{key}' for key in keys if key != 'ipv4'] + ['updated=excluded.updated'])
+    return (f"INSERT INTO hosts ({', '.join(HOSTS_INSERT_COLUMNS)}, updated) "
+            f"VALUES ({', '.join('?' * (len(HOSTS_INSERT_COLUMNS) + 1))}) ON CONFLICT(ipv4) DO UPDATE SET {update_str}")
@@ -0,0 +1,270 @@
+"""
+versioned schema migrations of the net_scan_data.db
+the migrations run in order at the SqlConnection start, the applied versions are kept in the schema_version table
+"""
+import sys
+import sqlite3
+import logging
+from datetime import datetime
+from typing import Callable
+
+from configuration import Config as cfg
+
+log = logging.getLogger('sql_migrations')
+
+
+def sync_hosts_columns(cursor: sqlite3.Cursor) -> list[str]:
+    """ add the cfg.sql_fields columns that are missing in the existing hosts table
+    :return: the added columns
+    """
+    existing = {column for _, column, *_ in cursor.execute('PRAGMA table_info(hosts)').fetchall()}
+    added = []
+    for key in cfg.sql_fields:
+        if key in existing:
+            continue
+        column_type = cfg.sql_fields[key].replace('primary key', '').strip()
+        if column_type != 'int':
+            column_type += f" DEFAULT '{cfg.fields_defaults.get(key, '')}'"
+        log.info(f'Add column "{key} {column_type}" to the hosts table')
+        cursor.execute(f'ALTER TABLE hosts ADD COLUMN {key} {column_type}')
+        added.append(key)
+    return added
+
+
+# the tables of the live change feed and their key columns
+FEED_TABLES: dict[str, str] = {'hosts': 'ipv4', 'b_networks': 'network'}
+# the changes of these columns do not bump the revision: the refresher rewrites 'updated' of every polled host,
+# the feed would resend the whole hosts table after every liveness pass
+# the revision of the last change and the revision of the insert of the row
+FEED_COLUMNS: tuple[str, ...] = ('revision', 'created_revision')
+REVISION_IGNORED_COLUMNS: set[str] = {'updated', *FEED_COLUMNS}
+
+
+def create_revision_triggers(cursor: sqlite3.Cursor) -> None:
+    """ (re)create the triggers that stamp the inserted and changed rows of FEED_TABLES with the next revision
+    and keep a tombstone of the deleted rows, the update trigger compares the current columns of the table
+    """
+    bump = "UPDATE revision_seq SET value = value + 1 WHERE name = 'rows';"
+    revision = "(SELECT value FROM revision_seq WHERE name = 'rows')"
+    for table, key in FEED_TABLES.items():
+        all_columns = [column for _, column, *_ in cursor.execute(f'PRAGMA table_info({table})').fetchall()]
+        columns = [column for column in all_columns if column not in REVISION_IGNORED_COLUMNS]
+        changed = ' OR '.join(f'NEW.{column} IS NOT OLD.{column}' for column in columns)
+        # the creation revision - since the migration 12
+        created = 'created_revision' in all_columns
+        stamp = f'UPDATE {table} SET revision = {revision} WHERE rowid = NEW.rowid;'
+        insert_stamp = (f'UPDATE {table} SET revision = {revision}, created_revision = {revision} '
+                        f'WHERE rowid = NEW.rowid;') if created else stamp
+        for event in ('insert', 'update', 'delete'):
+            cursor.execute(f'DROP TRIGGER IF EXISTS {table}_revision_{event}')
+        cursor.execute(
+            f'CREATE TRIGGER {table}_revision_insert AFTER INSERT ON {table} BEGIN {bump} {insert_stamp} '
+            f"DELETE FROM row_tombstones WHERE tbl = '{table}' AND row_key = NEW.{key}; END"
+        )
+        # the stamp does not change the other columns - the revision check stops the recursion
+        cursor.execute(
+            f'CREATE TRIGGER {table}_revision_update AFTER UPDATE ON {table} '
+            f'WHEN NEW.revision IS OLD.revision AND ({changed}) BEGIN {bump} {stamp} END'
+        )
+        # the tombstone keeps the creation revision - the rows inserted and deleted after the client revision
+        # are unknown to the client
+        cursor.execute(
+            f'CREATE TRIGGER {table}_revision_delete AFTER DELETE ON {table} BEGIN {bump} '
+            f'INSERT OR REPLACE INTO row_tombstones (tbl, row_key, revision, deleted{", created" if created else ""}) '
+            f"VALUES ('{table}', OLD.{key}, {revision}, (julianday('now') - 2440587.5) * 86400"
+            f"{', OLD.created_revision' if created else ''}); END"
+        )
+
+
+def add_revisions(cursor: sqlite3.Cursor) -> None:
+    cursor.execute('CREATE TABLE IF NOT EXISTS revision_seq (name char(10) primary key, value integer)')
+    # 'rows' - the last revision, 'tombstones' - the last revision of the expired tombstones
+    cursor.execute("INSERT OR IGNORE INTO revision_seq (name, value) VALUES ('rows', 0), ('tombstones', 0)")
+    cursor.execute('CREATE TABLE IF NOT EXISTS row_tombstones (tbl char(20), row_key char(40), revision integer, '
+                   'deleted real, PRIMARY KEY (tbl, row_key))')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_row_tombstones_revision ON row_tombstones (tbl, revision)')
+    for table in FEED_TABLES:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN revision integer DEFAULT 0')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_revision ON {table} (revision)')
+    create_revision_triggers(cursor)
+
+
+def add_created_revisions(cursor: sqlite3.Cursor) -> None:
+    """ the revision of the insert of the rows: the feed tells the new rows from the changed ones,
+    the existing rows are older than any client revision
+    """
+    cursor.execute('ALTER TABLE row_tombstones ADD COLUMN created integer DEFAULT 0')
+    for table in FEED_TABLES:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN created_revision integer DEFAULT 0')
+    create_revision_triggers(cursor)
+
+
+# the grid tables without the rows revisions, their writes bump the 'tables' counter of the web pages cache
+VERSIONED_TABLES: tuple[str, ...] = ('alive_networks', 'applications', 'os_cache_stats')
+
+
+def add_tables_version(cursor: sqlite3.Cursor) -> None:
+    """ the 'tables' counter of revision_seq grows with the writes of the grid data that do not bump the revision """
+    bump = "UPDATE revision_seq SET value = value + 1 WHERE name = 'tables';"
+    cursor.execute("INSERT OR IGNORE INTO revision_seq (name, value) VALUES ('tables', 0)")
+    for table in VERSIONED_TABLES:
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            cursor.execute(f'CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()} AFTER {event} ON {table} '
+                           f'BEGIN {bump} END')
+    cursor.execute('CREATE TRIGGER IF NOT EXISTS hosts_version_updated AFTER UPDATE OF updated ON hosts '
+                   f'WHEN NEW.updated IS NOT OLD.updated AND NEW.revision IS OLD.revision BEGIN {bump} END')
+
+
+def ip_num_sql(ip: str) -> str:
+    """ the SQL expression of the integer value of the dotted IPv4 text expression, NULL if it is not an address """
+    octets = []
+    rest = ip
+    for _ in range(3):
+        octets.append(f"CAST(substr({rest}, 1, instr({rest}, '.') - 1) AS integer)")
+        rest = f"substr({rest}, instr({rest}, '.') + 1)"
+    octets.append(f'CAST({rest} AS integer)')
+    # four dot separated digit groups only, every one of them an octet
+    is_address = (f"{ip} GLOB '[0-9]*.[0-9]*.[0-9]*.[0-9]*' AND {ip} NOT GLOB '*.*.*.*.*' "
+                  f"AND {ip} NOT GLOB '*[^0-9.]*' AND " + ' AND '.join(f'{octet} <= 255' for octet in octets))
+    return (f"CASE WHEN {is_address} THEN "
+            f"(({octets[0]} * 256 + {octets[1]}) * 256 + {octets[2]}) * 256 + {octets[3]} END")
+
+
+# (version, description, SQL statements or a function of the cursor)
+MIGRATIONS: list[tuple[int, str, list[str] | Callable[[sqlite3.Cursor], object]]] = [
+    (1, 'indexes of the refresher, AUDC plugin and DHCP duplicate queries', [
+        'CREATE INDEX IF NOT EXISTS idx_hosts_status ON hosts (status)',
+        'CREATE INDEX IF NOT EXISTS idx_hosts_scanned ON hosts (scanned)',
+        'CREATE INDEX IF NOT EXISTS idx_hosts_type_status_http ON hosts (type, status, http)',
+        'CREATE INDEX IF NOT EXISTS idx_hosts_name_domain ON hosts (name, domain, status)',
+    ]),
+    (2, 'hosts columns added to Config.sql_fields', sync_hosts_columns),
+    (3, 'alive_networks scan history of the scheduler', [
+        'ALTER TABLE alive_networks ADD COLUMN last_scan real',
+        'ALTER TABLE alive_networks ADD COLUMN prev_hosts integer',
+        'ALTER TABLE alive_networks ADD COLUMN churn integer',
+        'ALTER TABLE alive_networks ADD COLUMN empty_scans integer',
+        'ALTER TABLE alive_networks ADD COLUMN next_scan real',
+    ]),
+    (4, 'OS fingerprint cache', [
+        'CREATE TABLE IF NOT EXISTS os_cache (ipv4 char(17) primary key, mac char(12), ports char(64), os char(32), '
+        'checked real)',
+        'CREATE TABLE IF NOT EXISTS os_cache_stats (name char(20) primary key, value real)',
+    ]),
+    (5, 'plugins probe state', [
+        'CREATE TABLE IF NOT EXISTS probe_state (plugin char(20), ipv4 char(17), result char(20), failures integer, '
+        'checked real, next_eligible real, signature char(100), PRIMARY KEY (plugin, ipv4))',
+    ]),
+    (6, 'metrics of the processes', [
+        'CREATE TABLE IF NOT EXISTS metrics (name char(64), labels char(128), value real, PRIMARY KEY (name, labels))',
+    ]),
+    (7, 'hosts availability history', [
+        'CREATE TABLE IF NOT EXISTS host_transitions (ipv4 char(17), at real, status char(6))',
+        'CREATE INDEX IF NOT EXISTS idx_host_transitions_ipv4_at ON host_transitions (ipv4, at)',
+        'CREATE INDEX IF NOT EXISTS idx_host_transitions_at ON host_transitions (at)',
+        'CREATE TABLE IF NOT EXISTS host_availability (ipv4 char(17), period char(1), bucket integer, '
+        'up_seconds real, down_seconds real, transitions integer, last_status char(6), '
+        'PRIMARY KEY (ipv4, period, bucket))',
+        'CREATE TABLE IF NOT EXISTS history_state (name char(10) primary key, value real)',
+    ]),
+    (8, 'rows revisions and tombstones of the live change feed', add_revisions),
+    (9, 'grid tables version of the web pages cache', add_tables_version),
+    # a generated column - computed by SQLite on every write, the other DB clients need no function or trigger
+    (10, 'numeric IP of the hosts', [
+        f'ALTER TABLE hosts ADD COLUMN ip_num integer GENERATED ALWAYS AS ({ip_num_sql("ipv4")}) VIRTUAL',
+        'CREATE INDEX IF NOT EXISTS idx_hosts_ip_num ON hosts (ip_num)',
+        # the per C network AUDC counts read ip_num from the index instead of computing it
+        'CREATE INDEX IF NOT EXISTS idx_hosts_type_status_ip_num ON hosts (type, status, ip_num)',
+    ]),
+    # a generated column expression cannot be altered, the column and its indexes are rebuilt
+    (11, 'NULL numeric IP of the malformed hosts addresses', [
+        'DROP INDEX IF EXISTS idx_hosts_ip_num',
+        'DROP INDEX IF EXISTS idx_hosts_type_status_ip_num',
+        'ALTER TABLE hosts DROP COLUMN ip_num',
+        f'ALTER TABLE hosts ADD COLUMN ip_num integer GENERATED ALWAYS AS ({ip_num_sql("ipv4")}) VIRTUAL',
+        'CREATE INDEX IF NOT EXISTS idx_hosts_ip_num ON hosts (ip_num)',
+        'CREATE INDEX IF NOT EXISTS idx_hosts_type_status_ip_num ON hosts (type, status, ip_num)',
+    ]),
+    (12, 'rows creation revisions of the live change feed', add_created_revisions),
+]
+
+# the hot queries and their parameters - every one should be answered with an index
+HOT_QUERIES: dict[str, tuple[str, tuple]] = {
+    'hosts in subnet': ('SELECT ipv4 FROM hosts WHERE ip_num BETWEEN ? AND ?', (0, 0)),
+    'refresher not scanned': ('SELECT ipv4 FROM hosts WHERE scanned=0', ()),
+    'refresher hosts': ('SELECT ipv4 FROM hosts WHERE status="up" OR status="down"', ()),
+    'dhcp duplicates': (
+        "SELECT 1 FROM hosts d WHERE d.name=? AND d.domain=? AND d.type <> 'AUDC' AND d.status='up' AND d.ipv4 <> ?",
+        ('', '', '')
+    ),
+    'audc old hw': (
+        "SELECT ipv4,username,password FROM hosts WHERE "
+        "(status='up' AND http='ok' and os='embedded' and type='AUDC')", ()
+    ),
+    'audc filter': (
+        "SELECT ipv4,username,password FROM hosts WHERE "
+        f"(status='up' AND http='ok' and {cfg.filter_os_for_AUDC_scan} and type='' or type='AUDC')", ()
+    ),
+}
+
+
+def get_schema_version(cursor: sqlite3.Cursor) -> int:
+    cursor.execute('CREATE TABLE IF NOT EXISTS schema_version (version integer primary key, description char(100), '
+                   'applied date)')
+    return cursor.execute('SELECT max(version) FROM schema_version').fetchone()[0] or 0
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """ apply the missing migrations, every migration is applied in its own transaction
+    the hosts columns are synced with cfg.sql_fields on every run, the revision triggers follow the added columns
+    :return: the schema version
+    """
+    cursor = conn.cursor()
+    version = get_schema_version(cursor)
+    conn.commit()
+    for mig_version, description, migration in MIGRATIONS:
+        if mig_version <= version:
+            continue
+        log.info(f'Apply DB migration {mig_version}: {description}')
+        with conn:
+            if callable(migration):
+                migration(cursor)
+            else:
+                for cmd in migration:
+                    log.debug(cmd)
+                    cursor.execute(cmd)
+            cursor.execute(
+                'INSERT INTO schema_version (version, description, applied) VALUES (?, ?, ?)',
+                (mig_version, description, datetime.now().strftime("%Y-%b-%d %H:%M:%S"))
+            )
+        version = mig_version
+    if version >= 2:
+        with conn:
+            if sync_hosts_columns(cursor) and version >= 8:
+                create_revision_triggers(cursor)
+    return version
+
+
+def check_query_plans(cursor: sqlite3.Cursor) -> dict[str, list[str]]:
+    """ EXPLAIN QUERY PLAN of the hot queries
+    :return: the plans of the queries that scan the hosts table instead of using an index
+    """
+    bad_plans = {}
+    for name, (query, params) in HOT_QUERIES.items():
+        plan = [detail for *_, detail in cursor.execute(f'EXPLAIN QUERY PLAN {query}', params).fetchall()]
+        log.debug(f'{name}: {plan}')
+        if any(detail.startswith('SCAN') for detail in plan):
+            bad_plans[name] = plan
+    return bad_plans
+
+
+if __name__ == '__main__':
+    # apply the migrations and check that the hot queries use indexes
+    logging.basicConfig(level=logging.INFO)
+    from sql_connection import SqlConnection
+    sql = SqlConnection(*sys.argv[1:2])
+    if bad := check_query_plans(sql.cursor):
+        for query_name, query_plan in bad.items():
+            log.error(f'The "{query_name}" query does not use an index: {query_plan}')
+        sys.exit(1)
+    log.info(f'All the {len(HOT_QUERIES)} hot queries use indexes')
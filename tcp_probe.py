@@ -0,0 +1,122 @@
+"""
+pure python asyncio TCP connect probes - the native alternative to nmap for the ports check and the liveness sweeps
+the nmap is still needed for the OS detection
+"""
+import asyncio
+import logging
+from typing import Optional
+
+from configuration import Config
+
+log = logging.getLogger('tcp_probe')
+
+
+def check_ports() -> dict[int, str]:
+    """ the TCP ports of Config.check_ports_dict: {port: hosts table column} """
+    return {int(key[2:]): name for key, name in Config.check_ports_dict.items() if key.startswith('T:')}
+
+
+async def probe_port(ip: str, port: int, timeout: float) -> Optional[bool]:
+    """ TCP connect probe
+    :return: True - open, False - closed (the host answered with reset), None - no answer
+    """
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout)
+    except ConnectionRefusedError:
+        return False
+    except (asyncio.TimeoutError, OSError):
+        return None
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return True
+
+
+async def probe_host(
+        ip: str,
+        ports: tuple[int, ...],
+        semaphore: asyncio.Semaphore,
+        timeout: float,
+        host_timeout: float,
+) -> tuple[str, dict[int, Optional[bool]]]:
+    async with semaphore:
+        try:
+            states = await asyncio.wait_for(
+                asyncio.gather(*(probe_port(ip, port, timeout) for port in ports)), host_timeout
+            )
+        except asyncio.TimeoutError:
+            states = [None] * len(ports)
+    return ip, dict(zip(ports, states))
+
+
+async def probe_hosts_async(
+        targets: dict[str, tuple[int, ...]],
+        concurrency: int,
+        timeout: float,
+        host_timeout: float,
+) -> dict[str, dict[int, Optional[bool]]]:
+    semaphore = asyncio.Semaphore(concurrency)
+    results = await asyncio.gather(
+        *(probe_host(ip, ports, semaphore, timeout, host_timeout) for ip, ports in targets.items())
+    )
+    return dict(results)
+
+
+def probe_hosts(
+        targets: dict[str, tuple[int, ...]],
+        concurrency: Optional[int] = None,
+        timeout: Optional[float] = None,
+        host_timeout: Optional[float] = None,
+) -> dict[str, dict[int, Optional[bool]]]:
+    """ probe the ports of the hosts with bounded concurrency
+    :param targets: {ip: ports}
+    :param concurrency: hosts probed at the same time
+    :param timeout: connect timeout
+    :param host_timeout: timeout of all the ports of a host
+    :return: {ip: {port: state}}, see probe_port
+    """
+    return asyncio.run(probe_hosts_async(
+        targets,
+        concurrency or Config.native_probe_concurrency,
+        timeout or Config.native_probe_timeout,
+        host_timeout or Config.native_host_timeout,
+    ))
+
+
+def native_port_scan(ips: list[str], hostname: str = '') -> list[dict]:
+    """ probe Config.check_ports_dict ports of the ips
+    :return: hosts records for the hosts that answered (the process_nmap_res format)
+    """
+    ports = check_ports()
+    records = []
+    for ip, states in probe_hosts({ip: tuple(ports) for ip in ips}).items():
+        if all(state is None for state in states.values()):
+            continue
+        host_obj = dict(ipv4=hostname if hostname else ip)
+        for port, state in states.items():
+            if state:
+                host_obj[ports[port]] = 'ok'
+        host_obj['status'] = 'up'
+        host_obj['scanned'] = '1'
+        log.info(host_obj)
+        records.append(host_obj)
+    log.info(f'Found {len(records)} hosts of {len(ips)} probed')
+    return records
+
+
+def native_liveness(sql, ips: list[str]) -> set[str]:
+    """ liveness check with the ports known to be open for every host (all the checked ports if none is known),
+    a closed port answer means the host is alive too
+    :return: alive ips, the hosts that did not answer should be checked by nmap (ICMP)
+    """
+    ports = check_ports()
+    known_open: dict[str, tuple[int, ...]] = {}
+    for ipv4, *states in sql.cursor.execute(
+            f"SELECT ipv4, {', '.join(ports.values())} FROM hosts").fetchall():
+        known_open[ipv4] = tuple(port for port, state in zip(ports, states) if state == 'ok')
+    targets = {ip: known_open.get(ip) or tuple(ports) for ip in ips}
+    alive = {ip for ip, states in probe_hosts(targets).items() if any(state is not None for state in states.values())}
+    log.info(f'Found {len(alive)} alive hosts of {len(ips)} probed')
+    return alive
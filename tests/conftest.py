@@ -0,0 +1,17 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from configuration import Config
+from sql_connection import SqlConnection
+
+
+@pytest.fixture
+def sql(tmp_path, monkeypatch) -> SqlConnection:
+    """ a connection to a new migrated DB """
+    monkeypatch.setattr(Config, 'db_file', tmp_path / 'net_scan_data.db')
+    connection = SqlConnection()
+    yield connection
+    connection.conn.close()
@@ -0,0 +1,41 @@
+from plugins.audc_scanner import parse_software_version_page
+
+# the cells of the old HW /SoftwareVersion page sample of the module
+SAMPLE_ROWS = [
+    ('MAC Address', '00908f584979'),
+    ('Serial Number', '5785977'),
+    ('Board Type', '56'),
+    ('Device Up Time', '0d 5h 41m 12s 90th'),
+    ('Device Administrative State', 'Unlocked'),
+    ('Device Operational State', 'Enabled'),
+    ('Flash Size [bytes]', '8388608'),
+    ('RAM Size [bytes]', '33554432'),
+    ('CPU Speed [MHz]', '40'),
+    ('Version ID', '5.00.054.001'),
+    ('DSP Type', '0'),
+    ('DSP Software Version', '20922'),
+    ('DSP Software Name', '204IM'),
+    ('Flash Version', '199'),
+]
+
+
+def sample_page() -> str:
+    rows = ''.join(f'<tr><td>&nbsp;{name}&nbsp;</td><td>{value}&nbsp;</td></tr>\n' for name, value in SAMPLE_ROWS)
+    return (f'<html><body><h2>Device Information</h2><table><tr><th>General</th></tr>\n{rows}'
+            f'<tr><th>Loaded Files</th></tr><tr><td>Call Progress Tones File Name </td>'
+            f'<td>test_fxo_progress.dat</td></tr></table></body></html>')
+
+
+def test_parse_software_version_page():
+    assert parse_software_version_page(sample_page()) == {
+        'MAC Address': '00908f584979',
+        'Serial Number': '5785977',
+        'Board Type': '56',
+        'Device Up Time': '0d 5h 41m 12s 90th',
+        'Version ID': '5.00.054.001',
+    }
+
+
+def test_parse_name_and_value_in_one_cell():
+    page = '<table><tr><td>Version ID: 7.20A.258</td><td>Serial Number:</td><td>123</td></tr></table>'
+    assert parse_software_version_page(page) == {'Version ID': '7.20A.258', 'Serial Number': '123'}
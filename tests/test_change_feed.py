@@ -0,0 +1,93 @@
+import time
+
+import pytest
+
+import change_feed
+from configuration import Config
+
+SELECT = ['ipv4', 'name', 'status']
+
+
+@pytest.fixture
+def hosts(sql):
+    sql.bulk_upsert_hosts([{'ipv4': f'10.0.0.{i}', 'name': f'host{i}', 'status': 'up'} for i in range(1, 4)])
+    return sql
+
+
+def test_inserted_rows(hosts):
+    changes = change_feed.changes_since(hosts, 'hosts', SELECT, 0)
+    assert changes['revision'] == change_feed.current_revision(hosts) == 3
+    assert [row[:3] for row in changes['rows']] == [(f'10.0.0.{i}', f'host{i}', 'up') for i in range(1, 4)]
+    assert changes['inserted'] == [f'10.0.0.{i}' for i in range(1, 4)]
+    assert changes['deleted'] == [] and not changes['reset']
+
+
+def test_changed_and_deleted_rows(hosts):
+    since = change_feed.current_revision(hosts)
+    hosts.update_host_fields('10.0.0.2', {'status': 'down'})
+    hosts.delete_host('10.0.0.3')
+    changes = change_feed.changes_since(hosts, 'hosts', SELECT, since)
+    assert changes['rows'] == [('10.0.0.2', 'host2', 'down', since + 1)]
+    assert changes['inserted'] == []
+    assert changes['deleted'] == ['10.0.0.3']
+    assert changes['revision'] == since + 2
+    assert change_feed.changes_since(hosts, 'hosts', SELECT, changes['revision']) == dict(
+        revision=since + 2, rows=[], inserted=[], deleted=[], reset=False)
+
+
+def test_unchanged_values_and_updated_stamp_keep_the_revision(hosts):
+    since = change_feed.current_revision(hosts)
+    version = change_feed.tables_version(hosts)
+    hosts.update_host_fields('10.0.0.1', {'status': 'up'})
+    hosts.update_host_fields('10.0.0.1', {'updated': '2026-Oct-18 10:00:00'})
+    assert change_feed.current_revision(hosts) == since
+    # the grid pages cache still sees the updated stamp
+    assert change_feed.tables_version(hosts) > version
+
+
+def test_reinserted_row_drops_its_tombstone(hosts):
+    since = change_feed.current_revision(hosts)
+    hosts.delete_host('10.0.0.1')
+    hosts.bulk_upsert_hosts([{'ipv4': '10.0.0.1', 'name': 'host1', 'status': 'up'}])
+    changes = change_feed.changes_since(hosts, 'hosts', SELECT, since)
+    assert [row[0] for row in changes['rows']] == ['10.0.0.1']
+    assert changes['deleted'] == []
+
+
+def test_inserted_and_changed_rows(hosts):
+    since = change_feed.current_revision(hosts)
+    hosts.bulk_upsert_hosts([{'ipv4': '10.0.0.4', 'name': 'host4', 'status': 'up'},
+                             {'ipv4': '10.0.0.1', 'name': 'host1', 'status': 'down'}])
+    changes = change_feed.changes_since(hosts, 'hosts', SELECT, since)
+    assert sorted(row[0] for row in changes['rows']) == ['10.0.0.1', '10.0.0.4']
+    assert changes['inserted'] == ['10.0.0.4']
+
+
+def test_row_inserted_and_deleted_after_the_client_revision(hosts):
+    since = change_feed.current_revision(hosts)
+    hosts.bulk_upsert_hosts([{'ipv4': '10.0.0.4', 'name': 'host4', 'status': 'up'}])
+    hosts.delete_host('10.0.0.4')
+    hosts.delete_host('10.0.0.1')
+    changes = change_feed.changes_since(hosts, 'hosts', SELECT, since)
+    assert changes['rows'] == [] and changes['inserted'] == []
+    # the client never had the new row
+    assert changes['deleted'] == ['10.0.0.1']
+
+
+def test_batches(hosts, monkeypatch):
+    monkeypatch.setattr(Config, 'feed_batch', 2)
+    first = change_feed.changes_since(hosts, 'hosts', SELECT, 0)
+    assert [row[0] for row in first['rows']] == ['10.0.0.1', '10.0.0.2'] and first['revision'] == 2
+    second = change_feed.changes_since(hosts, 'hosts', SELECT, first['revision'])
+    assert [row[0] for row in second['rows']] == ['10.0.0.3'] and second['revision'] == 3
+
+
+def test_expired_tombstones_reset_the_clients_behind_them(hosts):
+    since = change_feed.current_revision(hosts)
+    hosts.delete_host('10.0.0.1')
+    assert change_feed.expire_tombstones(hosts) == 0
+    assert change_feed.expire_tombstones(hosts, now=time.time() + Config.feed_tombstones_days * 86400 + 60) == 1
+    assert change_feed.changes_since(hosts, 'hosts', SELECT, since)['reset']
+    # the clients after the expired tombstones and the clients of another DB
+    assert not change_feed.changes_since(hosts, 'hosts', SELECT, since + 1)['reset']
+    assert change_feed.changes_since(hosts, 'hosts', SELECT, since + 100)['reset']
@@ -0,0 +1,66 @@
+import pytest
+
+import history
+from refresher import reconcile_hosts_status
+
+# a day start
+T0 = 1_699_920_000.0
+IP = '10.0.1.44'
+
+
+@pytest.fixture
+def flapping(sql):
+    """ the host is up at T0, down at T0 + 30 min and up again at T0 + 90 min """
+    sql.cursor.execute("INSERT INTO hosts (ipv4, owner) VALUES (?, 'lab')", (IP,))
+    sql.conn.commit()
+    for at, alive in ((T0, {IP}), (T0 + 60, {IP}), (T0 + 1800, set()), (T0 + 5400, {IP}), (T0 + 5460, {IP})):
+        reconcile_hosts_status(sql, {IP}, alive, 'now', now=at)
+    return sql
+
+
+def test_split_to_buckets():
+    assert history.split_to_buckets('up', [(T0 + 1800, 'down'), (T0 + 5400, 'up')], T0, T0 + 7200, 3600) == {
+        T0: [1800, 1800, 1, 'down'],
+        T0 + 3600: [1800, 1800, 1, 'up'],
+    }
+
+
+def test_split_to_buckets_unknown_state():
+    # the time before the first observation is not counted and the observation is not a change
+    assert history.split_to_buckets(None, [(T0 + 1800, 'up')], T0, T0 + 3600, 3600) == {T0: [1800, 0, 0, 'up']}
+
+
+def test_only_changes_are_recorded(flapping):
+    rows = flapping.execute('host_transitions_of', (IP, 0, T0 + 86400)).fetchall()
+    assert rows == [(T0, 'up'), (T0 + 1800, 'down'), (T0 + 5400, 'up')]
+
+
+def test_rollup(flapping):
+    now = T0 + 3 * 3600 + 10
+    # the buckets with the changes only, the idle third hour keeps the state of the second one
+    assert history.rollup(flapping, 'h', now) == 2
+    assert flapping.execute('host_availability_of', (IP, 'h', T0, now)).fetchall() == [
+        (T0, 1800, 1800, 1, 'down'),
+        (T0 + 3600, 1800, 1800, 1, 'up'),
+    ]
+    # the completed buckets are not rolled up again
+    assert history.rollup(flapping, 'h', now + 60) == 0
+
+
+def test_availability_of_raw_transitions(flapping):
+    now = T0 + 3 * 3600
+    assert history.availability(flapping, IP, T0, now, now) == dict(
+        up=7200, down=3600, transitions=2, uptime=pytest.approx(200 / 3))
+
+
+def test_availability_after_compaction(flapping):
+    now = T0 + 10 * 86400
+    history.maintain(flapping, now)
+    # the expired transitions are deleted except the last one of the host
+    assert flapping.execute('host_transitions_of', (IP, 0, now)).fetchall() == [(T0 + 5400, 'up')]
+    assert flapping.execute('host_availability_of', (IP, 'd', T0, now)).fetchall() == [(T0, 82800, 3600, 2, 'up')]
+    # the hourly buckets answer the same as the raw transitions did
+    assert history.availability(flapping, IP, T0, T0 + 3 * 3600, now) == dict(
+        up=7200, down=3600, transitions=2, uptime=pytest.approx(200 / 3))
+    assert history.state_at(flapping, IP, T0 + 3600) == 'down'
+    assert history.state_at(flapping, IP, now) == 'up'
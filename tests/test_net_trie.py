@@ -0,0 +1,84 @@
+import random
+import ipaddress
+
+import pytest
+
+from net_trie import PrefixTrie, NetworkScope
+
+
+def random_networks(rng: random.Random, count: int) -> list[ipaddress.IPv4Network]:
+    # the networks are crowded into 10.0.0.0/16 to get the overlapping and the adjacent ones
+    return [ipaddress.IPv4Network((0x0A000000 | rng.getrandbits(16), rng.randint(16, 32)), strict=False)
+            for _ in range(count)]
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_networks_are_collapsed(seed):
+    networks = random_networks(random.Random(seed), 200)
+    assert [*PrefixTrie(networks).networks()] == [*ipaddress.collapse_addresses(networks)]
+
+
+def test_adjacent_halves_are_collapsed():
+    trie = PrefixTrie(['10.0.0.0/25', '10.0.0.128/25', '10.0.1.0/24'])
+    assert [*trie.networks()] == [ipaddress.IPv4Network('10.0.0.0/23')]
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_covers_and_overlaps(seed):
+    rng = random.Random(seed)
+    networks = random_networks(rng, 50)
+    trie = PrefixTrie(networks)
+    for probe in random_networks(rng, 200):
+        assert trie.covers(probe) == any(probe.subnet_of(network) for network in networks)
+        assert trie.overlaps(probe) == any(probe.overlaps(network) for network in networks)
+
+
+def test_empty_trie():
+    trie = PrefixTrie()
+    assert not trie
+    assert not trie.covers('0.0.0.0/0')
+    assert not trie.overlaps('0.0.0.0/0')
+    assert '10.0.0.1' not in trie
+
+
+def test_default_route():
+    trie = PrefixTrie(['10.0.0.0/8', '0.0.0.0/0'])
+    assert [*trie.networks()] == [ipaddress.IPv4Network('0.0.0.0/0')]
+    assert trie.covers('0.0.0.0/0')
+    assert trie.covers('192.168.1.0/24')
+    assert '255.255.255.255' in trie
+
+
+def test_partial_network():
+    trie = PrefixTrie(['10.0.0.0/25'])
+    assert not trie.covers('10.0.0.0/24')
+    assert trie.overlaps('10.0.0.0/24')
+    assert trie.overlaps('0.0.0.0/0')
+    assert '10.0.0.127' in trie
+    assert '10.0.0.128' not in trie
+
+
+def test_scope_without_allow_list():
+    scope = NetworkScope(deny=['10.0.0.0/25'])
+    assert not scope.excluded('192.168.1.0/24')
+    assert not scope.excluded('0.0.0.0/0')
+
+
+def test_scope_partly_allowed_network_is_excluded():
+    scope = NetworkScope(allow=['10.0.0.0/25'])
+    assert scope.excluded('10.0.0.0/24')
+    assert not scope.excluded('10.0.0.0/26')
+    assert scope.excluded('0.0.0.0/0')
+
+
+def test_scope_partly_denied_network_is_scanned():
+    scope = NetworkScope(allow=['10.0.0.0/8'], deny=['10.0.0.0/25'])
+    assert not scope.excluded('10.0.0.0/24')
+    assert scope.excluded('10.0.0.0/26')
+    assert '10.0.0.1' in scope.deny
+
+
+def test_scope_deny_all():
+    scope = NetworkScope(deny=['0.0.0.0/0'])
+    assert scope.excluded('10.0.0.0/24')
+    assert scope.excluded('0.0.0.0/0')
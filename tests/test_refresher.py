@@ -0,0 +1,22 @@
+import subprocess
+
+import pytest
+
+import refresher
+from configuration import Config
+
+
+def test_timed_out_sweep_removes_its_files(sql, tmp_path, monkeypatch):
+    tmp_folder = tmp_path / 'tmp'
+    tmp_folder.mkdir()
+
+    def timed_out_nmap(cmd, timeout, **kwargs):
+        # the partial XML result of the killed nmap
+        (tmp_folder / 'nmap_search_for_dead_3.xml').write_text('<nmaprun>')
+        raise subprocess.TimeoutExpired(cmd, timeout)
+
+    monkeypatch.setattr(Config, 'tmp_folder_path', tmp_folder)
+    monkeypatch.setattr(refresher.subprocess, 'run', timed_out_nmap)
+    with pytest.raises(subprocess.TimeoutExpired):
+        refresher.sweep_hosts(3, ['10.0.1.1', '10.0.1.2'])
+    assert [*tmp_folder.iterdir()] == []
@@ -0,0 +1,35 @@
+import scanner
+from scan_scheduler import record_scan
+from scanner import process_scan_result
+
+NETWORK = '10.0.1.0/24'
+
+
+def scan_records(count: int) -> list[dict]:
+    return [{'ipv4': f'10.0.1.{i}', 'status': 'up'} for i in range(1, count + 1)]
+
+
+def scan_history(sql) -> tuple:
+    return sql.cursor.execute('SELECT hosts, prev_hosts, churn FROM alive_networks WHERE network=?',
+                              (NETWORK,)).fetchone()
+
+
+def test_scan_result_churn(sql):
+    for count in (5, 20):
+        found = process_scan_result(sql, NETWORK, scan_records(count), 0)
+        record_scan(sql, NETWORK, found)
+    assert scan_history(sql) == (20, 5, 15)
+
+
+def test_failed_scan_is_not_recorded(sql):
+    record_scan(sql, NETWORK, process_scan_result(sql, NETWORK, scan_records(5), 0))
+    assert process_scan_result(sql, NETWORK, [], 1) == -1
+    assert scan_history(sql) == (5, 0, 5)
+
+
+def test_two_phase_port_scan_by_native_engine(sql, monkeypatch):
+    monkeypatch.setattr(scanner, 'native_port_scan', lambda ips: [{'ipv4': ips[0], 'ssh': 'ok', 'status': 'up'}])
+    monkeypatch.setattr(scanner, 'port_scan', None)
+    ips, records, returncode, os_cache_update = scanner.port_scan_worker(['10.0.1.1', '10.0.1.2'], 'native')
+    assert (returncode, os_cache_update) == (0, None)
+    assert [(host_obj['ipv4'], host_obj.get('ssh')) for host_obj in records] == [('10.0.1.1', 'ok'), ('10.0.1.2', None)]
@@ -0,0 +1,30 @@
+import pytest
+
+from sql_migrations import MIGRATIONS, check_query_plans
+
+
+def test_migrations_applied(sql):
+    version = sql.cursor.execute('SELECT max(version) FROM schema_version').fetchone()[0]
+    assert version == MIGRATIONS[-1][0]
+
+
+def test_hot_queries_use_indexes(sql):
+    assert check_query_plans(sql.cursor) == {}
+
+
+def test_dropped_index_is_reported(sql):
+    sql.cursor.execute('DROP INDEX idx_hosts_scanned')
+    assert [*check_query_plans(sql.cursor)] == ['refresher not scanned']
+
+
+@pytest.mark.parametrize('ipv4, ip_num', [
+    ('10.0.1.44', 167772460),
+    ('255.255.255.255', 4294967295),
+    ('1.2.3.4.5', None),
+    ('1.2.3.256', None),
+    ('1.2.3.4:80', None),
+    ('bad.host', None),
+])
+def test_hosts_ip_num(sql, ipv4, ip_num):
+    sql.cursor.execute('INSERT INTO hosts (ipv4) VALUES (?)', (ipv4,))
+    assert sql.cursor.execute('SELECT ip_num FROM hosts WHERE ipv4 = ?', (ipv4,)).fetchone()[0] == ip_num
@@ -3,13 +3,24 @@ from pathlib import Path
 import logging
 import ipaddress
 import json
+import time
+import gzip
+import hashlib
+import threading
+from datetime import datetime
 import re
+from collections import OrderedDict
+import functools
 from urllib.parse import unquote_plus
-from flask import (Flask, render_template, request, jsonify)
+from flask import (Flask, render_template, request, jsonify, g, Response, make_response)
 base_dir = str(Path(__file__).parent.parent)
 if base_dir not in sys.path: sys.path.append(base_dir)
 from configuration import Config
-from sql_connection import SqlConnection
+from sql_connection import SqlConnection, get_sql_connection
+import metrics
+import history
+import change_feed
+from ip_index import IpIndex
 
 logger = logging.getLogger('flask-web')
 log_file = Path(Config.log_files_path) / f'{Path(__file__).stem}.log'
@@ -20,24 +31,122 @@ show_list = ['ipv4', 'name', 'os', 'owner', 'status', 'type', 'productType', 've
 search_params = ['ipv4', 'name', 'os', 'owner', 'status', 'type', 'version', 'HA', 'productType', 'updated', ]
 
 params_attr = {
-    'ipv4': "size: '120px', style: 'font-weight: bold;  color: blue', info: true,",
-    'name': "size: '150px',",
-    'updated': "size: '150px',",
-    'type': "size: '60px',",
-    'os': "size: '100px',",
-    'owner': "size: '100px', editable: {type: 'text'},",
-    'status': "size: '50px',",
-    'productType': "size: '100px',",
-    'version': "size: '100px',",
-    'rdp': "size: '40px', attr: 'align=center',",
-    'ssh': "size: '40px', attr: 'align=center',",
-    'http': "size: '40px', attr: 'align=center',",
-    'https': "size: '50px', attr: 'align=center',",
-    'description': "size: '120px', attr: 'align=left', editable: {type: 'text'},",
+    'ipv4': {'size': '120px', 'style': 'font-weight: bold;  color: blue', 'info': True},
+    'name': {'size': '150px'},
+    'updated': {'size': '150px'},
+    'type': {'size': '60px'},
+    'os': {'size': '100px'},
+    'owner': {'size': '100px', 'editable': {'type': 'text'}},
+    'status': {'size': '50px'},
+    'productType': {'size': '100px'},
+    'version': {'size': '100px'},
+    'rdp': {'size': '40px', 'attr': 'align=center'},
+    'ssh': {'size': '40px', 'attr': 'align=center'},
+    'http': {'size': '40px', 'attr': 'align=center'},
+    'https': {'size': '50px', 'attr': 'align=center'},
+    'description': {'size': '120px', 'attr': 'align=left', 'editable': {'type': 'text'}},
     }
 
-default_attr = "size: '80px',"
+default_attr = {'size': '80px'}
+valid_tables = ('b_networks', 'alive_networks', 'applications', 'os_cache_stats')
+# the hosts grid shows the flags as icons
+display_values = {'x': '&#10060;', 'ok': '&#9989;', 'down': '&#9760;', 'up': '&#9989;'}
+flag_columns = ('status', *Config.check_ports_dict.values())
+# the hosts grid text cells are cut to one line of text_cell_size chars
+text_cell_size = 32
 app = Flask(__name__)
+# the records keep the columns order
+app.json.sort_keys = False
+# {URL: [grid tables version, ETag, mimetype, body, gzipped body]} of the last rendered pages
+_render_cache: OrderedDict[str, list] = OrderedDict()
+_render_cache_lock = threading.Lock()
+ip_index = IpIndex()
+COMPRESSED_MIMETYPES = ('text/html', 'application/json', 'text/plain', 'application/javascript')
+
+
+@app.before_request
+def start_request_timer():
+    g.start_time = time.perf_counter()
+
+
+@app.after_request
+def request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.observe('http_request_seconds', time.perf_counter() - g.start_time,
+                    route=route, method=request.method, status=response.status_code)
+    return response
+
+
+@app.after_request
+def compress_response(response):
+    """ gzip the not cached pages (the cached ones keep their compressed body) """
+    if (response.status_code != 200 or response.is_streamed or response.direct_passthrough
+            or response.mimetype not in COMPRESSED_MIMETYPES or 'Content-Encoding' in response.headers
+            or 'gzip' not in request.accept_encodings):
+        return response
+    body = response.get_data()
+    if len(body) >= Config.web_gzip_min_bytes:
+        response.set_data(gzip.compress(body, Config.web_gzip_level))
+        response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+def cached_response(view):
+    """ reuse the rendered page of the URL while the grid tables version is the same,
+    the ETag of the page answers If-None-Match with 304
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        version = change_feed.tables_version(get_sql_connection())
+        key = request.full_path
+        with _render_cache_lock:
+            entry = _render_cache.get(key)
+            if entry and entry[0] == version:
+                _render_cache.move_to_end(key)
+        if entry and entry[0] == version:
+            metrics.inc('web_cache_total', result='hit')
+        else:
+            metrics.inc('web_cache_total', result='miss')
+            rendered = make_response(view(*args, **kwargs))
+            if rendered.status_code != 200:
+                return rendered
+            body = rendered.get_data()
+            entry = [version, hashlib.sha1(body).hexdigest()[:20], rendered.mimetype, body, None]
+            with _render_cache_lock:
+                _render_cache[key] = entry
+                while len(_render_cache) > Config.web_cache_entries:
+                    _render_cache.popitem(last=False)
+        _, etag, mimetype, body, gzipped = entry
+        response = Response(body, mimetype=mimetype)
+        if 'gzip' in request.accept_encodings and len(body) >= Config.web_gzip_min_bytes:
+            if gzipped is None:
+                gzipped = entry[4] = gzip.compress(body, Config.web_gzip_level)
+            response.set_data(gzipped)
+            response.headers['Content-Encoding'] = 'gzip'
+            etag += '-gz'
+        response.vary.add('Accept-Encoding')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.set_etag(etag)
+        return response.make_conditional(request)
+    return wrapper
+
+
+@app.teardown_request
+def release_sql_connection(_exc=None):
+    """ the pooled connection outlives the request - do not leave a transaction open on it """
+    sql = get_sql_connection()
+    if sql.conn.in_transaction:
+        sql.conn.rollback()
+    metrics.flush_due(sql)
+
+
+@app.route('/metrics')
+def metrics_page():
+    """ the metrics of all the processes in the Prometheus text format """
+    sql = get_sql_connection()
+    metrics.flush(sql)
+    return Response(metrics.render(sql), mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/details')
@@ -49,10 +158,53 @@ def details():
         'DetailsSummary.html',
         host_details=f'{ipv4}',
         host_links=f'host links {ipv4}',
-        audc_summary='Summary'
+        audc_summary='Summary',
+        history=history.host_history(get_sql_connection(), ipv4),
+        display_values=display_values,
+        format_time=lambda at: datetime.fromtimestamp(at).strftime("%Y-%b-%d %H:%M:%S"),
     )
 
 
+@app.route('/api/history')
+def api_history():
+    """ the host availability: the up/down seconds, the uptime % and the changes of the last 24h, 7d, 30d and 365d,
+    and the raw transitions [time, status] kept by Config.history_raw_retention_days
+    """
+    return jsonify(history.host_history(get_sql_connection(), request.args['ip']))
+
+
+@app.route('/api/hosts')
+def api_hosts():
+    """ the hosts of the subnet: ?cidr=10.8.40.0/21 - the addresses, &group=24 - the number of the hosts of
+    every not empty /24, &fields=name,status - the records of these hosts columns
+    """
+    try:
+        network = ipaddress.IPv4Network(request.args['cidr'], strict=False)
+        group = int(request.args.get('group', 0))
+        if group and not network.prefixlen <= group <= 32:
+            raise ValueError(f'the group prefix length should be {network.prefixlen}-32')
+    except (KeyError, ValueError) as err:
+        return jsonify({"status": "error", "message": f'Wrong "cidr" or "group": {err!r}'}), 400
+    sql = get_sql_connection()
+    result = {'status': 'success', 'cidr': str(network)}
+    if fields := [field for field in request.args.get('fields', '').split(',') if field]:
+        try:
+            columns = sql.check_columns('hosts', dict.fromkeys(['ipv4', *fields]))
+        except ValueError as err:
+            return jsonify({"status": "error", "message": str(err)}), 400
+        rows = sql.hosts_in_range(columns, int(network.network_address), int(network.broadcast_address))
+        result.update(total=len(rows), hosts=[dict(zip(columns, row)) for row in rows])
+        return jsonify(result)
+    ip_index.refresh(sql)
+    if group:
+        counts = ip_index.subnet_counts(network, group)
+        result.update(total=sum(counts.values()), subnets=counts)
+    else:
+        hosts = ip_index.hosts_in(network)
+        result.update(total=len(hosts), hosts=hosts)
+    return jsonify(result)
+
+
 @app.route('/hosts/_action')
 def table_action_hosts():
     return treat_action('hosts', request.args['request'])
@@ -66,19 +218,19 @@ def table_action_bnetworks():
 def treat_action(table, request):
     logger.debug(f'{table=}, {request=}')
     request_dict = json.loads(request)
-    sql = SqlConnection()
+    sql = get_sql_connection()
     action = request_dict['action']
     if action == 'save':
         for host in request_dict['changes']:
             if table == 'hosts':
-                sql_filter = f"ipv4 = '{host['recid']}'"
+                key = {'ipv4': host['recid']}
             elif table == 'b_networks':
                 try:
                     net: ipaddress.IPv4Network = ipaddress.IPv4Network(host['recid'])
                 except ValueError as ex:
                     logger.error(ex)
                     return str(ex), 500
-                sql_filter = f"network = '{host['recid']}'"
+                key = {'network': host['recid']}
             else:
                 msg: str = f'Wrong table {table}'
                 logger.error(msg)
@@ -87,8 +239,8 @@ def treat_action(table, request):
             sql.update_table(
                 table,
                 [*host],
-                [host[key] for key in host],
-                sql_filter,
+                [*host.values()],
+                key,
             )
     elif action == 'delete':
         for host in request_dict["recid"]:
@@ -96,7 +248,7 @@ def treat_action(table, request):
             if table == 'hosts':
                 sql.delete_host(host)
             elif table == 'b_networks':
-                sql.delete_row('b_networks', f'network="{host}"')
+                sql.delete_row('b_networks', {'network': host})
     else:
         msg: str = f'Wrong action {request_dict["action"]}'
         logger.error(msg)
@@ -104,62 +256,158 @@ def treat_action(table, request):
     return jsonify({"status": "success"}), 200
 
 
-@app.route('/data/b_networks')
-def get_b_networks():
-    """ That works with json uploaded dynamically - not in use now """
-    sql = SqlConnection()
-    headers = sql.get_table_header('b_networks')
-    hosts = sql.get_all_rows_in_table('b_networks')
-    count = 1
-    records_list = []
-    for host in hosts:
-        l_dict = dict(zip(headers, host))
-        l_dict['recid'] = count
-        records_list.append(l_dict)
-        count += 1
-    records = {'total': count, 'records': records_list}
-    return json.dumps(records)
+def grid_headers(sql: SqlConnection, table_name: str) -> list[str]:
+    if table_name == 'hosts':
+        return sql.get_hosts_ordered_header()
+    return [header for header in sql.get_table_header(table_name) if header not in change_feed.FEED_COLUMNS]
+
+
+def grid_records(table_name: str, headers: list[str], rows) -> list[dict]:
+    """ the w2ui records of the rows, the first column is the recid """
+    keys = ('recid', *headers)
+    if table_name != 'hosts':
+        return [dict(zip(keys, (row[0], *row))) for row in rows]
+    # the value indexes are shifted by the recid
+    flags = [index + 1 for index, header in enumerate(headers) if header in flag_columns]
+    texts = [index + 1 for index, header in enumerate(headers) if header != 'ipv4' and header not in flag_columns]
+    records = []
+    for row in rows:
+        values = [row[0], *row]
+        for index in flags:
+            value = values[index]
+            values[index] = display_values.get(value, value)
+        for index in texts:
+            value = values[index]
+            if type(value) is str and (len(value) > text_cell_size or '\n' in value):
+                values[index] = value[0:text_cell_size].replace('\n', '')
+        records.append(dict(zip(keys, values)))
+    return records
+
+
+@functools.lru_cache(maxsize=64)
+def grid_script(table_name: str, headers: tuple[str, ...]) -> str:
+    """ the w2ui columns and searches of the table grid as the gridConfig JS variable """
+    if table_name == 'hosts':
+        columns = [dict(field=header, text=header.title(), hidden=header not in show_list,
+                        **params_attr.get(header, default_attr), sortable=True) for header in headers]
+        searches = []
+        for search in search_params:
+            if search == 'status':
+                searches.append(dict(field=search, label=f'{search.title()} ', type='list', operator='is', options={
+                    'items': [{'id': status, 'text': display_values[status]} for status in ('up', 'down')]}))
+            else:
+                searches.append(dict(field=search, label=f'{search.title()} ', type='text', operator='contains'))
+    else:
+        columns = [dict(field=header, text=header.title(), **params_attr.get(header, default_attr), sortable=True)
+                   for header in headers]
+        for column in columns:
+            if column['field'] == 'hosts':
+                column['editable'] = {'type': 'text'}
+        searches = [dict(field=header, label=f'{header.title()} ', type='text', operator='contains')
+                    for header in headers]
+    return f'var gridConfig = {json.dumps(dict(columns=columns, searches=searches))};\n'
+
+
+@app.route('/data/<path:table_name>')
+@cached_response
+def get_table_data(table_name=None):
+    """ the grid records - w2ui remote data protocol (limit/offset, sort, search)
+    the records of the change feed tables come with the revision to follow the /changes of
+    """
+    if table_name != 'hosts' and table_name not in valid_tables:
+        msg: str = f'Wrong table "{table_name}". Available tables: {valid_tables}'
+        logger.error(msg)
+        return jsonify({"status": "error", "message": msg}), 500
+    request_dict = json.loads(request.args.get('request', '{}'))
+    sql = get_sql_connection()
+    headers = grid_headers(sql, table_name)
+    # read before the rows - the rows changed in between are sent again by the feed
+    revision = change_feed.current_revision(sql) if table_name in change_feed.FEED_TABLES else None
+    total, rows = sql.query_table(
+        table_name,
+        headers,
+        limit=request_dict.get('limit', 100),
+        offset=request_dict.get('offset', 0),
+        sort=request_dict.get('sort'),
+        search=request_dict.get('search'),
+        search_logic=request_dict.get('searchLogic', 'AND'),
+    )
+    return jsonify({'status': 'success', 'total': total, 'records': grid_records(table_name, headers, rows),
+                    'revision': revision})
+
+
+@app.route('/changes/<path:table_name>')
+def changes_stream(table_name=None):
+    """ Server-Sent Events stream of the table rows changed after the 'since' revision (or the Last-Event-ID
+    of the reconnected EventSource): 'changes' events {revision, records, inserted, deleted} and a 'reset' event
+    if the revision is too old, the stream ends after Config.feed_stream_seconds and the browser reconnects
+    """
+    if table_name not in change_feed.FEED_TABLES:
+        msg: str = f'No change feed of "{table_name}". Available tables: {[*change_feed.FEED_TABLES]}'
+        logger.error(msg)
+        return jsonify({"status": "error", "message": msg}), 404
+    try:
+        since = int(request.headers.get('Last-Event-ID') or request.args['since'])
+    except (KeyError, ValueError):
+        return jsonify({"status": "error", "message": 'The "since" revision is required'}), 400
+    headers = grid_headers(get_sql_connection(), table_name)
+
+    def stream(since: int):
+        # runs after the request teardown, in the same waitress thread - the same pooled connection
+        sql = get_sql_connection()
+        deadline = time.monotonic() + Config.feed_stream_seconds
+        yield f'retry: {Config.feed_retry_ms}\n\n'
+        while True:
+            changes = change_feed.changes_since(sql, table_name, headers, since)
+            if changes['reset']:
+                yield f'event: reset\ndata: {json.dumps({"revision": changes["revision"]})}\n\n'
+                return
+            if changes['revision'] != since:
+                since = changes['revision']
+                data = dict(revision=since, records=grid_records(table_name, headers, changes['rows']),
+                            inserted=changes['inserted'], deleted=changes['deleted'])
+                metrics.inc('change_feed_rows_total', len(changes['rows']) + len(changes['deleted']),
+                            table=table_name)
+                yield f'id: {since}\nevent: changes\ndata: {json.dumps(data)}\n\n'
+                if len(changes['rows']) == Config.feed_batch:
+                    continue
+            if time.monotonic() >= deadline:
+                return
+            time.sleep(Config.feed_poll_interval)
+            # detects the closed connections
+            yield ':\n\n'
+
+    return Response(stream(since), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 
 @app.route('/tables/<path:table_name>')
+@cached_response
 def tables(table_name=None):
-    valid_tables = ('b_networks', 'alive_networks', 'applications')
     if table_name not in valid_tables:
         msg: str = f'Wrong table "{table_name}". Available tables: {valid_tables}'
         logger.error(msg)
         return msg, 500
-    sql = SqlConnection()
-    headers = sql.get_table_header(table_name)
-    columns = []
-    for header in headers:
-        temp_str = f"field: '{header}', text: '{header.title()}', {params_attr.get(header, default_attr)} sortable: true"
-        if header == 'hosts':
-            temp_str += ", editable: {type: 'text'}"
-        columns.append(f"{{ {temp_str} }}")
-
-    columns_str = ',\n'.join(columns)
-    rows = sql.get_all_rows_in_table(table_name)
-    count = 1
-    records = []
-    search_list = []
-    for host in rows:
-        network = host[0]
-        line = f"recid: '{network}'," + ', '.join([f"{param_name}: '{param}'" for param_name, param in zip(headers, host)])
-        records.append(f"{{{line}}}")
-        count += 1
-    records_str = 'records: [' + ',\n'.join(records) + ']'
-    for header in headers:
-        search_list.append(f"{{field: '{header}', label: '{header.title()} ', type: 'text', operator: 'contains'}}")
-    search_str = ',\n'.join(search_list)
     return render_template(
         'index_w2grid.html',
-        columns_str=columns_str,
-        records_str=records_str,
-        search_str=search_str,
+        grid_config_url='/grid_config/' + table_name,
         action_page='/' + table_name,
+        data_url='/data/' + table_name,
+        changes_url='/changes/' + table_name if table_name in change_feed.FEED_TABLES else '',
     )
 
 
+@app.route('/grid_config/<path:table_name>')
+@cached_response
+def grid_config(table_name=None):
+    """ the grid columns and searches - a static script of the page """
+    if table_name != 'hosts' and table_name not in valid_tables:
+        msg: str = f'Wrong table "{table_name}". Available tables: {valid_tables}'
+        logger.error(msg)
+        return msg, 500
+    headers = tuple(grid_headers(get_sql_connection(), table_name))
+    return Response(grid_script(table_name, headers), mimetype='application/javascript')
+
+
 @app.route('/_add_new', methods=['GET', 'POST'])
 def _add_new():
     # Assuming 'response' is the URL encoded string
@@ -169,7 +417,7 @@ def _add_new():
         req_json = re.sub(r'request=', '', unquote_plus(request.get_data(as_text=True,)))
         data = json.loads(req_json.lower())['record']
         logger.debug(request.method + f', {data=}')
-        sql = SqlConnection()
+        sql = get_sql_connection()
         if 'ipv4' in data:
             data['status'] = 'down'
             data['scanned'] = '0'
@@ -187,7 +435,7 @@ def _add_new():
                 return jsonify({"status": "error",  "message": msg}), 200
             sql.update_table(
                 'b_networks',
-                [*data], [data[key] for key in data], f'network = "{net}"'
+                [*data], [*data.values()], {'network': str(net)}
             )
         else:
             msg: str = f'Unknown data type'
@@ -219,63 +467,21 @@ def _add_new():
 
 
 @app.route('/')
+@cached_response
 def index():
-    sql = SqlConnection()
-    #name = request.args.get('name')
-    hosts = sql.get_hosts()
-    headers = sql.get_hosts_ordered_header()
-
-    columns = []
-    for header in headers:
-        hidden = 'true'
-        if header in show_list: hidden = 'false'
-        columns.append(f"{{ field: '{header}', text: '{header.title()}'," +
-                       f" hidden: {hidden},{params_attr.get(header, default_attr)} sortable: true }}")
-    columns_str = ',\n'.join(columns)
-
-    records = []
-    count = 0
-    for host in hosts:
-        line_list = []
-        ipv4 = host[0]
-        for param_name, param in zip(headers, host):
-            if param_name == 'ipv4':
-                #param = f'<a href="http://{param}">{param}</a>'
-                #param = f'<b style="color:blue;">{param}</b>'
-                line_list.append(f"{param_name}: '{param}'")
-            elif isinstance(param, str):
-                param = param[0:32]
-                param = param.replace('\n', '')
-                line_list.append(f"{param_name}: '{param}'")
-            else:
-                line_list.append(f"{param_name}: '{param}'")
-        line = ', '.join(line_list)
-        line = line.replace("'x'", "'&#10060;'")
-        line = line.replace("'ok'", "'&#9989;'")
-        line = line.replace("'down'", "'&#9760;'")
-        line = line.replace("'up'", "'&#9989;'")
-
-        records.append(f"{{recid: '{ipv4}', {line}}}")
-        count += 1
-    records_str = 'records: [' + ',\n'.join(records) + ']'
-
-    search_list = []
-    for search in search_params:
-        if search == 'status':
-            search_list.append(f"{{field: '{search}', label: '{search.title()} ', type: 'list', operator: 'is', \
-options: {{items: ['&#9989;', '&#9760;']}} }}")
-        else:
-            search_list.append(f"{{field: '{search}', label: '{search.title()} ', type: 'text', operator: 'contains'}}")
-    search_str = ',\n'.join(search_list)
     return render_template(
         'index_w2grid.html',
-        columns_str=columns_str,
-        records_str=records_str,
-        search_str=search_str,
-        action_page='/hosts'
+        grid_config_url='/grid_config/hosts',
+        action_page='/hosts',
+        data_url='/data/hosts',
+        changes_url='/changes/hosts',
     )
 
 
+# the hosts grid config does not depend on the DB
+grid_script('hosts', tuple(SqlConnection.get_hosts_ordered_header()))
+
+
 if __name__ == '__main__':
     try:
         app.run(debug=True, host='0.0.0.0', port=str(Config.web_app_port))
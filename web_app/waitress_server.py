@@ -10,6 +10,6 @@ import flask_web
 if __name__ == '__main__':
     logger = logging.getLogger('waitress_server')
     try:
-        serve(flask_web.app, host='0.0.0.0', port=Config.web_app_port, threads=4)
+        serve(flask_web.app, host='0.0.0.0', port=Config.web_app_port, threads=Config.web_app_threads)
     except Exception as err:
         logger.exception('An exception happened during running Flask app', exc_info=err)